@@ -13,7 +13,8 @@ import os
 from DNASkittleUtils.DDVUtils import editable_str
 
 from FluentDNA.ChainParser import ChainParser, scan_past_header, Batch
-from DNASkittleUtils.Contigs import pluck_contig
+from FluentDNA.FastaIndex import pluck_contig
+from FluentDNA.RunReport import RunReport
 from DNASkittleUtils.DDVUtils import first_word, ReverseComplement
 
 from FluentDNA.Annotations import create_fasta_from_annotation, GFF
@@ -61,13 +62,17 @@ class AnnotatedAlignment(ChainParser):
 
     def _parse_chromosome_in_chain(self, chromosome_name):# -> Batch:
         print("=== Begin Annotated Alignment ===")
-        names, ref_chr = self.setup_for_reference_chromosome(chromosome_name)
-        self.create_alignment_from_relevant_chains(ref_chr)
-
-        self.ref_sequence = pluck_contig(ref_chr, self.ref_source)  # only need the reference chromosome read, skip the others
-        self.query_sequence = self.query_contigs[ref_chr]  # TODO: remove this line
-        self.create_fasta_from_composite_alignment()
-        names['ref_gapped'], names['query_gapped'] = self.write_gapped_fasta(names['ref'], names['query'])
+        self.report = RunReport(self.trace_memory)
+        with self.phase('chain setup'):
+            names, ref_chr = self.setup_for_reference_chromosome(chromosome_name)
+        with self.phase('chain alignment'):
+            self.create_alignment_from_relevant_chains(ref_chr)
+
+            self.ref_sequence = pluck_contig(ref_chr, self.ref_source)  # only need the reference chromosome read, skip the others
+            self.query_sequence = self.query_contigs[ref_chr]  # TODO: remove this line
+            self.create_fasta_from_composite_alignment()
+        with self.phase('gapped fasta'):
+            names['ref_gapped'], names['query_gapped'] = self.write_gapped_fasta(names['ref'], names['query'])
 
         self.query_seq_gapped = editable_str('')
         self.ref_seq_gapped = editable_str('')
@@ -76,13 +81,14 @@ class AnnotatedAlignment(ChainParser):
         self.annotation_phase = True
         # At this point we have created two gapped sequence fastas
 
-        query_annotation_fasta, ref_annotation_fasta = self.load_annotation_fastas(ref_chr)
+        with self.phase('annotation alignment'):
+            query_annotation_fasta, ref_annotation_fasta = self.load_annotation_fastas(ref_chr)
 
-        self.create_fasta_from_composite_alignment(previous_chr=(ref_chr, '+'))
-        self.markup_annotation_differences()
-        # TODO: self.gap_annotation_metadata()
-        names['r_anno_gap'], names['q_anno_gap'] = self.write_gapped_fasta(ref_annotation_fasta, query_annotation_fasta, False)
-        self.write_stats_file()
+            self.create_fasta_from_composite_alignment(previous_chr=(ref_chr, '+'))
+            self.markup_annotation_differences()
+            # TODO: self.gap_annotation_metadata()
+            names['r_anno_gap'], names['q_anno_gap'] = self.write_gapped_fasta(ref_annotation_fasta, query_annotation_fasta, False)
+            self.write_stats_file()
         # NOTE: Order of these appends DOES matter!
         self.output_fastas.append(names['r_anno_gap'])
         self.output_fastas.append(names['q_anno_gap'])
@@ -92,7 +98,7 @@ class AnnotatedAlignment(ChainParser):
         if True:  # self.trial_run:  # these files are never used in the viz
             del names['ref']
             del names['query']
-        batch = Batch(chromosome_name, self.output_fastas, self.output_folder)
+        batch = Batch(chromosome_name, self.output_fastas, self.output_folder, self.report)
         self.output_folder = None  # clear the previous value
         return batch
 
@@ -1,11 +1,12 @@
 import math
-from DNASkittleUtils.Contigs import read_contigs
 from itertools import chain
 from os.path import join, basename
 
+import numpy as np
+
 from FluentDNA.Annotations import create_fasta_from_annotation, find_universal_prefix, parseGFF
 from FluentDNA.ParallelGenomeLayout import ParallelLayout
-from FluentDNA.FluentDNAUtils import filter_by_contigs, copy_to_sources
+from FluentDNA.FluentDNAUtils import read_and_filter_contigs, copy_to_sources
 
 
 class AnnotatedTrackLayout(ParallelLayout):
@@ -21,9 +22,7 @@ class AnnotatedTrackLayout(ParallelLayout):
     def render_genome(self, output_folder, output_file_name, extract_contigs=None):
         self.annotation_fasta = join(output_folder, 'sources', basename(self.gff_filename) +
                                      ('.fa' if extract_contigs is None else '_extracted.fa'))
-        self.contigs = read_contigs(self.fasta_file)
-        # TODO: Genome is read_contigs twice unnecessarily. This could be sped up.
-        self.contigs = filter_by_contigs(self.contigs, extract_contigs)
+        self.contigs = read_and_filter_contigs(self.fasta_file, extract_contigs, streamed=True)  # names and lengths
         extract_contigs = [x.name.split()[0] for x in self.contigs]
         lengths = [len(x.seq) for x in self.contigs]
         create_fasta_from_annotation(self.annotation, extract_contigs,
@@ -47,14 +46,10 @@ class AnnotatedTrackLayout(ParallelLayout):
             self.activate_natural_colors()
 
 
-    def calc_padding(self, total_progress, next_segment_length):
+    def limit_title_padding(self, title_padding):
         """ Skip the exceptions used in Parallel Layouts for first scaffold."""
-        reset_padding, title_padding, tail = super(ParallelLayout, self) \
-            .calc_padding(total_progress, next_segment_length)
         # no larger than 1 full column or text will overlap
-        if title_padding >= self.levels[3].chunk_size:
-            title_padding = self.levels[2].chunk_size
-        return reset_padding, title_padding, tail
+        return np.where(title_padding >= self.levels[3].chunk_size, self.levels[2].chunk_size, title_padding)
 
 
     def draw_extras(self):
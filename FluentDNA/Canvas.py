@@ -0,0 +1,664 @@
+"""Canvas classes that stand in for the single giant PIL Image used by TileLayout.
+A PIL Image has to be allocated in one piece, which means the size of a genome visualization
+is bounded by RAM.  ArrayCanvas implements the small subset of the PIL Image API that the Layouts
+actually use (paste, ImageDraw rectangle and text, pixel access, save) on top of numpy arrays.
+Anything more complicated than a pixel or block write is rendered by PIL on a small region
+image and written back, so the results are pixel identical to drawing on a PIL Image."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import math
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageMode
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+
+png_color_types = {'L': 0, 'RGB': 2, 'P': 3, 'LA': 4, 'RGBA': 6}
+png_filter_bytes = 4 * 1024 * 1024  # rows filtered at once by write_png()
+
+
+def canvas_draw(image):
+    """ImageDraw.Draw() for either a PIL Image or an ArrayCanvas"""
+    if isinstance(image, ArrayCanvas):
+        return CanvasDraw(image)
+    return ImageDraw.Draw(image)
+
+
+class ArrayCanvas(object):
+    """Base class for canvases that are not one contiguous PIL Image.  Subclasses store the pixels
+    and implement read_region(), write_region() and __setitem__().  Everything else is built on those.
+    Pixels are always handled as (height, width, bands) uint8 arrays internally.
+    __setitem__ follows numpy conventions: canvas[y, x] with slices or arrays of indices, the same
+    way draw_nucleotides() writes into an ndarray canvas.
+    Mode 'P' canvases store one palette index per pixel with a fixed palette of up to 256 RGB colors.
+    PIL drawing on them happens in RGB and is mapped back to the nearest palette color.
+    shared canvases can be written to by forked worker processes."""
+    shared = False
+
+    def __init__(self, mode, size, color=None, palette=None):
+        self.owner_pid = os.getpid()  # forked workers must not delete files they inherited
+        self.mode = mode
+        self.size = (int(size[0]), int(size[1]))
+        self.bands = len(ImageMode.getmode(mode).bands)
+        self.palette = None
+        if mode == 'P':
+            assert palette is not None and len(palette) <= 256, "Indexed canvases need a palette of <= 256 colors"
+            self.palette = np.zeros((256, 3), dtype=np.uint8)
+            self.palette[:len(palette)] = palette
+            self.n_colors = len(palette)
+            self.background = self.colors_to_indices(np.asarray([color[:3]], dtype=np.uint8)).reshape(1)
+        else:  # let PIL decide what color means for this mode (ex: alpha for RGBA)
+            self.background = np.asarray(Image.new(mode, (1, 1), color)).reshape(self.bands)
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    @property
+    def shape(self):
+        if self.bands == 1:
+            return self.height, self.width
+        return self.height, self.width, self.bands
+
+    def read_region(self, x0, y0, x1, y1):
+        """Returns a copy of the pixels in the box as a (height, width, bands) array"""
+        raise NotImplementedError()
+
+    def write_region(self, x0, y0, array):
+        """Overwrites the pixels starting at x0, y0 with a (height, width, bands) array"""
+        raise NotImplementedError()
+
+    def __setitem__(self, key, value):
+        raise NotImplementedError()
+
+    def clip_box(self, box):
+        """Intersection of box with the canvas as integers. Returns None if they don't overlap."""
+        x0, y0 = max(0, int(math.floor(box[0]))), max(0, int(math.floor(box[1])))
+        x1, y1 = min(self.width, int(math.ceil(box[2]))), min(self.height, int(math.ceil(box[3])))
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return x0, y0, x1, y1
+
+    def colors_to_indices(self, colors):
+        """Maps an (..., 3) array of RGB colors to the index of the nearest palette entry, shaped (..., 1).
+        Colors that are in the palette map exactly."""
+        flat = colors.reshape((-1, 3)).astype(np.int32)
+        keys = flat[:, 0] << 16 | flat[:, 1] << 8 | flat[:, 2]
+        unique, inverse = np.unique(keys, return_inverse=True)
+        unique_colors = np.stack([unique >> 16 & 255, unique >> 8 & 255, unique & 255], axis=1)
+        distance = ((unique_colors[:, None, :] - self.palette[None, :self.n_colors].astype(np.int32)) ** 2).sum(-1)
+        nearest = distance.argmin(axis=1).astype(np.uint8)
+        return nearest[inverse].reshape(colors.shape[:-1] + (1,))
+
+    def palette_bytes(self):
+        """Flat RGB palette for 'P' mode canvases"""
+        if self.palette is None:
+            return None
+        return self.palette[:self.n_colors].tobytes()
+
+    def array_to_image(self, array):
+        if self.bands == 1:
+            array = array[..., 0]
+        image = Image.fromarray(np.ascontiguousarray(array), self.mode)
+        if self.mode == 'P':
+            image.putpalette(self.palette.tobytes())
+        return image
+
+    def image_to_array(self, image):
+        if self.mode == 'P' and image.mode != 'P':
+            return self.colors_to_indices(np.asarray(image.convert('RGB')))
+        array = np.asarray(image)
+        return array.reshape((image.height, image.width, self.bands))
+
+    def edit_region(self, box, edit):
+        """Hands a PIL Image of the box to edit(region_image, x0, y0) and writes the result back.
+        This is how paste() and text get exactly the same compositing as PIL.
+        Indexed canvases are edited in RGB, then mapped back to the palette."""
+        clipped = self.clip_box(box)
+        if clipped is None:
+            return
+        x0, y0, x1, y1 = clipped
+        region = self.array_to_image(self.read_region(x0, y0, x1, y1))
+        if self.mode == 'P':
+            region = region.convert('RGB')
+        edit(region, x0, y0)
+        self.write_region(x0, y0, self.image_to_array(region))
+
+    def paste(self, im, box=None, mask=None):
+        if box is None:
+            box = (0, 0)
+        left, top = int(box[0]), int(box[1])
+
+        def paste_into(region, x0, y0):
+            region.paste(im, (left - x0, top - y0), mask)
+        self.edit_region((left, top, left + im.width, top + im.height), paste_into)
+
+    def crop(self, box):
+        """Same as Image.crop(), areas outside the canvas are zero filled."""
+        left, top, right, bottom = [int(v) for v in box]
+        result = np.zeros((bottom - top, right - left, self.bands), dtype=np.uint8)
+        clipped = self.clip_box(box)
+        if clipped is not None:
+            x0, y0, x1, y1 = clipped
+            result[y0 - top:y1 - top, x0 - left:x1 - left] = self.read_region(x0, y0, x1, y1)
+        return self.array_to_image(result)
+
+    def crop_tiles(self, boxes):
+        """Yields crop(box) for each box.  Boxes are expected in row major order, like deep zoom tiles, so each
+        band of canvas rows is read once and every tile in it is cut from that band.  Bands are a quarter of
+        band_height(), like halved()."""
+        band_top, band_bottom, band = 0, 0, None
+        for box in boxes:
+            left, top, right, bottom = [int(v) for v in box]
+            result = np.zeros((bottom - top, right - left, self.bands), dtype=np.uint8)
+            clipped = self.clip_box(box)
+            if clipped is not None:
+                x0, y0, x1, y1 = clipped
+                if band is None or y0 < band_top or y1 > band_bottom:
+                    band = None  # free the last band before reading the next
+                    band_top, band_bottom = y0, min(self.height, max(y1, y0 + self.band_height() // 4))
+                    band = self.read_region(0, band_top, self.width, band_bottom)
+                result[y0 - top:y1 - top, x0 - left:x1 - left] = band[y0 - band_top:y1 - band_top, x0:x1]
+            yield self.array_to_image(result)
+
+    def load(self):
+        return CanvasPixelAccess(self)
+
+    def iter_bands(self, band_height):
+        """Yields horizontal strips of the whole canvas from top to bottom"""
+        for y in range(0, self.height, band_height):
+            yield self.read_region(0, y, self.width, min(self.height, y + band_height))
+
+    def band_height(self):
+        return 256
+
+    def save(self, fp, format=None):
+        """PNG is written one band at a time so the full image never needs to be in memory.
+        Other formats are assembled into a PIL Image first."""
+        extension = os.path.splitext(fp)[1].lower() if isinstance(fp, str) else ''
+        if (format or extension.lstrip('.') or 'PNG').upper() == 'PNG':
+            write_png(fp, self.mode, self.size, self.iter_bands(self.band_height()), self.palette_bytes())
+        else:
+            self.to_image().save(fp, format)
+
+    def to_image(self):
+        """Assembles the entire canvas into one PIL Image. Only use this on canvases that fit in RAM.
+        Bands are pasted into one preallocated Image so there's never a second full size copy."""
+        image = Image.new(self.mode, self.size)
+        if self.mode == 'P':
+            image.putpalette(self.palette.tobytes())
+        band_height = self.band_height()
+        for y, band in zip(range(0, self.height, band_height), self.iter_bands(band_height)):
+            image.paste(self.array_to_image(band), (0, y))
+        return image
+
+    def halved(self):
+        """Half size RGB (or RGBA) PIL Image where each pixel is the average of a 2x2 block.  It's built one band of
+        rows at a time, so a canvas bigger than RAM is never copied whole.  Used for the deep zoom level below
+        full size by ImageCreator.get_image().  Odd edges repeat the last row or column."""
+        mode = 'RGBA' if self.mode == 'RGBA' else 'RGB'
+        image = Image.new(mode, ((self.width + 1) // 2, (self.height + 1) // 2))
+        band_height = max(2, self.band_height() // 8 * 2)  # quarter bands, the uint16 sums are larger
+        for y, band in zip(range(0, self.height, band_height), self.iter_bands(band_height)):
+            if self.mode == 'P':
+                band = self.palette[band[..., 0]]
+            if band.shape[0] % 2:
+                band = np.concatenate([band, band[-1:]], axis=0)
+            if band.shape[1] % 2:
+                band = np.concatenate([band, band[:, -1:]], axis=1)
+            summed = band[0::2, 0::2].astype(np.uint16)
+            summed += band[1::2, 0::2]
+            summed += band[0::2, 1::2]
+            summed += band[1::2, 1::2]
+            summed += 2  # round to nearest
+            image.paste(Image.fromarray((summed // 4).astype(np.uint8), mode), (0, y // 2))
+        return image
+
+    def close(self):
+        pass
+
+
+class NumpyCanvas(ArrayCanvas):
+    """Canvas stored in one (height, width, bands) ndarray.  TileLayout draws nucleotides into one in
+    memory: 3 bytes per RGB pixel where PIL uses 4, and indexed 'P' canvases keep their palette while
+    RGB text is drawn on them."""
+    def __init__(self, mode, size, color=None, palette=None):
+        super(NumpyCanvas, self).__init__(mode, size, color, palette)
+        self.array = self.allocate()
+        for y in range(0, self.height, self.band_height()):  # fill without a full size temporary
+            self.array[y:y + self.band_height()] = self.background
+
+    def allocate(self):
+        return np.empty((self.height, self.width, self.bands), dtype=np.uint8)
+
+    def read_region(self, x0, y0, x1, y1):
+        return np.array(self.array[y0:y1, x0:x1])
+
+    def write_region(self, x0, y0, array):
+        self.array[y0:y0 + array.shape[0], x0:x0 + array.shape[1]] = array
+
+    def iter_bands(self, band_height):
+        """Views into the array instead of copies, nothing that reads bands writes to them"""
+        for y in range(0, self.height, band_height):
+            yield self.array[y:y + band_height]
+
+    def __setitem__(self, key, value):
+        value = np.asarray(value, dtype=np.uint8)
+        self.array[key] = value.reshape(value.shape[:-1] + (self.bands,))
+
+    def band_height(self):
+        return max(1, 64 * 1024 * 1024 // max(1, self.width * self.bands))  # ~64MB per band
+
+    def close(self):
+        self.array = None
+
+
+class MemmapCanvas(NumpyCanvas):
+    """Canvas backed by a raw numpy.memmap file of (height, width, bands) bytes.  The operating system
+    page cache decides how much of it lives in RAM, so canvases larger than RAM render at disk speed.
+    The file is deleted on close() unless delete_on_close=False."""
+    shared = True
+
+    def __init__(self, mode, size, color=None, palette=None, path=None, directory=None, delete_on_close=True):
+        if path is None:
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            handle, path = tempfile.mkstemp(prefix='fluentdna_canvas_', suffix='.raw', dir=directory)
+            os.close(handle)
+        self.path = path
+        self.delete_on_close = delete_on_close
+        super(MemmapCanvas, self).__init__(mode, size, color, palette)
+
+    def allocate(self):
+        return np.memmap(self.path, dtype=np.uint8, mode='w+', shape=(self.height, self.width, self.bands))
+
+    def close(self):
+        if self.array is not None and os.getpid() == self.owner_pid:
+            self.array.flush()
+            self.array = None  # memmap closes when the last reference is gone
+            if self.delete_on_close and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def __del__(self):
+        try:
+            self.close()
+        except BaseException:
+            pass  # interpreter shutdown
+
+
+class SharedMemoryCanvas(NumpyCanvas):
+    """NumpyCanvas in a multiprocessing.shared_memory block, so forked workers can draw into it
+    without the pixels being pickled or copied."""
+    shared = True
+
+    def __init__(self, mode, size, color=None, palette=None):
+        self.block = None
+        super(SharedMemoryCanvas, self).__init__(mode, size, color, palette)
+
+    def allocate(self):
+        shape = (self.height, self.width, self.bands)
+        self.block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))))
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.block.buf)
+
+    def close(self):
+        if self.block is not None and os.getpid() == self.owner_pid:
+            self.array = None  # the buffer can't be released while an array is using it
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except BaseException:
+            pass  # interpreter shutdown
+
+
+class CanvasPixelAccess(object):
+    """Stand in for the PixelAccess object returned by Image.load().  This is slow, it's only meant for
+    Layouts that still draw one pixel at a time."""
+    def __init__(self, canvas):
+        self.canvas = canvas
+
+    def _check(self, xy):
+        x, y = int(xy[0]), int(xy[1])
+        if not (0 <= x < self.canvas.width and 0 <= y < self.canvas.height):
+            raise IndexError("image index out of range")
+        return x, y
+
+    def __getitem__(self, xy):
+        x, y = self._check(xy)
+        pixel = self.canvas.read_region(x, y, x + 1, y + 1)[0, 0]
+        return int(pixel[0]) if self.canvas.bands == 1 else tuple(int(v) for v in pixel)
+
+    def __setitem__(self, xy, color):
+        x, y = self._check(xy)
+        if not hasattr(color, '__len__'):
+            color = (color,)
+        if self.canvas.mode == 'P' and len(color) >= 3:
+            color = self.canvas.colors_to_indices(np.asarray([color[:3]], dtype=np.uint8))[0]
+        pixel = np.full((1, 1, self.canvas.bands), 255, dtype=np.uint8)  # missing alpha is opaque
+        pixel[0, 0, :len(color)] = color[:self.canvas.bands]
+        self.canvas.write_region(x, y, pixel)
+
+
+class CanvasDraw(object):
+    """The parts of ImageDraw used by the Layouts. Each call is drawn by ImageDraw onto
+    a region image just big enough to hold the shape."""
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.scratch = ImageDraw.Draw(Image.new('L', (1, 1)))  # for measuring text
+
+    def rectangle(self, xy, fill=None, outline=None, width=1):
+        coords = np.asarray(xy, dtype=float).reshape(-1)
+        box = (coords[0::2].min(), coords[1::2].min(), coords[0::2].max() + 1, coords[1::2].max() + 1)
+
+        def draw_rectangle(region, x0, y0):
+            shifted = [v - (x0 if i % 2 == 0 else y0) for i, v in enumerate(coords)]
+            ImageDraw.Draw(region).rectangle(shifted, fill=fill, outline=outline, width=width)
+        self.canvas.edit_region(box, draw_rectangle)
+
+    def text(self, xy, text, fill=None, font=None, **kwargs):
+        self._text('text', xy, text, fill, font, kwargs)
+
+    def multiline_text(self, xy, text, fill=None, font=None, **kwargs):
+        self._text('multiline_text', xy, text, fill, font, kwargs)
+
+    def _text(self, method, xy, text, fill, font, kwargs):
+        width, height = self.scratch.multiline_textsize(text, font=font)
+        margin = height // 2 + 2  # room for glyphs that overhang their advance width
+        left, top = xy[0], xy[1]
+        box = (left - margin, top - margin, left + width + margin, top + height + margin)
+
+        def draw_text(region, x0, y0):
+            getattr(ImageDraw.Draw(region), method)((left - x0, top - y0), text, fill=fill, font=font,
+                                                    **kwargs)
+        self.canvas.edit_region(box, draw_text)
+
+
+class TiledCanvas(ArrayCanvas):
+    """Canvas made of square tiles that are only allocated once something is drawn on them.
+    Blank tiles are never allocated, which is most of a fragmented assembly.  When the allocated
+    tiles exceed memory_budget bytes the least recently used ones are spilled to raw files in
+    spill_dir and read back when they are needed again.  save() assembles the output one row of
+    tiles at a time."""
+    def __init__(self, mode, size, color=None, palette=None, tile_size=2048, memory_budget=2 * 1024 ** 3,
+                 spill_dir=None):
+        super(TiledCanvas, self).__init__(mode, size, color, palette)
+        self.tile_size = int(tile_size)
+        self.tile_bytes = self.tile_size * self.tile_size * self.bands
+        self.max_tiles_in_memory = max(1, int(memory_budget // self.tile_bytes))
+        self.n_tiles_x = int(math.ceil(self.width / self.tile_size))
+        self.tiles = OrderedDict()  # (tile_x, tile_y): ndarray, least recently used first
+        self.spilled = set()
+        self.spill_root = spill_dir
+        self.spill_dir = None  # created on first spill
+
+    def tile(self, tile_x, tile_y, create=True):
+        """Returns the array for one tile, reading it back from disk if it was spilled.
+        If create=False blank tiles return None instead of being allocated."""
+        key = (tile_x, tile_y)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+        if key in self.spilled:
+            path = self.spill_path(key)
+            tile = np.fromfile(path, dtype=np.uint8).reshape((self.tile_size, self.tile_size, self.bands))
+            os.remove(path)
+            self.spilled.remove(key)
+        elif not create:
+            return None
+        else:
+            tile = np.empty((self.tile_size, self.tile_size, self.bands), dtype=np.uint8)
+            tile[:] = self.background
+        self.tiles[key] = tile
+        self.enforce_memory_budget()
+        return tile
+
+    def enforce_memory_budget(self):
+        while len(self.tiles) > self.max_tiles_in_memory:
+            key, tile = self.tiles.popitem(last=False)
+            if self.spill_dir is None:
+                if self.spill_root and not os.path.exists(self.spill_root):
+                    os.makedirs(self.spill_root)
+                self.spill_dir = tempfile.mkdtemp(prefix='fluentdna_tiles_', dir=self.spill_root)
+            tile.tofile(self.spill_path(key))
+            self.spilled.add(key)
+
+    def peek(self, tile_x, tile_y, top, bottom):
+        """Rows top:bottom of a tile without changing what is kept in memory, None if the tile is blank.
+        Spilled tiles are read straight from their file so reading the canvas never evicts anything."""
+        key = (tile_x, tile_y)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            return tile[top:bottom]
+        if key not in self.spilled:
+            return None
+        spilled = np.memmap(self.spill_path(key), dtype=np.uint8, mode='r',
+                            shape=(self.tile_size, self.tile_size, self.bands))
+        rows = np.array(spilled[top:bottom])
+        del spilled
+        return rows
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, '%i_%i.raw' % key)
+
+    def tiles_in_box(self, x0, y0, x1, y1):
+        """Yields tile coordinates plus the overlapping box in canvas coordinates"""
+        size = self.tile_size
+        for tile_y in range(y0 // size, (y1 - 1) // size + 1):
+            for tile_x in range(x0 // size, (x1 - 1) // size + 1):
+                yield tile_x, tile_y, (max(x0, tile_x * size), max(y0, tile_y * size),
+                                       min(x1, (tile_x + 1) * size), min(y1, (tile_y + 1) * size))
+
+    def read_region(self, x0, y0, x1, y1):
+        result = np.empty((y1 - y0, x1 - x0, self.bands), dtype=np.uint8)
+        result[:] = self.background
+        for tile_x, tile_y, (left, top, right, bottom) in self.tiles_in_box(x0, y0, x1, y1):
+            tx, ty = tile_x * self.tile_size, tile_y * self.tile_size
+            rows = self.peek(tile_x, tile_y, top - ty, bottom - ty)
+            if rows is not None:
+                result[top - y0:bottom - y0, left - x0:right - x0] = rows[:, left - tx:right - tx]
+        return result
+
+    def write_region(self, x0, y0, array):
+        x1, y1 = x0 + array.shape[1], y0 + array.shape[0]
+        for tile_x, tile_y, (left, top, right, bottom) in self.tiles_in_box(x0, y0, x1, y1):
+            tx, ty = tile_x * self.tile_size, tile_y * self.tile_size
+            self.tile(tile_x, tile_y)[top - ty:bottom - ty, left - tx:right - tx] = \
+                array[top - y0:bottom - y0, left - x0:right - x0]
+
+    def __setitem__(self, key, value):
+        ys, xs = key
+        value = np.asarray(value, dtype=np.uint8)
+        if not isinstance(ys, (slice, int, np.integer)):  # pixels scattered by index arrays
+            return self.scatter(np.asarray(ys), np.asarray(xs), value.reshape((-1, self.bands)))
+        rows = self.index_range(ys, self.height)
+        columns = self.index_range(xs, self.width)
+        if not len(rows) or not len(columns):
+            return
+        assert columns.step == 1, "Only rows can be written with a step"
+        block = np.broadcast_to(value.reshape(value.shape[:-1] + (self.bands,)),
+                                (len(rows), len(columns), self.bands))
+        rows = np.arange(rows.start, rows.stop, rows.step)
+        size = self.tile_size
+        for tile_y in np.unique(rows // size):
+            in_tile = np.flatnonzero(rows // size == tile_y)
+            tile_rows = rows[in_tile] - tile_y * size
+            for tile_x, _, (left, top, right, bottom) in self.tiles_in_box(columns.start, 0, columns.stop, 1):
+                self.tile(tile_x, int(tile_y))[tile_rows, left - tile_x * size:right - tile_x * size] = \
+                    block[in_tile, left - columns.start:right - columns.start]
+
+    @staticmethod
+    def index_range(index, length):
+        if isinstance(index, slice):
+            return range(*index.indices(length))
+        index = int(index) + length if index < 0 else int(index)
+        return range(index, index + 1)
+
+    def scatter(self, ys, xs, values):
+        """Writes individual pixels, grouped by tile so each tile is fetched once.
+        The stable sort keeps the last write to a pixel on top, same as numpy."""
+        size = self.tile_size
+        tile_ids = (ys // size) * self.n_tiles_x + xs // size
+        order = np.argsort(tile_ids, kind='stable')
+        boundaries = np.flatnonzero(np.diff(tile_ids[order])) + 1
+        for group in np.split(order, boundaries):
+            if not len(group):
+                continue
+            tile_y, tile_x = divmod(int(tile_ids[group[0]]), self.n_tiles_x)
+            self.tile(tile_x, tile_y)[ys[group] - tile_y * size, xs[group] - tile_x * size] = values[group]
+
+    def band_height(self):
+        return self.tile_size
+
+    def close(self):
+        """Frees memory and deletes any spilled tiles"""
+        if os.getpid() != self.owner_pid:
+            return
+        self.tiles.clear()
+        self.spilled.clear()
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except BaseException:
+            pass  # interpreter shutdown
+
+
+def write_png_chunk(f, chunk_type, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type)
+    f.write(data)
+    f.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def write_png(path, mode, size, bands, palette=None, compress_level=6):
+    """Streams horizontal bands of pixels into a PNG file.  PIL can only write a PNG from a complete
+    image in memory. Rows use the Sub filter (palette images use no filter, as the PNG spec suggests)."""
+    width, height = size
+    channels = len(ImageMode.getmode(mode).bands)
+    use_sub_filter = mode != 'P'
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, png_color_types[mode], 0, 0, 0))
+        if palette is not None:
+            write_png_chunk(f, b'PLTE', bytes(palette))
+        compressor = zlib.compressobj(compress_level)
+        chunk_rows = max(1, png_filter_bytes // (width * channels + 1))
+        for band in bands:
+            band = band.reshape((band.shape[0], width * channels))
+            for start in range(0, band.shape[0], chunk_rows):  # filtered copies stay small next to the band
+                rows = band[start:start + chunk_rows]
+                filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+                filtered[:, 0] = 1 if use_sub_filter else 0
+                filtered[:, 1:] = rows
+                if use_sub_filter:
+                    filtered[:, 1 + channels:] -= rows[:, :-channels]  # uint8 wraps around, as PNG expects
+                data = compressor.compress(filtered.data)
+                if data:
+                    write_png_chunk(f, b'IDAT', data)
+        write_png_chunk(f, b'IDAT', compressor.flush())
+        write_png_chunk(f, b'IEND', b'')
+
+
+class PNGRows(object):
+    """Reads a PNG from the top down, a band of rows at a time, so deep zoom can tile a PNG that's too big
+    to decode whole.  Only 8 bit, non interlaced PNGs, which is what write_png() and PIL write; open()
+    returns None for anything else.  The scanlines are inflated here and unfiltered by PIL's own PNG
+    decoder: each band is handed to it with the last row of the band before in front, unfiltered."""
+    read_size = 1024 * 1024  # compressed bytes read from the file at once
+
+    def __init__(self, f, idat_length, width, height, mode, palette=None):
+        self.file = f
+        self.width, self.height, self.mode = width, height, mode
+        self.palette = None
+        if palette is not None:  # what getpalette() gives for the whole image, in this version of PIL
+            probe = Image.new('P', (1, 1))
+            probe.putpalette(palette)
+            self.palette = probe.getpalette()
+        self.row_bytes = width * len(ImageMode.getmode(mode).bands) + 1
+        self.previous = bytes(self.row_bytes)  # the row above the first is all zeros
+        self.pending = bytearray()
+        self.inflater = zlib.decompressobj()
+        self.pieces = self.compressed(idat_length)
+
+    @classmethod
+    def open(cls, path):
+        """PNGRows for the file at path, or None if it isn't a PNG this can read"""
+        f = open(path, 'rb')
+        try:
+            if f.read(8) != b'\x89PNG\r\n\x1a\n':
+                raise ValueError()
+            header, palette = None, None
+            length, chunk_type = struct.unpack('>I4s', f.read(8))
+            while chunk_type != b'IDAT':
+                data = f.read(length + 4)[:length]  # and the CRC
+                if chunk_type == b'IHDR':
+                    header = struct.unpack('>IIBBBBB', data)
+                elif chunk_type == b'PLTE':
+                    palette = data
+                length, chunk_type = struct.unpack('>I4s', f.read(8))
+            width, height, depth, color_type, _, _, interlace = header
+            modes = {color: mode for mode, color in png_color_types.items()}
+            if depth != 8 or interlace or color_type not in modes:
+                raise ValueError()
+            return cls(f, length, width, height, modes[color_type], palette)
+        except (ValueError, TypeError, struct.error):
+            f.close()
+            return None
+
+    def compressed(self, length):
+        """The data of the consecutive IDAT chunks in pieces of at most read_size bytes"""
+        while True:
+            while length:
+                piece = self.file.read(min(length, self.read_size))
+                if not piece:
+                    return
+                length -= len(piece)
+                yield piece
+            header = self.file.read(4 + 8)[4:]  # skip the CRC
+            if len(header) < 8:
+                return
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type != b'IDAT':
+                return
+
+    def read(self, rows):
+        """The next rows of the image as a PIL Image"""
+        needed = rows * self.row_bytes
+        while len(self.pending) < needed:
+            data = self.inflater.unconsumed_tail or next(self.pieces, b'')
+            if not data:
+                raise IOError("%s ends before its last row" % self.file.name)
+            self.pending += self.inflater.decompress(data, needed - len(self.pending))
+        stream = zlib.compress(self.previous + bytes(self.pending[:needed]), 0)  # stored, not compressed
+        del self.pending[:needed]
+        band = Image.frombytes(self.mode, (self.width, rows + 1), stream, 'zip', self.mode)
+        self.previous = b'\0' + band.crop((0, rows, self.width, rows + 1)).tobytes()
+        band = band.crop((0, 1, self.width, rows + 1))
+        if self.palette is not None:
+            band.putpalette(self.palette)
+        return band
+
+    def close(self):
+        self.file.close()
@@ -5,6 +5,7 @@ import os
 import sys
 import traceback
 from collections import namedtuple
+from contextlib import contextmanager
 
 try:
     from blist import blist
@@ -17,16 +18,20 @@ except ImportError:
 
 
 from DNASkittleUtils.CommandLineUtils import just_the_name
-from DNASkittleUtils.Contigs import pluck_contig, write_complete_fasta
+from DNASkittleUtils.Contigs import write_complete_fasta
 from DNASkittleUtils.DDVUtils import first_word, ReverseComplement, BlankIterator, editable_str
 from FluentDNA.DefaultOrderedDict import DefaultOrderedDict
 from FluentDNA.ChainFiles import chain_file_to_list, match
+from FluentDNA.FastaIndex import pluck_contig
 from FluentDNA.FluentDNAUtils import make_output_directory, keydefaultdict, read_contigs_to_dict, copy_to_sources
+from FluentDNA.Progress import Progress, Cancelled
+from FluentDNA.RunReport import RunReport
 from FluentDNA.Span import AlignedSpans, Span, alignment_chopping_index
 from FluentDNA import gap_char
 from FluentDNA.TileLayout import hex_to_rgb
 
-Batch = namedtuple('Batch', ['chr', 'fastas', 'output_folder'])
+Batch = namedtuple('Batch', ['chr', 'fastas', 'output_folder', 'report'])
+Batch.__new__.__defaults__ = (None,)  # report: RunReport of the chain phases, continued by the layout
 
 
 def scan_past_header(seq, index, take_shortcuts=False, skip_newline=True):
@@ -97,6 +102,9 @@ class ChainParser(object):
         self.stored_rev_comps = {}
         self.gapped = '_gapped'
         self.stats = initial_stats()
+        self.trace_memory = False  # RunReport(trace_allocations) for each chromosome
+        self.report = None
+        self.progress = Progress()  # events and cancellation, see Progress.py
 
         if self.query_source:
             self.query_contigs = read_contigs_to_dict(self.query_source)
@@ -275,7 +283,9 @@ class ChainParser(object):
             alignment = self.alignment
         query_source_annotation = editable_str('')  # only used if translocation_markup
 
-        for pair in alignment:
+        for pair_index, pair in enumerate(alignment):
+            if pair_index % 1000 == 0:
+                self.progress.update(pair_index / len(alignment), self.ref_chr_name)
             if previous_chr != (pair.query.contig_name, pair.query.strand):
                 # pair.ref.contig_name could be None
                 if not self.switch_sequences(pair.query.contig_name, pair.query.strand, translocation_markup,
@@ -521,7 +531,8 @@ class ChainParser(object):
         if not relevant_chains:
             raise ValueError("Unable to find any chain matches for %s" % ref_chr)
         previous = None
-        for chain in relevant_chains:
+        for chain_index, chain in enumerate(relevant_chains):
+            self.progress.update(chain_index / len(relevant_chains), ref_chr)
             is_master_alignment = previous is None
             self.mash_fasta_and_chain_together(chain, is_master_alignment)  # first chain is the master alignment
             previous = chain
@@ -558,18 +569,29 @@ class ChainParser(object):
         return names, ref_chr
 
 
+    @contextmanager
+    def phase(self, name):
+        """Times one step into self.report and reports it to self.progress, like TileLayout.phase()"""
+        with self.report.phase(name), self.progress.phase(name):
+            yield
+
     def _parse_chromosome_in_chain(self, chromosome_name):# -> Batch:
         print("=== Begin ChainParser Unique Alignment ===")
-        names, ref_chr = self.setup_for_reference_chromosome(chromosome_name)
-        self.create_alignment_from_relevant_chains(ref_chr)
-        self.create_fasta_from_composite_alignment()
-        translocation_markup = self.create_fasta_from_composite_alignment(translocation_markup=True)
-
-        names['ref_gapped'], names['query_gapped'] = self.write_gapped_fasta(names['ref'], names['query'])
-        names['ref_unique'], names['query_unique'] = \
-            self.print_only_unique(names['query_gapped'], names['ref_gapped'], translocation_markup)
-        names['translocation_markup'] = self.write_markup_file(names['ref'], translocation_markup)
-        stats_path = self.write_stats_file()
+        self.report = RunReport(self.trace_memory)
+        with self.phase('chain setup'):
+            names, ref_chr = self.setup_for_reference_chromosome(chromosome_name)
+        with self.phase('chain alignment'):
+            self.create_alignment_from_relevant_chains(ref_chr)
+            self.create_fasta_from_composite_alignment()
+            translocation_markup = self.create_fasta_from_composite_alignment(translocation_markup=True)
+
+        with self.phase('gapped fasta'):
+            names['ref_gapped'], names['query_gapped'] = self.write_gapped_fasta(names['ref'], names['query'])
+        with self.phase('unique fasta'):
+            names['ref_unique'], names['query_unique'] = \
+                self.print_only_unique(names['query_gapped'], names['ref_gapped'], translocation_markup)
+            names['translocation_markup'] = self.write_markup_file(names['ref'], translocation_markup)
+            stats_path = self.write_stats_file()
         # NOTE: Order of these appends DOES matter!
         self.output_fastas.append(names['ref_gapped'])
         self.output_fastas.append(names['ref_unique'])
@@ -580,7 +602,7 @@ class ChainParser(object):
         if True:  #self.trial_run:  # these files are never used in the viz
             del names['ref']
             del names['query']
-        batch = Batch(chromosome_name, self.output_fastas, self.output_folder)
+        batch = Batch(chromosome_name, self.output_fastas, self.output_folder, self.report)
         # self.output_folder = None  # clear the previous value
         return batch
 
@@ -598,6 +620,8 @@ class ChainParser(object):
             try:
                 result = self._parse_chromosome_in_chain(chromosome)
                 batches.append(result)
+            except Cancelled:
+                raise
             except BaseException as e:
                 print("Encountered exception while parsing chromosome alignment: ")
                 traceback.print_exc()
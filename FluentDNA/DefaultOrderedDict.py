@@ -3,7 +3,11 @@ Source: http://stackoverflow.com/a/6190500/562769
 """
 from __future__ import print_function, division, absolute_import, \
     with_statement, generators, nested_scopes
-from collections import OrderedDict, Callable
+from collections import OrderedDict
+try:
+    from collections.abc import Callable
+except ImportError:  # Python 2.7
+    from collections import Callable
 
 
 class DefaultOrderedDict(OrderedDict):
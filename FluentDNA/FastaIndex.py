@@ -0,0 +1,333 @@
+"""Streaming access to FASTA files.  read_contigs() holds every sequence in RAM as a Python string, but
+calc_all_padding() and prepare_image() only need names and lengths.  scan_fasta() reads just those
+(plus where each sequence sits in the file) in one pass, and StreamedSequence reads the sequence
+back from disk a block at a time when it is actually drawn or written.
+The same entries are saved next to the FASTA as a samtools compatible .fai index (unless --no_fasta_index)
+so --contigs extraction and pluck_contig() can jump straight to the contigs they need."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import os
+from datetime import datetime
+
+import numpy as np
+from DNASkittleUtils import Contigs
+from DNASkittleUtils.Contigs import Contig
+
+
+class FastaIndexEntry(object):
+    """Location of one contig's sequence in a FASTA file, same fields as a samtools .fai line.
+    offset is the file position of the first base.  Every line but the last holds line_bases bases
+    and takes line_width bytes with its line ending.  line_bases is None when lines are irregular,
+    then the sequence can only be read as a whole from offset to end."""
+    def __init__(self, name, length, offset, line_bases, line_width, end=None):
+        self.name = name
+        self.length = length
+        self.offset = offset
+        self.line_bases = line_bases
+        self.line_width = line_width
+        self.end = end
+
+    @property
+    def regular(self):
+        return self.line_bases is not None
+
+    def __repr__(self):
+        return '< "%s" %i bp at %i>' % (self.name, self.length, self.offset)
+
+
+class ContigScanner(object):
+    """State machine for scan_fasta().  Lines are fed in numpy batches so only headers are handled in Python.
+    Matches DNASkittleUtils read_contigs(): blank lines are skipped, a header without any sequence is
+    dropped (unless it's the last one) and text before the first header belongs to a contig named ''."""
+    def __init__(self):
+        self.entries = []
+        self.start_contig('', 0)
+
+    def start_contig(self, name, offset):
+        self.name = name
+        self.offset = offset
+        self.length = 0
+        self.line_bases = None
+        self.line_width = None
+        self.regular = True
+        self.ended = False  # a short or blank line was seen, any more sequence makes it irregular
+
+    def header(self, name, line_start, next_line_start):
+        self.finish_contig(line_start, keep_empty=False)
+        self.start_contig(name, next_line_start)
+
+    def finish_contig(self, end, keep_empty):
+        if self.length or keep_empty:
+            regular = self.regular and self.line_bases is not None
+            self.entries.append(FastaIndexEntry(self.name, self.length, self.offset,
+                                                self.line_bases if regular else None,
+                                                self.line_width if regular else None, end))
+
+    def sequence_lines(self, bases, widths, first_line_start):
+        """bases and widths are arrays of bases and bytes (with line ending) of consecutive sequence lines"""
+        if not len(bases):
+            return
+        if self.length == 0:  # blank lines before the first bases only shift where the sequence starts
+            leading_blank = int(np.argmax(bases > 0)) if (bases > 0).any() else len(bases)
+            if leading_blank == len(bases):
+                self.offset = first_line_start + int(widths.sum())
+                return
+            self.offset = first_line_start + int(widths[:leading_blank].sum())
+            bases, widths = bases[leading_blank:], widths[leading_blank:]
+            self.line_bases, self.line_width = int(bases[0]), int(widths[0])
+        endings = widths - bases
+        has_bases = bases > 0
+        if self.ended and has_bases.any():
+            self.regular = False
+        if (bases > self.line_bases).any() or (endings[has_bases] != self.line_width - self.line_bases).any():
+            self.regular = False
+        short = np.flatnonzero(bases < self.line_bases)
+        if len(short):
+            if has_bases[short[0] + 1:].any():
+                self.regular = False
+            self.ended = True
+        self.length += int(bases.sum())
+
+
+def scan_fasta(input_file_path, chunk_size=16 * 1024 * 1024):
+    """First pass of streaming ingest: returns a FastaIndexEntry for every contig without keeping any sequence.
+    Raises UnicodeDecodeError on non-ASCII bytes, same as read_contigs() does for binary files."""
+    scanner = ContigScanner()
+    position = 0  # file offset of carry[0]
+    carry = b''
+    with open(input_file_path, 'rb') as fasta:
+        while True:
+            chunk = fasta.read(chunk_size)
+            data = carry + chunk
+            if not chunk:  # treat the end of the file like a final line ending
+                if data:
+                    data += b'\n'
+                else:
+                    break
+            array = np.frombuffer(data, dtype=np.uint8)
+            if (array >= 128).any():
+                bad = int(np.argmax(array >= 128))
+                raise UnicodeDecodeError('ascii', data[bad:bad + 1], 0, 1,
+                                         'non-ASCII byte at position %i' % (position + bad))
+            newlines = np.flatnonzero(array == ord('\n'))
+            if not len(newlines):
+                carry = data
+                continue
+            starts = np.concatenate([[0], newlines[:-1] + 1])
+            ends = newlines  # exclusive of the '\n'
+            content_ends = ends - (array[np.maximum(ends - 1, 0)] == ord('\r')) * (ends > starts)
+            bases = content_ends - starts
+            widths = newlines + 1 - starts
+            is_header = (bases > 0) & (array[np.minimum(starts, len(array) - 1)] == ord('>'))
+            previous = 0
+            for h in np.flatnonzero(is_header):
+                scanner.sequence_lines(bases[previous:h], widths[previous:h], position + int(starts[previous]))
+                name = data[starts[h] + 1:content_ends[h]].decode('ascii')
+                scanner.header(name, position + int(starts[h]), position + int(newlines[h]) + 1)
+                previous = h + 1
+            scanner.sequence_lines(bases[previous:], widths[previous:], position + int(starts[previous])
+                                   if previous < len(starts) else 0)
+            consumed = int(newlines[-1]) + 1
+            carry = data[consumed:]
+            position += consumed
+            if not chunk:
+                break
+    scanner.finish_contig(position, keep_empty=True)  # read_contigs() always returns the last contig
+    return scanner.entries
+
+
+block_cache = [None, None]  # (key, bytes) one block shared by all sequences keeps peak memory to one block
+
+
+class StreamedSequence(object):
+    """Read only, string-like view of one contig's sequence in a FASTA file.  Supports len(), indexing,
+    slicing and iteration, so code written for read_contigs() strings keeps working.  Sequential
+    reads are served from a cached block.  Files are reopened for every read, which keeps this safe to
+    use from forked worker processes.  Sequence is upper case, like read_contigs()."""
+    block_size = 1024 * 1024
+
+    def __init__(self, path, entry):
+        self.path = path
+        self.entry = entry
+
+    def __len__(self):
+        return self.entry.length
+
+    def file_position(self, index):
+        entry = self.entry
+        return entry.offset + (index // entry.line_bases) * entry.line_width + index % entry.line_bases
+
+    def read_bytes(self, start=0, stop=None):
+        """Upper case bytes of sequence[start:stop], read straight from the file"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return b''
+        if not self.entry.regular:  # without a fixed line width the whole contig has to be read
+            return self.cached(('whole', self.path, self.entry.offset), self.read_whole)[start:stop]
+        with open(self.path, 'rb') as fasta:
+            fasta.seek(self.file_position(start))
+            raw = fasta.read(self.file_position(stop - 1) + 1 - self.file_position(start))
+        return raw.replace(b'\n', b'').replace(b'\r', b'').upper()
+
+    def read_whole(self):
+        with open(self.path, 'rb') as fasta:
+            fasta.seek(self.entry.offset)
+            raw = fasta.read(self.entry.end - self.entry.offset)
+        return raw.replace(b'\n', b'').replace(b'\r', b'').upper()  # also drops blank lines
+
+    @staticmethod
+    def cached(key, read):
+        if block_cache[0] != key:
+            block_cache[0], block_cache[1] = None, None  # free the old block before reading the next
+            block_cache[1] = read()
+            block_cache[0] = key
+        return block_cache[1]
+
+    def read_cached(self, start, stop):
+        """Small reads that fit inside one aligned block come from the shared block cache"""
+        block = start // self.block_size
+        if stop > (block + 1) * self.block_size or not self.entry.regular:
+            return self.read_bytes(start, stop)
+        block_start = block * self.block_size
+        data = self.cached((self.path, self.entry.offset, block),
+                           lambda: self.read_bytes(block_start, block_start + self.block_size))
+        return data[start - block_start:stop - block_start]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.read_cached(start, stop).decode('ascii')[::step] if start < stop else ''
+            return self.read_cached(start, stop).decode('ascii') if start < stop else ''
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("sequence index out of range")
+        return self.read_cached(index, index + 1).decode('ascii')
+
+    def __iter__(self):
+        for start in range(0, len(self), self.block_size):
+            for character in self.read_cached(start, start + self.block_size).decode('ascii'):
+                yield character
+
+    def blocks(self, block_size):
+        """Yields (start, bytes) for consecutive blocks of the sequence"""
+        for start in range(0, len(self), block_size):
+            yield start, self.read_bytes(start, start + block_size)
+
+    def __str__(self):
+        return self.read_bytes().decode('ascii')
+
+    def __repr__(self):
+        return '<StreamedSequence %s %i bp>' % (self.entry.name, len(self))
+
+
+def streamed_contigs(input_file_path):
+    """Drop in replacement for read_contigs() whose Contig.seq are StreamedSequences"""
+    return [Contig(entry.name, StreamedSequence(input_file_path, entry)) for entry in scan_fasta(input_file_path)]
+
+
+def fai_path(fasta_path):
+    return fasta_path + '.fai'
+
+
+def write_fai(index_path, entries):
+    """samtools faidx format: name, length, offset, line bases, line bytes.  Name is the first word of the header."""
+    with open(index_path, 'w') as fai:
+        for entry in entries:
+            fai.write('%s\t%i\t%i\t%i\t%i\n' % (entry.name.split()[0], entry.length, entry.offset,
+                                                 entry.line_bases, entry.line_width))
+
+
+def read_fai(index_path):
+    entries = []
+    with open(index_path) as fai:
+        for line in fai:
+            columns = line.rstrip('\r\n').split('\t')
+            if len(columns) >= 5:
+                name, length, offset, line_bases, line_width = columns[:5]
+                entries.append(FastaIndexEntry(name, int(length), int(offset), int(line_bases), int(line_width)))
+    return entries
+
+
+save_indexes = True  # turned off by --no_fasta_index, otherwise the .fai is saved wherever the FASTA's folder is writable
+
+
+def load_fasta_index(fasta_path, cache=None):
+    """Reads FASTA.fai if it is newer than the FASTA.  Otherwise the FASTA is scanned once and, when
+    save_indexes is on and the folder is writable, the index is saved next to it for next time.
+    Files with irregular lines, unnamed or duplicate contigs can't be described by a .fai,
+    their scan is only used for this run."""
+    cache = save_indexes if cache is None else cache
+    index_path = fai_path(fasta_path)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(fasta_path):
+        try:
+            return read_fai(index_path)
+        except (IOError, ValueError) as e:
+            print("Ignoring unreadable index", index_path, e)
+    start_time = datetime.now()
+    entries = scan_fasta(fasta_path)
+    names = [entry.name.split()[0] if entry.name.split() else '' for entry in entries]
+    writable = os.access(os.path.dirname(os.path.abspath(fasta_path)), os.W_OK)
+    if cache and writable and all(entry.regular for entry in entries) and all(names) \
+            and len(set(names)) == len(names):
+        try:
+            write_fai(index_path, entries)
+            print("Indexed %i contigs in" % len(entries), datetime.now() - start_time, index_path)
+        except (IOError, OSError) as e:
+            print("Could not save index", index_path, e)
+    return entries
+
+
+def read_header(fasta_path, entry):
+    """The full header line of an entry (without '>').  A .fai only keeps the first word but titles use the
+    whole header, so it's read back from the bytes right before the sequence."""
+    with open(fasta_path, 'rb') as fasta:
+        size = 1024
+        while True:
+            start = max(0, entry.offset - size)
+            fasta.seek(start)
+            text = fasta.read(entry.offset - start).rstrip(b'\r\n')
+            line_start = text.rfind(b'\n')
+            if line_start >= 0 or start == 0:
+                line = text[line_start + 1:].rstrip(b'\r')
+                return line[1:].decode('ascii') if line.startswith(b'>') else ''
+            size *= 16
+
+
+def indexed_contigs(fasta_path, extract_contigs, streamed=False):
+    """Contigs named in extract_contigs, in that order, read by byte offset through the .fai index.
+    Names match the first word of the header like filter_by_contigs().  Returns None when the file
+    can't be indexed, leaving the caller to parse it the normal way."""
+    try:
+        entries = load_fasta_index(fasta_path)
+    except UnicodeDecodeError:
+        return None
+    by_name = {entry.name.split()[0]: entry for entry in entries if entry.name.split() and entry.length}
+    contigs = []
+    for name in extract_contigs:
+        if name in by_name:
+            seq = StreamedSequence(fasta_path, by_name[name])
+            contigs.append(Contig(read_header(fasta_path, by_name[name]), seq if streamed else str(seq)))
+    return contigs
+
+
+def pluck_contig(chromosome_name, genome_source, verbose=True):
+    """Same as DNASkittleUtils pluck_contig(), a case insensitive match of the whole header, but only that
+    contig is read, by offset from the .fai index."""
+    wanted = chromosome_name.upper()
+    try:
+        entries = load_fasta_index(genome_source) if wanted.split() else None
+    except UnicodeDecodeError:
+        entries = None
+    if entries is None:
+        return Contigs.pluck_contig(chromosome_name, genome_source, verbose)
+    for entry in entries:
+        if entry.name.split() and entry.name.split()[0].upper() == wanted.split()[0]:
+            header = read_header(genome_source, entry)
+            if header.rstrip().upper() == wanted:
+                if verbose:
+                    print("Found", '>' + header)
+                return str(StreamedSequence(genome_source, entry))
+    raise IOError("Contig not found." + '>' + chromosome_name + "   inside " + genome_source)
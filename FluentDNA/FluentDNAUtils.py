@@ -8,8 +8,8 @@ import textwrap
 from collections import defaultdict
 from datetime import datetime
 
-from DNASkittleUtils.Contigs import read_contigs
-from PIL import ImageDraw
+# Only the standard library up here: fluentdna imports this module before it knows whether there's any work
+# to do (--version), so PIL, numpy and DNASkittleUtils are imported by the functions that use them.
 
 
 class keydefaultdict(defaultdict):
@@ -22,10 +22,19 @@ class keydefaultdict(defaultdict):
             return ret
 
 
+font_descenders = {}  # font: descender, measured once per font
+
+
+def font_descender(font):
+    if font not in font_descenders:
+        font_descenders[font] = font.getsize('y')[1] - font.getsize('A')[1]
+    return font_descenders[font]
+
+
 def multi_line_height(font, multi_line_title, txt):
+    from PIL import ImageDraw
     sum_line_spacing = ImageDraw.Draw(txt).multiline_textsize(multi_line_title, font)[1]
-    descender = font.getsize('y')[1] - font.getsize('A')[1]
-    return sum_line_spacing + descender
+    return sum_line_spacing + font_descender(font)
 
 
 def pretty_contig_name(contig_name, title_width, title_lines):
@@ -62,22 +71,37 @@ def filter_by_contigs(unfiltered, extract_contigs):
                   extract_contigs, file=sys.stderr)
     return unfiltered
 
+
+def read_and_filter_contigs(input_file_path, extract_contigs=None, streamed=False):
+    """When only some contigs are wanted they are read by offset from the .fai index instead of parsing
+    the whole file.  Falls back to read_contigs() and filter_by_contigs() if nothing could be indexed."""
+    from DNASkittleUtils.Contigs import read_contigs
+    from FluentDNA.FastaIndex import indexed_contigs, streamed_contigs
+    contigs = None
+    if extract_contigs:
+        contigs = indexed_contigs(input_file_path, extract_contigs, streamed)
+    if not contigs:
+        contigs = streamed_contigs(input_file_path) if streamed else read_contigs(input_file_path)
+    return filter_by_contigs(contigs, extract_contigs)
+
+
 def read_contigs_to_dict(input_file_path, extract_contigs=None):
     print("Reading contigs... ", input_file_path)
     start_time = datetime.now()
-    contig_list = read_contigs(input_file_path)
-    contig_list = filter_by_contigs(contig_list, extract_contigs)
+    contig_list = read_and_filter_contigs(input_file_path, extract_contigs)
     contig_dict = {c.name.lower(): c.seq for c in contig_list}  # capitalization!!!!
     print("Read %i FASTA Contigs in:" % len(contig_dict), datetime.now() - start_time)
     return contig_dict
 
 
-def create_deepzoom_stack(input_image, output_dzi):
+def create_deepzoom_stack(input_image, output_dzi, workers=1, archive=False):
+    """archive=True packs the tiles into one file next to output_dzi, see TileArchive"""
     import FluentDNA.deepzoom
     creator = FluentDNA.deepzoom.ImageCreator(tile_size=256,
                                     tile_overlap=1,
                                     tile_format="png",
-                                    resize_filter="antialias")# cubic bilinear bicubic nearest antialias
+                                    workers=workers,
+                                    archive=archive)
     creator.create(input_image, output_dzi)
 
 
@@ -1,12 +1,14 @@
 import traceback
 
 import sys
+import numpy as np
 from PIL import Image, ImageFont
 
 from FluentDNA.Annotations import GFFAnnotation, find_universal_prefix, GFF3Record, parseGFF
 from FluentDNA.Span import Span
 from FluentDNA.TileLayout import TileLayout
 from FluentDNA.FluentDNAUtils import linspace, copy_to_sources
+from FluentDNA.TitleCache import title_cache
 
 
 def blend_pixel(markup_canvas, pt, c, overwrite=False):
@@ -20,7 +22,8 @@ def blend_pixel(markup_canvas, pt, c, overwrite=False):
 def annotation_points(entry, renderer, start_offset):
     # important to include title and reset padding in coordinate frame
     # TODO use unsigned shorts (max 65535) for memory
-    annotation_points = tuple(renderer.position_on_screen(i + start_offset) for i in range(entry.start, entry.end))
+    xs, ys = renderer.positions_on_screen(np.arange(entry.start, entry.end, dtype=np.int64) + start_offset)
+    annotation_points = tuple(zip(xs.tolist(), ys.tolist()))
 
     return annotation_points
 
@@ -224,53 +227,54 @@ class HighlightedAnnotation(TileLayout):
         self.fonts = {9: ImageFont.load_default()}  # clear font cache, this may be a different font
         last_unsuppressed_progress = 0
         suppression_size = 900 if use_suppression else 0
-        for region in annotated_regions:
-            if last_unsuppressed_progress \
-                    and abs(region.start - last_unsuppressed_progress) < suppression_size:
-                continue #skip
-            else:
-                last_unsuppressed_progress = region.start
-            try:
-                if not region.points:
-                    print(region.name(), "has empty coordinates.")
-                    break
-                # pts = region.points
-                # left, right = min(pts, key=lambda p: p[0])[0], max(pts, key=lambda p: p[0])[0]
-                # top, bottom = min(pts, key=lambda p: p[1])[1], max(pts, key=lambda p: p[1])[1]
-
-                width, height, left, right, top, bottom = \
-                    self.levels.handle_multi_column_annotations(region.start+start_offset,
-                                                    region.end+start_offset)
-                vertical_label = height > width and (force_orientation != 'horizontal')
-                if force_orientation == 'vertical':
-                    vertical_label = True
-                upper_left = [left, top]
-
-                # Title orientation and size
-                if vertical_label:
-                    width, height = height, width  # swap
-
-                font_size_by_width  = max(9, int((min(3000, width) * 0.09)))  # found eq with two reference points
-                font_size_by_height = max(9, int((min(3000, height * 18) * 0.09)))
-                if height <= 244: # 398580bp = 1900 width, 243 height
-                    font_size_by_height = min(font_size_by_height, int(1900 * .09))  # 171 max font size in one fiber
-                font_size = min(font_size_by_width, font_size_by_height)
-                if height < 11:
-                    height = 11  # don't make the area so small it clips the text
-                    upper_left[1] -= 2
-                font = self.get_font(font_size)
-                current_color = tuple(label_color) # must be tuple
-                if font_size >= 14:
-                    alpha = 235 / 255
-                    if font_size > 30:
-                        alpha = 200 / 255
-                    current_color = (label_color[0], label_color[1], label_color[2], int(current_color[3] * alpha))
-
-                self.draw_label(region.name(universal_prefix), width, height, font, 18,
-                                upper_left, vertical_label, region.strand, markup_image,
-                                label_color=current_color)
-            except ValueError as e:
-                print('Error while drawing label %s' % region.name(), e)
+        with title_cache.batched(self.workers):  # labels are rasterized in parallel with --workers
+            for region in annotated_regions:
+                if last_unsuppressed_progress \
+                        and abs(region.start - last_unsuppressed_progress) < suppression_size:
+                    continue #skip
+                else:
+                    last_unsuppressed_progress = region.start
+                try:
+                    if not region.points:
+                        print(region.name(), "has empty coordinates.")
+                        break
+                    # pts = region.points
+                    # left, right = min(pts, key=lambda p: p[0])[0], max(pts, key=lambda p: p[0])[0]
+                    # top, bottom = min(pts, key=lambda p: p[1])[1], max(pts, key=lambda p: p[1])[1]
+
+                    width, height, left, right, top, bottom = \
+                        self.levels.handle_multi_column_annotations(region.start+start_offset,
+                                                        region.end+start_offset)
+                    vertical_label = height > width and (force_orientation != 'horizontal')
+                    if force_orientation == 'vertical':
+                        vertical_label = True
+                    upper_left = [left, top]
+
+                    # Title orientation and size
+                    if vertical_label:
+                        width, height = height, width  # swap
+
+                    font_size_by_width  = max(9, int((min(3000, width) * 0.09)))  # found eq with two reference points
+                    font_size_by_height = max(9, int((min(3000, height * 18) * 0.09)))
+                    if height <= 244: # 398580bp = 1900 width, 243 height
+                        font_size_by_height = min(font_size_by_height, int(1900 * .09))  # 171 max font size in one fiber
+                    font_size = min(font_size_by_width, font_size_by_height)
+                    if height < 11:
+                        height = 11  # don't make the area so small it clips the text
+                        upper_left[1] -= 2
+                    font = self.get_font(font_size)
+                    current_color = tuple(label_color) # must be tuple
+                    if font_size >= 14:
+                        alpha = 235 / 255
+                        if font_size > 30:
+                            alpha = 200 / 255
+                        current_color = (label_color[0], label_color[1], label_color[2], int(current_color[3] * alpha))
+
+                    self.draw_label(region.name(universal_prefix), width, height, font, 18,
+                                    upper_left, vertical_label, region.strand, markup_image,
+                                    label_color=current_color)
+                except ValueError as e:
+                    print('Error while drawing label %s' % region.name(), e)
 
     def draw_label(self, contig_name, width, height, font, title_width, upper_left, vertical_label, strand,
                    canvas, label_color, horizontal_centering=False, center_vertical=False, chop_text=True):
@@ -121,6 +121,33 @@ class IdeogramCoordinateFrame(LayoutFrame):
     def relative_position(self, progress):
         return self.point_mapping[progress]
 
+    def point_mapping_array(self):
+        """(n, 2) array copy of self.point_mapping, rebuilt only when the mapping has grown."""
+        if getattr(self, '_mapping_array', None) is None or len(self._mapping_array) != len(self.point_mapping):
+            self._mapping_array = np.array(self.point_mapping, dtype=np.int64).reshape((-1, 2))
+        return self._mapping_array
+
+    def relative_positions(self, progress):
+        pts = self.point_mapping_array()[np.asarray(progress, dtype=np.int64)]
+        return pts[..., 0], pts[..., 1]
+
+    def positions_on_screen(self, progress):
+        xs, ys = self.relative_positions(progress)
+        return xs + self.origin[0], ys + self.origin[1]
+
+    def positions_to_progress(self, xs, ys):
+        """The fractal has no closed form inverse, so this uses a lookup grid of the whole mapping."""
+        mapping = self.point_mapping_array()
+        grid = np.full((mapping[:, 1].max() + 1, mapping[:, 0].max() + 1), -1, dtype=np.int64)
+        grid[mapping[:, 1], mapping[:, 0]] = np.arange(len(mapping))
+        xs = np.asarray(xs, dtype=np.int64) - self.origin[0]
+        ys = np.asarray(ys, dtype=np.int64) - self.origin[1]
+        inside = (xs >= 0) & (ys >= 0) & (xs < grid.shape[1]) & (ys < grid.shape[0])
+        progress = np.full(np.broadcast(xs, ys).shape, -1, dtype=np.int64)
+        progress[inside] = grid[np.broadcast_to(ys, progress.shape)[inside],
+                                np.broadcast_to(xs, progress.shape)[inside]]
+        return progress
+
 
     def handle_multi_column_annotations(self, start, stop):
         """In 2D fractal layout, this method is much simpler since there's no columns per se.
@@ -193,19 +220,27 @@ class Ideogram(HighlightedAnnotation):
         self.each_layout = [coordinates]  # overwrite anything else
         self.i_layout = 0
         self.layout_algorithm = "1"  # non-raster peano space filling curve
+        self.draws_by_pixel = True
 
 
 
 
     def process_file(self, input_file_path, output_folder, output_file_name,
                      no_webpage=False, extract_contigs=None):
+        extract_contigs = self.first_contig(input_file_path, extract_contigs)
+        return super(Ideogram, self).process_file(input_file_path, output_folder, output_file_name,
+                                           no_webpage=no_webpage, extract_contigs=extract_contigs)
+
+    def render_image(self, source, extract_contigs=None):
+        return super(Ideogram, self).render_image(source, self.first_contig(source, extract_contigs))
+
+    def first_contig(self, source, extract_contigs):
+        """Ideogram only draws one contig, the first one unless extract_contigs says otherwise"""
         if extract_contigs is None:
-            contigs = read_contigs(input_file_path)
+            contigs = read_contigs(source) if isinstance(source, str) else source
             extract_contigs = [contigs[0].name.split()[0]]
             print("Extracting ", extract_contigs)
-
-        return super(Ideogram, self).process_file(input_file_path, output_folder, output_file_name,
-                                           no_webpage=no_webpage, extract_contigs=extract_contigs)
+        return extract_contigs
 
     # def activate_high_contrast_colors(self):
     #     # Terrain Colors
@@ -223,6 +258,8 @@ class Ideogram(HighlightedAnnotation):
         self.levels.build_coordinate_mapping(len(contig.seq))
         seq_iter = iter(contig.seq)
         for pts in range(len(contig.seq)):
+            if verbose and pts % 100000 == 0:
+                self.progress.update(pts / len(contig.seq), contig.name)
             try:
                 x, y = self.levels.position_on_screen(pts)
                 self.draw_pixel(next(seq_iter), x, y)
@@ -259,7 +296,7 @@ class Ideogram(HighlightedAnnotation):
             self.levels.y_radices[-1] += 1
         return width, height
 
-    def find_layout_height_by_chromosomes(self):
+    def find_layout_height_by_chromosomes(self, lengths=None):
         """Override to do nothing."""
         return self.each_layout[self.i_layout]
 
@@ -1,6 +1,6 @@
 import sys
-from PIL import Image, ImageDraw
-from FluentDNA.FluentDNAUtils import multi_line_height
+import numpy as np
+from FluentDNA.TitleCache import title_cache, text_bitmap, text_size
 
 
 class LayoutLevel(object):
@@ -73,6 +73,54 @@ class LayoutFrame(list):
         return xy[0] + self.origin[0], xy[1] + self.origin[1]
 
 
+    def relative_positions(self, progress):
+        """Batch version of relative_position() for a numpy array of progress offsets.
+        Each level contributes thickness * ((progress // chunk_size) % modulo) to x or y,
+        so the whole array is mapped with one integer divmod per level instead of a Python loop.
+        :return: x and y int64 arrays the same shape as progress"""
+        progress = np.asarray(progress, dtype=np.int64)
+        xy = [np.zeros(progress.shape, dtype=np.int64), np.zeros(progress.shape, dtype=np.int64)]
+        for i, level in enumerate(self.levels):
+            coordinate_in_chunk = (progress // int(level.chunk_size)) % int(level.modulo)
+            xy[i % 2] += int(level.thickness) * coordinate_in_chunk
+        return xy[0], xy[1]
+
+
+    def positions_on_screen(self, progress):
+        """Batch version of position_on_screen().  Shared fast path for drawing nucleotides and annotations."""
+        xs, ys = self.relative_positions(progress)
+        return xs + self.origin[0], ys + self.origin[1]
+
+
+    def positions_to_progress(self, xs, ys):
+        """Inverse of positions_on_screen(): maps screen coordinates back to progress offsets.
+        Levels on each axis are peeled off from the largest thickness down.  Pixels that land in
+        padding or outside the layout have no nucleotide and are returned as -1."""
+        relative = [np.asarray(xs, dtype=np.int64) - self.origin[0],
+                    np.asarray(ys, dtype=np.int64) - self.origin[1]]
+        relative = [np.broadcast_to(r, np.broadcast(*relative).shape).copy() for r in relative]
+        progress = np.zeros(relative[0].shape, dtype=np.int64)
+        valid = (relative[0] >= 0) & (relative[1] >= 0)
+        for i in reversed(range(len(self.levels))):
+            level = self.levels[i]
+            remaining = relative[i % 2]
+            coordinate_in_chunk = remaining // int(level.thickness)
+            valid &= coordinate_in_chunk < int(level.modulo)
+            remaining -= coordinate_in_chunk * int(level.thickness)
+            progress += coordinate_in_chunk * int(level.chunk_size)
+        valid &= (relative[0] == 0) & (relative[1] == 0)  # leftovers are padding inside the lowest level
+        progress[~valid] = -1
+        return progress
+
+
+    def column_stencil(self):
+        """ColumnStencil of one full column in this frame. Cached until the column shape changes."""
+        stencil = getattr(self, '_column_stencil', None)
+        if stencil is None or stencil.key != ColumnStencil.shape_key(self):
+            stencil = self._column_stencil = ColumnStencil(self)
+        return stencil
+
+
     def handle_multi_column_annotations(coord_frame, start, stop):
         interval = abs(stop - start)
         upper_left = coord_frame.position_on_screen(start + 2)
@@ -105,30 +153,105 @@ class LayoutFrame(list):
         """
         upper_left = list(upper_left)  # to make it mutable
         shortened = contig_name[-title_width:]  # max length 18.  Last characters are most unique
-        txt = Image.new('RGBA', (width, height))#, color=(0,0,0,50))
-        txt_canvas = ImageDraw.Draw(txt)
-        text_width = txt_canvas.textsize(shortened, font)[0]
-        if not chop_text and text_width > width:
-            txt = Image.new('RGBA', (text_width, height))  # TODO performance around txt_canvas
-            txt_canvas = ImageDraw.Draw(txt)
-        if center_vertical or vertical_label:  # Large labels are centered in the column to look nice,
-            # rotation indicates strand in big text
-            vertically_centered = (height // 2) - multi_line_height(font, shortened, txt)//2
-        else:  # Place label at the beginning of gene based on strand
-            vertically_centered = height - multi_line_height(font, shortened, txt)  # bottom
-            if strand == "+":
-                vertically_centered = 0  # top of the box
-        txt_canvas.multiline_text((0, max(0, vertically_centered)), shortened, font=font,
-                                           fill=label_color)
+        text_width, text_height = text_size(font, shortened)
         if vertical_label:
-            rotation_direction = 90 if strand == '-' else -90
-            txt = txt.rotate(rotation_direction, expand=True)
             upper_left[1] += -4 if strand == '-' else 4
         if horizontal_centering:
             margin = width - text_width
             upper_left[0] += margin // 2
-        canvas.paste(txt, (upper_left[0], upper_left[1]), txt)
 
+        def render():
+            box_width = width
+            if not chop_text and text_width > width:
+                box_width = text_width
+            if center_vertical or vertical_label:  # Large labels are centered in the column to look nice,
+                # rotation indicates strand in big text
+                vertically_centered = (height // 2) - text_height // 2
+            else:  # Place label at the beginning of gene based on strand
+                vertically_centered = height - text_height  # bottom
+                if strand == "+":
+                    vertically_centered = 0  # top of the box
+            rotation = 0
+            if vertical_label:
+                rotation = 90 if strand == '-' else -90
+            return text_bitmap(shortened, font, text_width, box_width, height, max(0, vertically_centered),
+                               label_color, rotation)
+        title_cache.paste(canvas, ('label', shortened, font, width, height, vertical_label, strand, center_vertical,
+                                   chop_text, label_color), render, upper_left)
+
+
+
+class ColumnStencil(object):
+    """Screen offsets (dx, dy) of every nucleotide in one full column, relative to the column's first
+    nucleotide.  A column is levels[0].modulo * levels[1].modulo nucleotides (100 kbp by default)
+    and always has the same shape, so it is computed once per LayoutFrame and reused for every column.
+    apply() draws any number of columns with one fancy indexing assignment per batch, instead of
+    calling position_on_screen() for every line.  This is the numpy version of get_packed_coordinates()."""
+    def __init__(self, frame):
+        self.key = self.shape_key(frame)
+        self.size = int(frame[0].modulo * frame[1].modulo)
+        self.dx, self.dy = frame.relative_positions(np.arange(self.size))
+        self.width, self.height = int(self.dx.max()) + 1, int(self.dy.max()) + 1
+        self.flat_offsets_by_row = {}
+
+    @staticmethod
+    def shape_key(frame):
+        return tuple((int(level.modulo), int(level.thickness)) for level in frame[:2])
+
+    def flat_offsets(self, row_length):
+        """Offsets of the stencil in a flattened canvas with row_length pixels per row"""
+        if row_length not in self.flat_offsets_by_row:
+            self.flat_offsets_by_row[row_length] = self.dy * row_length + self.dx
+        return self.flat_offsets_by_row[row_length]
+
+    def apply(self, canvas, lookup, codes, starts, xs, ys, batch_pixels=1000000):
+        """Draws codes[starts[i]:starts[i] + size] as a full column anchored at (xs[i], ys[i]).
+        Callers are responsible for checking that every column fits on the canvas.
+        canvas is an ndarray or an ArrayCanvas.  Contiguous arrays are written through a one element
+        per pixel view, which makes the scatter as fast as a block copy."""
+        array = getattr(canvas, 'array', canvas)
+        flat = pixel_view(array)
+        colors = pixel_view(lookup) if flat is not None else lookup
+        per_batch = max(1, batch_pixels // self.size)
+        offsets = np.arange(self.size, dtype=np.int64)
+        for batch in range(0, len(starts), per_batch):
+            sl = slice(batch, batch + per_batch)
+            column_codes = codes[(np.asarray(starts[sl])[:, None] + offsets).ravel()]
+            if flat is not None:
+                anchors = np.asarray(ys[sl], dtype=np.int64) * array.shape[1] + xs[sl]
+                flat[(anchors[:, None] + self.flat_offsets(array.shape[1])).ravel()] = colors[column_codes]
+            else:  # canvases without one big array still take scattered index writes
+                canvas[(np.asarray(ys[sl])[:, None] + self.dy).ravel(),
+                       (np.asarray(xs[sl])[:, None] + self.dx).ravel()] = lookup[column_codes]
+
+
+class PaddingPlan(object):
+    """Padding for every contig in a file as int64 arrays, from TileLayout.plan_padding().
+    Cumulative positions are derived with numpy instead of being summed contig by contig:
+    xy_seq_start is the progress where each sequence begins on screen and nuc_title_start / nuc_seq_start
+    point into the sequence text sent to the browser, same as the attributes calc_all_padding() sets."""
+    def __init__(self, contigs, lengths, name_lengths, reset_padding, title_padding, tail_padding):
+        self.contigs = contigs  # the list this plan was made for, see TileLayout.contig_struct()
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.reset_padding = np.asarray(reset_padding, dtype=np.int64)
+        self.title_padding = np.asarray(title_padding, dtype=np.int64)
+        self.tail_padding = np.asarray(tail_padding, dtype=np.int64)
+        footprint = self.reset_padding + self.title_padding + self.lengths + self.tail_padding
+        self.xy_seq_start = np.cumsum(footprint) - footprint + self.reset_padding + self.title_padding
+        text = np.asarray(name_lengths, dtype=np.int64) + self.lengths
+        self.nuc_title_start = np.cumsum(text) - text
+        self.nuc_seq_start = self.nuc_title_start + name_lengths
+        self.total_progress = int(footprint.sum())
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+def pixel_view(array):
+    """Views a contiguous (..., channels) uint8 array as one flat element per pixel, or None."""
+    if not isinstance(array, np.ndarray) or array.ndim < 2 or not array.flags.c_contiguous:
+        return None
+    return array.view(np.dtype((np.void, array.shape[-1] * array.itemsize))).reshape(-1)
 
 
 def level_layout_factory(modulos, padding, origin):
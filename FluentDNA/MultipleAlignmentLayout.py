@@ -96,10 +96,10 @@ class MultipleAlignmentLayout(TileLayout):
     def process_all_alignments(self, input_fasta_folder, output_folder, output_file_name):
         start_time = datetime.now()
         make_output_directory(output_folder)
-        self.preview_all_files(input_fasta_folder)
-        self.calculate_mixed_layout()
-        print("Tallied all contigs :", datetime.now() - start_time)
-        print("Initialized Image:", datetime.now() - start_time, "\n")
+        with self.phase('read'):
+            self.preview_all_files(input_fasta_folder)
+        with self.phase('padding'):
+            self.calculate_mixed_layout()
         #TODO: sort all layouts with corresponding sequence?
 
         for file_no, single_MSA in enumerate(self.fasta_sources):
@@ -107,18 +107,20 @@ class MultipleAlignmentLayout(TileLayout):
             self.contigs = self.all_contents[single_MSA]
             # self.read_contigs_and_calc_padding(single_MSA, None)
             try:  # These try catch statements ensure we get at least some output.  These jobs can take hours
-                self.draw_nucleotides()
+                with self.phase('nucleotides'):
+                    self.draw_nucleotides()
                 if self.use_titles and not self.single_file:
-                    self.draw_titles()
+                    with self.phase('titles'):
+                        self.draw_titles()
             except Exception as e:
                 print('Encountered exception while drawing nucleotides:', '\n')
                 traceback.print_exc()
             input_path = os.path.join(input_fasta_folder, single_MSA)
-            self.output_fasta(output_folder, input_path, False, None, False,
-                              append_fasta_sources=False, create_source_download=False)
-        print("\nDrew Nucleotides:", datetime.now() - start_time)
-        self.output_image(output_folder, output_file_name, False)
-        print("Output Image in:", datetime.now() - start_time)
+            with self.phase('fasta'):
+                self.output_fasta(output_folder, input_path, False, None, False,
+                                  append_fasta_sources=False, create_source_download=False)
+        with self.phase('png'):
+            self.output_image(output_folder, output_file_name, False)
         target_folder = os.path.join(output_folder, 'sources', os.path.basename(input_fasta_folder))
         if not os.path.exists(target_folder):
             print("Copying entire sources directory:", input_fasta_folder)
@@ -162,9 +164,7 @@ class MultipleAlignmentLayout(TileLayout):
         if not width or not height:
             width, height = self.max_dimensions(image_length)
         print("Image dimensions are", width, "x", height, "pixels")
-        self.image = Image.new(self.pil_mode, (width, height), hex_to_rgb('#FFFFFF'))#ui_grey)
-        self.draw = ImageDraw.Draw(self.image)
-        self.pixels = self.image.load()
+        self.set_canvas(self.new_canvas(width, height))
 
     def guess_image_dimensions(self):
         margin = self.border_width*2
@@ -5,11 +5,13 @@ import os
 import traceback
 from datetime import datetime
 
+import numpy as np
 from PIL import ImageFont, Image
 
 from DNASkittleUtils.CommandLineUtils import just_the_name
 from FluentDNA.TileLayout import TileLayout, hex_to_rgb
 from FluentDNA.Layouts import level_layout_factory
+from FluentDNA.Progress import Cancelled
 
 
 class ParallelLayout(TileLayout):
@@ -52,13 +54,27 @@ class ParallelLayout(TileLayout):
 
     def process_file(self, output_folder, output_file_name, fasta_files,
                      no_webpage=False, extract_contigs=None):
-        assert len(fasta_files) == self.n_genomes, "List of Genome files must be same length as n_genomes"
         start_time = datetime.now()
+        try:
+            self.render_image(fasta_files, extract_contigs, output_folder)
+        except Cancelled:
+            self.save_cancelled_image(output_folder, output_file_name, no_webpage)
+            raise
+        # self.draw_the_viz_title(fasta_files)  # Needs padding in origins to work
+        # self.generate_html(output_folder, output_file_name) # done in fluentdna.py
+        with self.phase('png'):
+            self.output_image(output_folder, output_file_name, no_webpage)
+        return start_time
+
+    def render_image(self, fasta_files, extract_contigs=None, output_folder=None):
+        """Draws every genome into self.image.  Each genome's contigs are replaced by the next one's, so
+        process_file() passes output_folder to save each fasta right after it is drawn."""
+        assert len(fasta_files) == self.n_genomes, "List of Genome files must be same length as n_genomes"
         self.image_length = self.read_contigs_and_calc_padding(fasta_files[0], extract_contigs)
-        self.prepare_image(self.image_length)
-        if self.use_border_boxes:
-            self.draw_border_boxes(fasta_files)
-        print("Initialized Image:", datetime.now() - start_time)
+        with self.phase('image allocation'):
+            self.prepare_image(self.image_length)
+            if self.use_border_boxes:
+                self.draw_border_boxes(fasta_files)
 
         try:
             # Do inner work for each file
@@ -66,25 +82,31 @@ class ParallelLayout(TileLayout):
                 self.changes_per_genome()
                 if index != 0:
                     self.read_contigs_and_calc_padding(filename, extract_contigs)
-                self.draw_nucleotides()
+                with self.phase('nucleotides'):
+                    self.draw_nucleotides()
                 if index == self.n_genomes -1: #last one
-                    self.draw_titles()
+                    with self.phase('titles'):
+                        self.draw_titles()
                 self.genome_processed += 1
-                print("Drew File:", filename, datetime.now() - start_time)
-                self.output_fasta(output_folder, filename, False, extract_contigs, self.sort_contigs)
+                self.progress.message("Drew File: %s" % (filename if isinstance(filename, str) else
+                                                         "genome %i" % (index + 1)))
+                if output_folder is not None:
+                    with self.phase('fasta'):
+                        self.output_fasta(output_folder, filename, False, extract_contigs, self.sort_contigs)
+        except Cancelled:
+            raise
         except Exception as e:
             print('Encountered exception while drawing nucleotides:', '\n')
             traceback.print_exc()
         try:
-            self.draw_extras()
+            with self.phase('extras'):
+                self.draw_extras()
+        except Cancelled:
+            raise
         except BaseException as e:
             print('Encountered exception while drawing titles:', '\n')
             traceback.print_exc()
-        # self.draw_the_viz_title(fasta_files)  # Needs padding in origins to work
-        # self.generate_html(output_folder, output_file_name) # done in fluentdna.py
-        self.output_image(output_folder, output_file_name, no_webpage)
-        print("Output Image in:", datetime.now() - start_time)
-        return start_time
+        return self.image
 
     def changes_per_genome(self):
         self.i_layout = self.genome_processed
@@ -159,26 +181,11 @@ class ParallelLayout(TileLayout):
             left_start += font.getsize(title + '      ')[0]
 
 
-    def calc_padding(self, total_progress, next_segment_length):
+    def limit_title_padding(self, title_padding):
         """Parallel Layouts have a special title which describes the first (main) alignment.
         So padding for their title does not need to be included."""
-        # Get original values and level
-        reset_padding, title_padding, tail = super(ParallelLayout, self).calc_padding(total_progress,
-                                                                                      next_segment_length)
         # no larger than 1 full column or text will overlap
-        if title_padding >= self.levels[2].chunk_size:
-            title_padding = self.levels[2].chunk_size
-        # Remove first title
-        # if total_progress == 0:
-        #     # tail += title_padding  #commenting this out could cause problems with multiple contigs
-        #     title_padding = 0
-        #     if len(self.contigs) == 1:
-        #         tail = 0  # no need for tail
-        #     i = min([i for i in range(len(self.levels)) if next_segment_length + 2600 < self.levels[i].chunk_size])
-        #     total_padding = total_progress + title_padding + reset_padding + next_segment_length
-        #     tail = self.levels[i - 1].chunk_size - total_padding % self.levels[i - 1].chunk_size - 1
-
-        return reset_padding, title_padding, tail
+        return np.minimum(title_padding, self.levels[2].chunk_size)
 
 
     def draw_title(self, total_progress, contig):
@@ -0,0 +1,132 @@
+"""Checks a render against the machine before the canvas is allocated.  TileLayout.new_canvas() makes a
+Preflight from the canvas size, prints it, and with render_mode 'auto' uses it to pick how the canvas is stored:
+'memory' when the peak of the whole run, see memory_needed(), fits comfortably in available RAM, 'memmap' when
+the canvas does (the OS pages it and deep zoom reads it without decoding the PNG again) and 'tiled' otherwise.
+A job that won't fit on disk gets a warning up front instead of dying hours later.  With --dry_run the
+estimate is all that happens.
+Disk sizes and run time are rough: rates measured on dense random sequence with one core by
+benchmarks/run_benchmarks.py.  Mostly white images compress and run several times better."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import os
+
+import psutil
+
+png_bytes_per_pixel = 0.45  # the full size PNG in sources/
+tile_bytes_per_pixel = 1.3  # every level of GeneratedImages, per pixel of the full size image
+seconds_per_megapixel = {'nucleotides': 0.13, 'png': 0.25, 'deep zoom': 0.75}
+deep_zoom_rows = 5 * 256  # full width RGBA rows deep zoom holds while it streams the pyramid, measured
+
+
+class DryRun(Exception):
+    """Raised by new_canvas() with --dry_run once the estimate is printed, nothing has been allocated"""
+
+
+def existing_parent(directory):
+    directory = os.path.abspath(directory or os.getcwd())
+    while not os.path.exists(directory) and os.path.dirname(directory) != directory:
+        directory = os.path.dirname(directory)
+    return directory
+
+
+def pyramid_tiles(width, height, tile_size=256):
+    from FluentDNA.deepzoom import DZIDescriptor
+    descriptor = DZIDescriptor(width, height, tile_size=tile_size)
+    total = 0
+    for level in range(descriptor.num_levels):
+        columns, rows = descriptor.get_num_tiles(level)
+        total += columns * rows
+    return total, descriptor.num_levels
+
+
+def pil_bytes_per_pixel(bands):
+    """PIL stores every multi band mode in 4 bytes per pixel, RGB included"""
+    return 1 if bands == 1 else 4
+
+
+class Preflight(object):
+    """bands of the canvas mode.  pil_image is True when an in memory canvas is a PIL Image rather than an
+    ArrayCanvas, see TileLayout.memory_canvas_is_array()."""
+    def __init__(self, width, height, bands, directory=None, webpage=True, pil_image=False):
+        self.width, self.height = width, height
+        self.pixels = width * height
+        self.pil_image = pil_image
+        self.canvas_bytes = self.pixels * (pil_bytes_per_pixel(bands) if pil_image else bands)
+        self.array_bytes = self.pixels * bands  # memmap and tiled canvases
+        self.stream_bytes = width * deep_zoom_rows * 4 if webpage else 0
+        self.png_bytes = int(self.pixels * png_bytes_per_pixel)
+        self.tile_count, self.levels = pyramid_tiles(width, height) if webpage else (0, 0)
+        self.tile_bytes = int(self.pixels * tile_bytes_per_pixel) + self.tile_count * 2048 if webpage else 0
+        steps = ['nucleotides', 'png'] + (['deep zoom'] if webpage else [])
+        self.seconds = sum(seconds_per_megapixel[step] for step in steps) * self.pixels / 1e6
+        self.available_ram = psutil.virtual_memory().available
+        self.directory = existing_parent(directory)
+        self.free_disk = psutil.disk_usage(self.directory).free
+
+    def memory_needed(self, render_mode):
+        """Peak RAM of drawing, the PNG and deep zoom.  An ArrayCanvas in memory is tiled directly, so it's
+        the canvas plus the rows deep zoom streams.  A PIL Image is released before deep zoom reads the PNG
+        a band at a time, the larger of the two is the peak.  memmap and tiled canvases are paged by the OS
+        or kept to the tiled memory_budget, only the deep zoom rows count here."""
+        if render_mode != 'memory':
+            return self.stream_bytes
+        if self.pil_image:
+            return max(self.canvas_bytes, self.stream_bytes)
+        return self.canvas_bytes + self.stream_bytes
+
+    def choose_render_mode(self):
+        """The render_mode for 'auto', see the module docstring"""
+        if self.memory_needed('memory') <= self.available_ram * 0.8:
+            return 'memory'
+        if self.array_bytes + self.stream_bytes <= self.available_ram * 0.8:
+            return 'memmap'
+        return 'tiled'
+
+    def disk_needed(self, render_mode):
+        """Output files, plus the canvas itself when it lives on disk (tiled spills at most all of it)"""
+        return self.png_bytes + self.tile_bytes + (self.array_bytes if render_mode != 'memory' else 0)
+
+    def warnings(self, render_mode):
+        warnings = []
+        if render_mode == 'memory' and self.memory_needed('memory') > self.available_ram:
+            warnings.append("The image needs about %s of RAM but only %s is available. "
+                            "Try --render_mode=tiled." % (pretty_bytes(self.memory_needed('memory')),
+                                                          pretty_bytes(self.available_ram)))
+        if self.disk_needed(render_mode) > self.free_disk:
+            warnings.append("The results need about %s of disk but only %s is free in %s." %
+                            (pretty_bytes(self.disk_needed(render_mode)), pretty_bytes(self.free_disk),
+                             self.directory))
+        return warnings
+
+    def describe(self, render_mode):
+        lines = ["Preflight estimate:",
+                 "  canvas        %i x %i pixels, %s" % (self.width, self.height, pretty_bytes(
+                     self.canvas_bytes if render_mode == 'memory' else self.array_bytes)),
+                 "  png           ~%s" % pretty_bytes(self.png_bytes)]
+        if self.tile_count:
+            lines.append("  deep zoom     %i tiles in %i levels, ~%s" % (self.tile_count, self.levels,
+                                                                       pretty_bytes(self.tile_bytes)))
+        lines += ["  peak RAM      ~%s" % pretty_bytes(self.memory_needed(render_mode)),
+                  "  run time      ~%s single core" % pretty_seconds(self.seconds),
+                  "  available     %s RAM, %s disk in %s" % (pretty_bytes(self.available_ram),
+                                                             pretty_bytes(self.free_disk), self.directory),
+                  "  render mode   %s" % render_mode]
+        lines += ["WARNING: " + warning for warning in self.warnings(render_mode)]
+        return '\n'.join(lines)
+
+
+def pretty_bytes(n):
+    for unit in ['bytes', 'KB', 'MB', 'GB']:
+        if n < 1024:
+            return "%.1f %s" % (n, unit) if unit != 'bytes' else "%i bytes" % n
+        n /= 1024
+    return "%.1f TB" % n
+
+
+def pretty_seconds(seconds):
+    if seconds < 120:
+        return "%i seconds" % max(1, seconds)
+    if seconds < 2 * 3600:
+        return "%i minutes" % (seconds // 60)
+    return "%.1f hours" % (seconds / 3600)
@@ -0,0 +1,114 @@
+"""Profiling for fluentdna --profile.  The whole job runs under the profiler and the results are saved in the
+sources/ directory next to command.sh: fluentdna.prof, which loads in pstats, snakeviz or gprof2dot, and
+fluentdna_hotspots.txt, a flat list of the functions that took the most time.
+'cprofile' traces every call, which is exact but can double the run time of pure Python steps.
+'sample' looks at the main thread's stack every few milliseconds instead.  It costs almost nothing, so it
+is the one to use on multi-hour jobs, and its counts are written in the same .prof format: "calls" are the
+number of samples a function was seen in and times are the wall time of those samples.
+Only the main process is profiled, --workers processes are not."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+
+
+def code_key(code):
+    """The (file, line, function) key pstats uses for a function"""
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class SamplingProfiler(object):
+    """Samples the stack of the thread that started it every interval seconds from a daemon thread.
+    Each sample is weighted by the wall time since the previous one, so a late sample isn't undercounted."""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread_id = None
+        self.self_time = defaultdict(float)
+        self.total_time = defaultdict(float)
+        self.samples = defaultdict(int)
+        self.callers = defaultdict(lambda: defaultdict(float))  # callee: {caller: time}
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def enable(self):
+        self.thread_id = threading.current_thread().ident
+        self.thread = threading.Thread(target=self.poll)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def disable(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def poll(self):
+        last = time.time()
+        while not self.stopped.wait(self.interval):
+            now = time.time()
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.record(frame, now - last)
+            last = now
+            frame = None  # don't keep the sampled stack alive
+
+    def record(self, frame, elapsed):
+        stack = []
+        while frame is not None:
+            stack.append(code_key(frame.f_code))
+            frame = frame.f_back
+        self.self_time[stack[0]] += elapsed
+        for key in set(stack):  # recursion only counts once
+            self.total_time[key] += elapsed
+            self.samples[key] += 1
+        for callee, caller in set(zip(stack, stack[1:])):
+            self.callers[callee][caller] += elapsed
+
+    def dump_stats(self, path):
+        """Writes the samples in the marshalled dict format of cProfile.Profile.dump_stats()"""
+        stats = {}
+        for key, total in self.total_time.items():
+            n = self.samples[key]
+            callers = {caller: (1, 1, 0.0, elapsed) for caller, elapsed in self.callers[key].items()}
+            stats[key] = (n, n, self.self_time.get(key, 0.0), total, callers)
+        with open(path, 'wb') as prof:
+            marshal.dump(stats, prof)
+
+
+class JobProfiler(object):
+    """mode is 'cprofile' or 'sample'.  finish() can be called more than once, only the first one saves."""
+    def __init__(self, mode='cprofile', top=40):
+        self.mode = mode
+        self.top = top
+        self.profiler = cProfile.Profile() if mode == 'cprofile' else SamplingProfiler()
+        self.running = False
+
+    def start(self):
+        self.profiler.enable()
+        self.running = True
+        return self
+
+    def finish(self, directory, name='fluentdna'):
+        if not self.running:
+            return None
+        self.profiler.disable()
+        self.running = False
+        try:
+            prof_path = os.path.join(directory, name + '.prof')
+            self.profiler.dump_stats(prof_path)
+            summary_path = os.path.join(directory, name + '_hotspots.txt')
+            with open(summary_path, 'w') as summary:
+                summary.write("%s profile of: %s\n" % (self.mode, ' '.join(sys.argv)))
+                stats = pstats.Stats(prof_path, stream=summary)
+                stats.sort_stats('tottime').print_stats(self.top)
+                stats.sort_stats('cumulative').print_stats(self.top)
+            print("Profile saved to", prof_path, "top functions in", summary_path)
+            return prof_path
+        except (IOError, OSError) as e:
+            print("Could not save the profile:", e)
+            return None
@@ -0,0 +1,89 @@
+"""Progress events and cooperative cancellation for long renders.  Every Layout and ChainParser has a
+self.progress that they report through: phase() sends an event when each step starts and ends,
+update() sends the fraction of the current step that is done and which contig is being worked on.
+update() is called from hot loops, so callbacks are throttled to one per interval seconds.
+
+A program embedding FluentDNA passes its own callback and a CancelToken:
+    token = CancelToken()
+    layout.progress = Progress(lambda event: send(event._asdict()), cancel=token)
+Calling token.cancel() from any thread makes the next update() or phase() raise Cancelled.  process_file()
+catches it, saves the partially drawn image, and raises it again so nothing else is generated."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+# fraction is None for messages.  contig is the name of the contig being drawn or aligned, if any.
+ProgressEvent = namedtuple('ProgressEvent', ['phase', 'fraction', 'contig', 'message'])
+
+
+class Cancelled(Exception):
+    """Raised inside the render when its CancelToken has been cancelled"""
+
+
+class CancelToken(object):
+    """Thread safe flag shared between the render and whoever wants to stop it"""
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled("Render was cancelled")
+
+
+def print_progress(event):
+    """The default callback, prints messages and the fraction of nucleotides done like the old progress bar"""
+    if event.message is not None:
+        print(event.message, flush=True)
+    elif event.contig is not None and event.fraction is not None:
+        print("%s %.1f %% done: %s" % (event.phase or '', event.fraction * 100, event.contig), flush=True)
+
+
+class Progress(object):
+    def __init__(self, callback=print_progress, cancel=None, interval=1.0):
+        self.callback = callback
+        self.cancel = cancel or CancelToken()
+        self.interval = interval
+        self.current_phase = None
+        self.last_update = 0.0
+
+    def emit(self, event):
+        if self.callback is not None:
+            self.callback(event)
+
+    def check(self):
+        self.cancel.check()
+
+    @contextmanager
+    def phase(self, name):
+        """Events with fraction 0 and 1 around one step.  A failed step doesn't send the second one."""
+        self.check()
+        outer, self.current_phase = self.current_phase, name
+        self.emit(ProgressEvent(name, 0.0, None, None))
+        try:
+            yield self
+            self.emit(ProgressEvent(name, 1.0, None, None))
+        finally:
+            self.current_phase = outer
+
+    def update(self, fraction, contig=None):
+        """Cheap enough to call once per contig or block: one flag check and one clock read"""
+        self.cancel.check()
+        now = time.time()
+        if now - self.last_update >= self.interval:
+            self.last_update = now
+            self.emit(ProgressEvent(self.current_phase, min(1.0, fraction), contig, None))
+
+    def message(self, text):
+        """Free text that used to be printed, never throttled"""
+        self.emit(ProgressEvent(self.current_phase, None, None, text))
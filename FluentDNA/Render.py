@@ -0,0 +1,44 @@
+"""Library interface for programs that want FluentDNA's pixels instead of a results directory.
+render() draws a fasta file or a list of Contigs with any Layout and returns the image as a numpy array (or PIL
+Image) and the layout metadata as a dict.  Nothing is written to disk unless the canvas itself lives there
+(render_mode 'memmap' or 'tiled').  For the usual files, call layout.process_file() which is
+render_image() followed by output_image() and output_fasta().
+
+    from FluentDNA.Render import render
+    pixels, layout_json = render('genome.fa', region=(0, 0, 1024, 1024))"""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import numpy as np
+
+from FluentDNA.Canvas import ArrayCanvas, NumpyCanvas
+from FluentDNA.TileLayout import TileLayout
+
+
+def render(source, layout=None, region=None, extract_contigs=None, as_image=False):
+    """source is a fasta path or a list of DNASkittleUtils Contigs, or a list of either for ParallelLayout.
+    layout is any Layout instance, configured the way fluentdna.py would (render_mode, workers, ...),
+    default TileLayout().  region is a (left, top, right, bottom) pixel box.  Only that part is copied out,
+    so with render_mode='tiled' a window of an image bigger than RAM can be taken.
+    Returns (pixels, layout_json): an (height, width, bands) uint8 array, or a PIL Image with as_image,
+    and layout.layout_json().  Indexed color layouts return palette indices.
+    Set layout.progress to a Progress.Progress for events and cancellation, a cancelled render raises Cancelled."""
+    if layout is None:
+        layout = TileLayout()
+    layout.no_webpage = True  # no deep zoom tiles in the Preflight estimate
+    try:
+        image = layout.render_image(source, extract_contigs)
+        metadata = layout.layout_json()
+        if region is not None:
+            image = image.crop(region)
+        elif type(image) is NumpyCanvas and image.bands > 1 and not as_image:
+            image = image.array  # already the pixels, close() only drops the canvas' reference
+        elif isinstance(image, ArrayCanvas):
+            image = image.to_image()
+    finally:
+        if isinstance(layout.image, ArrayCanvas):
+            layout.image.close()  # shared memory and memmap files are released right away
+        layout.image, layout.draw, layout.pixels = None, None, None
+    if as_image:
+        return image, metadata
+    return np.asarray(image), metadata
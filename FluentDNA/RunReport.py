@@ -0,0 +1,186 @@
+"""Machine readable timing for a whole FluentDNA run.  Every Layout has a RunReport and wraps each step in
+self.phase('name'), which records wall time, CPU time (including worker processes) and bytes read and
+written for that step.  finish_webpage() adds the webpage and deep zoom phases and saves the report as
+run_report.json next to the output image, in sources/ for normal runs, so renders can be compared over time.
+A phase that runs more than once (one per genome in a ParallelLayout) gets one entry each time.
+Memory is sampled with psutil by a background thread while a phase runs: resident memory (RSS) of this
+process plus any workers at the start and end and the highest sample in between.  Workers are measured from
+here, and the sampling thread is paused while they're forked, see fork_pool().  With trace_allocations
+(--trace_memory) the tracemalloc peak and the biggest live allocations at the end of each phase are added."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import psutil
+
+
+def io_counters():
+    """(bytes read, bytes written) by this process so far, or None where /proc/self/io isn't available.
+    These are rchar and wchar: every byte passed through read() and write(), whether it hit the disk or
+    the page cache.  Worker processes are not included."""
+    try:
+        with open('/proc/self/io') as counters:
+            fields = dict(line.split(':', 1) for line in counters if ':' in line)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def cpu_seconds():
+    """CPU time of this process and of the worker processes that have already finished"""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def resident_bytes(process):
+    """RSS of the process and its children (--workers), a child can exit while it's being read"""
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+running_samplers = []  # MemorySamplers of phases in progress, paused by fork_pool()
+
+
+class MemorySampler(object):
+    """Polls resident_bytes() every interval seconds in a daemon thread and keeps the highest value"""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.start_rss = self.peak_rss = resident_bytes(self.process)
+        self.resume()
+        running_samplers.append(self)
+
+    def resume(self):
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.poll)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def pause(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def poll(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.peak_rss = max(self.peak_rss, resident_bytes(self.process))
+            except psutil.Error:
+                pass
+
+    def stop(self):
+        self.pause()
+        running_samplers.remove(self)
+        end_rss = resident_bytes(self.process)
+        self.peak_rss = max(self.peak_rss, end_rss)
+        return end_rss
+
+
+def fork_pool(workers):
+    """multiprocessing Pool of forked workers.  A thread running during fork() can leave a lock held
+    forever in the child, so sampling stops until the workers exist.  They're measured from this process."""
+    for sampler in running_samplers:
+        sampler.pause()
+    try:
+        return multiprocessing.get_context('fork').Pool(workers)
+    finally:
+        for sampler in running_samplers:
+            sampler.resume()
+
+
+class RunReport(object):
+    def __init__(self, trace_allocations=False, top_allocations=5):
+        self.started = None
+        self.phases = []
+        self.trace_allocations = trace_allocations
+        self.top_allocations = top_allocations
+
+    def counters(self):
+        return time.time(), cpu_seconds(), io_counters()
+
+    @contextmanager
+    def phase(self, name, verbose=True):
+        """Records one step.  The entry is kept even if the step raises, with "error": true."""
+        if self.started is None:
+            self.started = datetime.now()
+        if self.trace_allocations:
+            self.start_tracing()
+        sampler = MemorySampler()
+        wall, cpu, io = self.counters()
+        entry = {'phase': name, 'error': True}
+        try:
+            yield entry
+            entry['error'] = False
+        finally:
+            end_wall, end_cpu, end_io = self.counters()
+            entry['wall_seconds'] = round(end_wall - wall, 4)
+            entry['cpu_seconds'] = round(end_cpu - cpu, 4)
+            if io is not None and end_io is not None:
+                entry['bytes_read'] = end_io[0] - io[0]
+                entry['bytes_written'] = end_io[1] - io[1]
+            entry['rss_end'] = sampler.stop()
+            entry['rss_start'], entry['rss_peak'] = sampler.start_rss, sampler.peak_rss
+            if self.trace_allocations:
+                self.add_allocations(entry)
+            self.phases.append(entry)
+            if verbose:
+                print("Phase %s: %.2fs (%.2fs CPU, %i MB peak RSS)" % (name, entry['wall_seconds'],
+                      entry['cpu_seconds'], entry['rss_peak'] // 2 ** 20), flush=True)
+
+    def start_tracing(self):
+        """Starts tracemalloc, or resets its peak so it belongs to the phase that is starting"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.clear_traces()  # also drops older allocations from add_allocations()
+
+    def add_allocations(self, entry):
+        entry['traced_peak'] = tracemalloc.get_traced_memory()[1]
+        statistics = tracemalloc.take_snapshot().statistics('lineno')[:self.top_allocations]
+        entry['top_allocations'] = [{'where': '%s:%i' % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                                     'bytes': stat.size, 'count': stat.count} for stat in statistics]
+
+    def totals(self):
+        """Sums of each phase name, in the order they first ran"""
+        totals = {}
+        for entry in self.phases:
+            total = totals.setdefault(entry['phase'], {'runs': 0})
+            total['runs'] += 1
+            for field in ['wall_seconds', 'cpu_seconds', 'bytes_read', 'bytes_written']:
+                if field in entry:
+                    total[field] = round(total.get(field, 0) + entry[field], 4)
+            for field in ['rss_peak', 'traced_peak']:  # traced_peak only with trace_allocations
+                if field in entry:
+                    total[field] = max(total.get(field, 0), entry[field])
+        return totals
+
+    def as_dict(self, layout_name=None):
+        return {'started': self.started.isoformat() if self.started else None,
+                'layout': layout_name,
+                'command': sys.argv,
+                'wall_seconds': round(sum(entry['wall_seconds'] for entry in self.phases), 4),
+                'cpu_seconds': round(sum(entry['cpu_seconds'] for entry in self.phases), 4),
+                'rss_peak': max([entry['rss_peak'] for entry in self.phases] or [None]),
+                'phases': self.phases,
+                'totals': self.totals()}
+
+    def save(self, directory, layout_name=None, file_name='run_report.json'):
+        path = os.path.join(directory, file_name)
+        with open(path, 'w') as report:
+            json.dump(self.as_dict(layout_name), report, indent=2)
+        return path
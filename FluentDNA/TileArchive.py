@@ -0,0 +1,144 @@
+"""One file for a whole deep zoom pyramid, for shared file systems that choke on millions of tiles.
+With fluentdna --tile_archive, ImageCreator writes GeneratedImages/dzc_output.tiles instead of the
+dzc_output_files/ directory.  The built-in server (run_server) answers the same tile URLs OpenSeadragon
+already requests, GeneratedImages/dzc_output_files/<level>/<column>_<row>.png, by reading just that tile's
+bytes out of the archive, so index.html doesn't change.  Opening index.html without the server won't work.
+
+Layout: MAGIC, the encoded tiles one after another, the index, then a footer with the offset of the index,
+the number of tiles and MAGIC again.  The index is an array of index_dtype records sorted by
+key = level << 48 | column << 24 | row.  Identical uniform tiles are stored once and share an offset."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import io
+import os
+import re
+import struct
+
+import numpy as np
+
+MAGIC = b'FDNATIL1'
+index_dtype = np.dtype([('key', '<u8'), ('offset', '<u8'), ('length', '<u8')])
+footer = struct.Struct('<QQ8s')
+tile_url = re.compile(r'(.*)_files[/\\](\d+)[/\\](\d+)_(\d+)\.(png|jpg)$')
+
+
+def tile_key(level, column, row):
+    return level << 48 | column << 24 | row
+
+
+def archive_path(destination):
+    """The archive that stands in for the tiles of a .xml or .dzi descriptor"""
+    return os.path.splitext(destination)[0] + '.tiles'
+
+
+class TileArchiveWriter(object):
+    """Tiles are appended as they're added and the index is written by close().  The archive is written
+    under a .partial name and renamed at the end, so a crashed run never leaves a valid looking archive."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + '.partial', 'wb')
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.entries = []
+        self.shared = {}  # shared_key: (offset, length)
+
+    def add(self, level, column, row, data, shared_key=None):
+        """shared_key identifies tiles that are always the same bytes, like a blank tile of one size"""
+        if shared_key is not None and shared_key in self.shared:
+            offset, length = self.shared[shared_key]
+        else:
+            self.file.write(data)
+            offset, length = self.offset, len(data)
+            self.offset += length
+            if shared_key is not None:
+                self.shared[shared_key] = (offset, length)
+        self.entries.append((tile_key(level, column, row), offset, length))
+
+    def close(self):
+        index = np.array(self.entries, dtype=index_dtype)
+        index.sort(order='key')
+        self.file.write(index.tobytes())
+        self.file.write(footer.pack(self.offset, len(index), MAGIC))
+        self.file.close()
+        self.file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(self.path + '.partial', self.path)
+
+    def abort(self):
+        """Deletes the partial archive, unless close() already finished it"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.path + '.partial')
+
+
+class TileArchive(object):
+    """Reads tiles from an archive.  Only the index is loaded, each tile is a seek and read of its bytes."""
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, 'rb') as archive:
+            archive.seek(-footer.size, os.SEEK_END)
+            index_offset, count, magic = footer.unpack(archive.read(footer.size))
+            if magic != MAGIC:
+                raise ValueError("%s is not a FluentDNA tile archive" % path)
+            archive.seek(index_offset)
+            self.index = np.frombuffer(archive.read(count * index_dtype.itemsize), dtype=index_dtype)
+        self.keys = self.index['key']
+
+    def __len__(self):
+        return len(self.index)
+
+    def find(self, level, column, row):
+        """(offset, length) of a tile, or None if the archive doesn't have it"""
+        key = tile_key(level, column, row)
+        i = np.searchsorted(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return int(self.index['offset'][i]), int(self.index['length'][i])
+
+    def read(self, level, column, row):
+        location = self.find(level, column, row)
+        if location is None:
+            return None
+        with open(self.path, 'rb') as archive:
+            archive.seek(location[0])
+            return archive.read(location[1])
+
+
+open_archives = {}  # path: TileArchive, opened again when the file changes
+
+
+def archived_tile(file_path):
+    """The bytes of the tile a dzc_output_files/<level>/<column>_<row>.png path stands for, if there's an
+    archive for it.  None for anything else."""
+    match = tile_url.match(file_path)
+    if match is None:
+        return None
+    path = match.group(1) + '.tiles'
+    if not os.path.isfile(path):
+        return None
+    archive = open_archives.get(path)
+    if archive is None or archive.mtime != os.path.getmtime(path):
+        archive = open_archives[path] = TileArchive(path)
+    level, column, row = (int(match.group(i)) for i in (2, 3, 4))
+    return archive.read(level, column, row)
+
+
+def archive_request_handler(base):
+    """Subclass of an http.server SimpleHTTPRequestHandler that serves tiles from archives when the tile
+    file itself doesn't exist"""
+    class ArchiveRequestHandler(base):
+        def send_head(self):
+            file_path = self.translate_path(self.path)
+            data = None if os.path.exists(file_path) else archived_tile(file_path)
+            if data is None:
+                return base.send_head(self)
+            self.send_response(200)
+            self.send_header("Content-type", self.guess_type(file_path))
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            return io.BytesIO(data)
+    return ArchiveRequestHandler
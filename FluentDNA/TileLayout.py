@@ -2,20 +2,30 @@ from __future__ import print_function, division, absolute_import, \
     with_statement, generators, nested_scopes
 
 import math
+import multiprocessing
 import os
 import traceback
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 
 import sys
-from DNASkittleUtils.Contigs import read_contigs, Contig, write_contigs_to_file
+import numpy as np
+from DNASkittleUtils.Contigs import Contig, write_contigs_to_file
 from DNASkittleUtils.DDVUtils import copytree
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageFont, ImageMode
 
 from FluentDNA import gap_char
-from FluentDNA.FluentDNAUtils import multi_line_height, pretty_contig_name, viridis_palette, \
-    make_output_directory, filter_by_contigs, copy_to_sources
-from FluentDNA.Layouts import LayoutFrame, LayoutLevel, level_layout_factory, parse_custom_layout
+from FluentDNA.FastaIndex import StreamedSequence
+from FluentDNA.Canvas import ArrayCanvas, NumpyCanvas, TiledCanvas, MemmapCanvas, SharedMemoryCanvas, \
+    canvas_draw, shared_memory
+from FluentDNA.FluentDNAUtils import pretty_contig_name, viridis_palette, \
+    make_output_directory, filter_by_contigs, read_and_filter_contigs, copy_to_sources
+from FluentDNA.Layouts import LayoutFrame, LayoutLevel, PaddingPlan, level_layout_factory, parse_custom_layout
+from FluentDNA.Preflight import Preflight, DryRun
+from FluentDNA.Progress import Progress, Cancelled
+from FluentDNA.RunReport import RunReport, fork_pool
+from FluentDNA.TitleCache import title_cache, text_bitmap, text_size
 
 small_title_bp = 10000
 protein_found_message = False
@@ -65,7 +75,19 @@ class TileLayout(object):
         self.draw = None
         self.pixels = None
         self.pil_mode = 'RGB'  # no alpha channel means less RAM used
+        self.draws_by_pixel = False  # draw_nucleotides() is replaced by a draw_pixel() loop, see new_canvas()
+        self.render_mode = 'memory'  # 'tiled' or 'memmap' keep the canvas out of RAM, 'auto' picks, see new_canvas()
+        self.memory_budget = 2 * 1024 ** 3  # bytes of tiles kept in RAM by the tiled canvas
+        self.canvas_dir = None  # where spilled tiles and memmap files go
+        self.indexed_color = False  # one byte per pixel 'P' canvas, see indexed_palette()
+        self.workers = 1  # processes for draw_nucleotides(), see draw_nucleotides_in_workers()
+        self.stream_sequences = False  # read sequence from disk while drawing, see FastaIndex.StreamedSequence
+        self.dry_run = False  # stop at the Preflight estimate, see check_resources()
+        self.no_webpage = False  # only used to estimate whether deep zoom tiles will be made
         self.contigs = []
+        self.padding_plan = None  # made by calc_all_padding()
+        self.report = RunReport()  # timing of each step, see phase()
+        self.progress = Progress()  # events and cancellation, see Progress.py
         self.contig_memory = []
         self.image_length = 0
 
@@ -194,37 +216,70 @@ class TileLayout(object):
         make_output_directory(output_folder, no_webpage)
         start_time = datetime.now()
         self.final_output_location = output_folder
-        self.image_length = self.read_contigs_and_calc_padding(input_file_path, extract_contigs)
-        print("Read contigs from", input_file_path, ":", datetime.now() - start_time)
-        self.prepare_image(self.image_length)
-        print("Initialized Image:", datetime.now() - start_time, "\n")
+        try:
+            self.render_image(input_file_path, extract_contigs)
+        except Cancelled:
+            self.save_cancelled_image(output_folder, output_file_name, no_webpage)
+            raise
+
+        with self.phase('png'):
+            self.output_image(output_folder, output_file_name, no_webpage)
+        with self.phase('fasta'):
+            self.output_fasta(output_folder, input_file_path, no_webpage,
+                              extract_contigs, self.sort_contigs)
+        return start_time
+
+    def render_image(self, source, extract_contigs=None):
+        """Every drawing step of process_file() without writing anything: read and pad the contigs, allocate
+        the canvas, then nucleotides, titles and extras.  source is a fasta path or a list of Contigs.
+        The finished canvas is self.image, also returned.  Render.render() uses this to hand the pixels to
+        another program."""
+        self.image_length = self.read_contigs_and_calc_padding(source, extract_contigs)
+        with self.phase('image allocation'):
+            self.prepare_image(self.image_length)
         try:  # These try catch statements ensure we get at least some output.  These jobs can take hours
-            self.draw_nucleotides()
-            print("\nDrew Nucleotides:", datetime.now() - start_time)
+            with self.phase('nucleotides'):
+                self.draw_nucleotides()
+        except Cancelled:
+            raise
         except Exception as e:
             print('Encountered exception while drawing nucleotides:', '\n')
             traceback.print_exc()
         try:
             if self.use_titles:
-                print("Drawing %i titles" % sum(len(x.seq) > small_title_bp for x in self.contigs))
-                self.draw_titles()
-                print("Drew Titles:", datetime.now() - start_time)
+                self.progress.message("Drawing %i titles" % sum(len(x.seq) > small_title_bp for x in self.contigs))
+                with self.phase('titles'):
+                    self.draw_titles()
+        except Cancelled:
+            raise
         except BaseException as e:
             print('Encountered exception while drawing titles:', '\n')
             traceback.print_exc()
         try:
-            self.draw_extras()
+            with self.phase('extras'):
+                self.draw_extras()
+        except Cancelled:
+            raise
         except BaseException as e:
             print('Encountered exception while drawing titles:', '\n')
             traceback.print_exc()
+        return self.image
 
-        self.output_image(output_folder, output_file_name, no_webpage)
-        print("Output Image in:", datetime.now() - start_time)
-        self.output_fasta(output_folder, input_file_path, no_webpage,
-                          extract_contigs, self.sort_contigs)
-        print("Output Fasta in:", datetime.now() - start_time)
-        return start_time
 
+    @contextmanager
+    def phase(self, name):
+        """Context manager that times one step of the run into self.report and reports it to self.progress,
+        for use in every Layout:  with self.phase('nucleotides'): ..."""
+        with self.report.phase(name), self.progress.phase(name):
+            yield
+
+    def save_cancelled_image(self, output_folder, output_file_name, no_webpage):
+        """Flushes whatever was drawn before a Cancelled render stopped"""
+        if self.image is None:
+            return
+        print("Render cancelled, saving the partial image")
+        with self.report.phase('png'):
+            self.output_image(output_folder, output_file_name, no_webpage)
 
     def draw_extras(self):
         """Placeholder method for child classes"""
@@ -232,7 +287,137 @@ class TileLayout(object):
 
     def draw_nucleotides(self, verbose=True):
         """Top level function loop for placing color pixels onto the self.canvas based on the nucleotide
-        content of the fasta. Frequently overridden by child classes."""
+        content of the fasta. Frequently overridden by child classes.
+        Each contig is encoded once into a uint8 array and colored through a 256 entry lookup table.
+        Whole columns are written as one block into the ArrayCanvas new_canvas() made for it.
+        Child classes that override draw_pixel() fall back to draw_nucleotides_by_pixel().
+        Streamed contigs are read and encoded one block of whole columns at a time."""
+        if not self.supports_vectorized_drawing():
+            return self.draw_nucleotides_by_pixel(verbose)
+        lookup = self.palette_lookup_table()
+        canvas = self.nucleotide_canvas()
+        if self.workers > 1:
+            if not getattr(canvas, 'shared', False):
+                print("Drawing in one process: --workers needs a memory or memmap canvas")
+            elif 'fork' not in multiprocessing.get_all_start_methods():
+                print("Drawing in one process: --workers needs the fork start method on this platform")
+            else:
+                return self.draw_nucleotides_in_workers(canvas, lookup, verbose)
+        column_size = self.levels[0].modulo * self.levels[1].modulo
+        block_size = max(column_size, StreamedSequence.block_size * 16 // column_size * column_size)
+        total_progress = 0
+        # Layout contigs one at a time
+        for contig in self.contigs:
+            total_progress += contig.reset_padding + contig.title_padding
+            if isinstance(contig.seq, StreamedSequence):
+                for start, block in contig.seq.blocks(block_size):
+                    self.draw_sequence_array(canvas, lookup, encode_sequence(block), total_progress + start)
+                    self.report_nucleotides(total_progress + start, contig, verbose)
+            else:
+                self.draw_sequence_array(canvas, lookup, encode_sequence(contig.seq), total_progress)
+            total_progress += len(contig.seq)
+            total_progress += contig.tail_padding  # add trailing white space after the contig sequence body
+            self.report_nucleotides(total_progress, contig, verbose)
+
+
+    def report_nucleotides(self, total_progress, contig, verbose=True):
+        """Throttled progress for draw_nucleotides().  Cancellation is checked even when it's not verbose."""
+        if verbose:
+            self.progress.update(total_progress / self.image_length, contig.name)
+        else:
+            self.progress.check()
+
+
+    def draw_nucleotides_in_workers(self, canvas, lookup, verbose=True):
+        """Splits every contig into pieces of whole columns and draws them in a pool of forked processes.
+        Padding is already fixed, so pieces are independent.  The workers inherit this layout, the contigs and
+        the shared canvas from the fork: they slice the sequence by offset and write pixels straight into
+        shared memory.  Nothing large is pickled.  Titles are drawn afterwards by the main process."""
+        global forked_layout
+        jobs = list(self.nucleotide_jobs())
+        forked_layout = (self, canvas, lookup)
+        try:
+            pool = fork_pool(self.workers)
+            try:
+                chunk_size = max(1, len(jobs) // (self.workers * 8))
+                for done, contig_index in enumerate(pool.imap_unordered(draw_job_in_worker, jobs, chunk_size)):
+                    if verbose:
+                        self.progress.update((done + 1) / len(jobs), self.contigs[contig_index].name)
+                    else:
+                        self.progress.check()
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            forked_layout = None
+
+
+    def nucleotide_jobs(self, job_size=10 * 1000 * 1000):
+        """Yields (contig_index, start, stop, progress) pieces of at most job_size nucleotides.  Pieces start on
+        a column boundary so they get the same line breaks and column blocks as drawing the whole contig."""
+        column_size = self.levels[0].modulo * self.levels[1].modulo
+        job_size = max(column_size, job_size // column_size * column_size)
+        total_progress = 0
+        for contig_index, contig in enumerate(self.contigs):
+            total_progress += contig.reset_padding + contig.title_padding
+            seq_length = len(contig.seq)
+            for start in range(0, seq_length, job_size):
+                stop = min(seq_length, start + job_size)
+                yield contig_index, start, stop, total_progress + start
+            total_progress += seq_length + contig.tail_padding
+
+
+    def draw_sequence_array(self, canvas, lookup, codes, total_progress):
+        """Writes one encoded contig starting at total_progress.  Every line is placed exactly where
+        draw_nucleotides_by_pixel() would put it: line anchors come from one positions_on_screen() call.
+        Lines that start a full, aligned column are drawn together by the frame's ColumnStencil,
+        the remaining lines at contig edges are scattered with fancy indexing in batches."""
+        seq_length = len(codes)
+        line_width = self.levels[0].modulo
+        lines_per_column = self.levels[1].modulo
+        stencil = self.levels.column_stencil()
+        height, width = canvas.shape[:2]
+        line_starts = np.arange(0, seq_length, line_width, dtype=np.int64)
+        xs, ys = self.positions_on_screen(line_starts + total_progress)
+
+        column_starts = np.flatnonzero(((line_starts + total_progress) % stencil.size == 0) &
+                                       (seq_length - line_starts >= stencil.size) &
+                                       (xs >= 0) & (xs + stencil.width <= width) &
+                                       (ys >= 0) & (ys + stencil.height <= height))
+        stencil.apply(canvas, lookup, codes, line_starts[column_starts], xs[column_starts], ys[column_starts])
+        block_lines = np.zeros(len(line_starts), dtype=bool)
+        for line in column_starts:
+            block_lines[line:line + lines_per_column] = True
+
+        remaining_lines = np.flatnonzero(~block_lines)
+        batch_size = max(1, 1000000 // line_width)  # bounds the size of temporary index arrays
+        for batch in range(0, len(remaining_lines), batch_size):
+            self.draw_lines_array(canvas, lookup, codes, remaining_lines[batch:batch + batch_size],
+                                  line_starts, xs, ys, line_width)
+
+
+    def draw_lines_array(self, canvas, lookup, codes, lines, line_starts, xs, ys, line_width):
+        """Scatters individual lines onto the canvas.  Like the original loop, nucleotides run to the right
+        of each line anchor, and pixels that fall off the image are skipped with a warning."""
+        seq_length = len(codes)
+        height, width = canvas.shape[:2]
+        lengths = np.minimum(line_width, seq_length - line_starts[lines])
+        line_of_pixel = np.repeat(np.arange(len(lines)), lengths)
+        i = np.arange(len(line_of_pixel)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        px = xs[lines][line_of_pixel] + i
+        py = ys[lines][line_of_pixel]
+        inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+        if not inside.all():  # x only grows along a line, so what's left inside is the part that was drawn before
+            for line in np.unique(line_of_pixel[~inside]):
+                print("Cursor fell off the image at", (int(xs[lines[line]]), int(ys[lines[line]])))
+        offsets = line_starts[lines][line_of_pixel] + i
+        canvas[py[inside], px[inside]] = lookup[codes[offsets[inside]]]
+
+
+    def draw_nucleotides_by_pixel(self, verbose=True):
+        """Original one pixel at a time version of draw_nucleotides().  This is much slower, but it
+        respects any draw_pixel() override in child classes."""
         total_progress = 0
         # Layout contigs one at a time
         for contig_index, contig in enumerate(self.contigs):
@@ -251,9 +436,46 @@ class TileLayout(object):
                 except IndexError:
                    print("Cursor fell off the image at", (x,y))
             total_progress += contig.tail_padding  # add trailing white space after the contig sequence body
-            if verbose and (len(self.contigs) < 100 or contig_index % (len(self.contigs) // 100) == 0):
-                print(str(total_progress / self.image_length * 100)[:4], '% done:', contig.name,
-                      flush=True)  # pseudo progress bar
+            self.report_nucleotides(total_progress, contig, verbose)
+
+
+    def supports_vectorized_drawing(self, mode=None):
+        """The vectorized path only knows how to reproduce the stock draw_pixel() on RGB(A) or
+        indexed canvases.  mode is the canvas mode before there is a canvas."""
+        return type(self).draw_pixel is TileLayout.draw_pixel and \
+            (mode or self.image.mode) in ('RGB', 'RGBA', 'P') and \
+            len(self.levels) > 2 and self.levels[0].thickness == 1
+
+
+    def palette_lookup_table(self):
+        """Maps every possible byte value to the color draw_pixel() would have used for it.
+        Reading through .get() avoids filling the defaultdict with 256 new entries.
+        Indexed canvases get a table of palette indices instead of colors."""
+        channels = 3 if self.image.mode == 'P' else len(self.image.mode)
+        default = self.palette.default_factory() if getattr(self.palette, 'default_factory', None) \
+            else (255, 0, 0)
+        table = np.full((256, channels), 255, dtype=np.uint8)  # alpha is opaque, same as draw_pixel
+        for code in range(256):
+            key = code if self.using_spectrum else chr(code)
+            table[code, :3] = self.palette.get(key, default)[:3]
+        if self.image.mode == 'P':
+            return self.image.colors_to_indices(table)
+        return table
+
+
+    def nucleotide_canvas(self):
+        """The ArrayCanvas draw_nucleotides() writes numpy blocks into.  new_canvas() already makes one for
+        layouts that draw this way.  A PIL Image that got here some other way is moved into a NumpyCanvas
+        for good, one band at a time, and never copied back."""
+        if not isinstance(self.image, ArrayCanvas):
+            image = self.image
+            canvas = NumpyCanvas(image.mode, image.size)
+            for y in range(0, image.height, canvas.band_height()):
+                band = image.crop((0, y, image.width, min(image.height, y + canvas.band_height())))
+                canvas.write_region(0, y, canvas.image_to_array(band))
+            del image
+            self.set_canvas(canvas)
+        return self.image
 
 
     def output_fasta(self, output_folder, fasta, no_webpage, extract_contigs, sort_contigs,
@@ -284,62 +506,209 @@ class TileLayout(object):
         it upgrades the order of magnitude of padding to the next LayoutLevel. By analogy, this is the same operation
         as ensuring there are no single text lines at the bottom of a page and instead placing the page break at
         the start of a new paragraph on line earlier. Padding gets attached to the contigs and cumulative x_y positions
-        are included. This means there's a difference between a padded list of contigs and a bare list of contigs."""
-        total_progress = 0  # pointer in image
-        seq_start = 0  # pointer in text
-        biggest_chromosome = None
+        are included. This means there's a difference between a padded list of contigs and a bare list of contigs.
+        The padding for all contigs is worked out at once from an array of lengths by plan_padding()."""
         if len(self.contigs) > 10000:
             print("Over 10,000 scaffolds detected!  Titles for entries less than 10,000bp will not be drawn.")
             self.skip_small_titles = True
             self.sort_contigs = True  # Important! Skipping isn't valid unless they're sorted
+        lengths = np.array([len(contig.seq) for contig in self.contigs], dtype=np.int64)
         if self.sort_contigs:
             # Best to bring the largest contigs to the forefront
             print("Scaffolds are being sorted by length.")
-            self.contigs.sort(key=lambda fragment: -len(fragment.seq))
+            order = np.argsort(-lengths, kind='stable')  # same order as a stable list.sort()
+            self.contigs[:] = [self.contigs[i] for i in order.tolist()]
+            lengths = lengths[order]
         # Replaces the current layout with an update based on file contents
-        self.each_layout[self.i_layout] = self.find_layout_height_by_chromosomes()
-
-        for contig in self.contigs:  # Type: class DNASkittleUtils.Contigs.Contig
-            length = len(contig.seq)
-            title_length = len(contig.name) + 1  # for tracking where we are in the SEQUENCE file
-            reset, title, tail = self.calc_padding(total_progress, length)
-
+        self.each_layout[self.i_layout] = self.find_layout_height_by_chromosomes(lengths)
+
+        # +1 for tracking where we are in the SEQUENCE file
+        name_lengths = np.array([len(contig.name) + 1 for contig in self.contigs], dtype=np.int64)
+        plan = self.plan_padding(lengths, name_lengths)
+        for contig, reset, title, tail, title_start, seq_start in zip(
+                self.contigs, plan.reset_padding.tolist(), plan.title_padding.tolist(), plan.tail_padding.tolist(),
+                plan.nuc_title_start.tolist(), plan.nuc_seq_start.tolist()):  # Type: DNASkittleUtils.Contigs.Contig
             contig.reset_padding = reset
             contig.title_padding = title
             contig.tail_padding = tail
-            contig.nuc_title_start = seq_start
-            contig.nuc_seq_start = seq_start + title_length
+            contig.nuc_title_start = title_start
+            contig.nuc_seq_start = seq_start
+        self.padding_plan = plan
+        return plan.total_progress  # + reset + title + tail + length
+
+
+    def plan_padding(self, lengths, name_lengths):
+        """Same padding as calling calc_padding() for every contig, as a PaddingPlan.
+        Which level a contig fits in and its title padding only depend on its length, so they're computed for all
+        contigs at once by title_paddings().  Reset and tail depend on where the previous contig ended, that
+        part is a short loop over plain ints.  Child classes that override calc_padding() instead of
+        limit_title_padding() get their own calc_padding() called for each contig."""
+        n = len(lengths)
+        reset_padding, tail_padding = [0] * n, [0] * n
+        if type(self).calc_padding is not TileLayout.calc_padding:
+            title_padding = [0] * n
+            total_progress = 0
+            for k, length in enumerate(lengths.tolist()):
+                reset_padding[k], title_padding[k], tail_padding[k] = self.calc_padding(total_progress, length)
+                total_progress += reset_padding[k] + title_padding[k] + tail_padding[k] + length
+            return PaddingPlan(self.contigs, lengths, name_lengths, reset_padding, title_padding, tail_padding)
+
+        level_index, title_padding = self.title_paddings(lengths)
+        shown_title = self.limit_title_padding(title_padding)
+        chunks = [level.chunk_size for level in self.levels]
+        megarow_chunk = self.levels[3].chunk_size
+        widen_resets = not self.using_custom_layout
+        total_progress = 0
+        for k, (i, length, title, shown) in enumerate(zip(level_index.tolist(), lengths.tolist(),
+                                                         title_padding.tolist(), shown_title.tolist())):
+            if i >= 0:  # same steps as the end of calc_padding()
+                chunk, smaller_chunk = chunks[i], chunks[i - 1]
+                space_remaining = chunk - total_progress % chunk
+                reset_chunk = smaller_chunk if length + title < space_remaining else chunk
+                reset = reset_chunk - total_progress % reset_chunk
+                if widen_resets and space_remaining > 1 and reset == 1 and length > megarow_chunk * 2:
+                    reset += megarow_chunk
+                if total_progress == 0:
+                    reset = 0
+                tail = smaller_chunk - (total_progress + title + reset + length) % smaller_chunk - 1
+                reset_padding[k], tail_padding[k] = reset, tail
+                total_progress += reset + shown + tail + length
+            else:
+                total_progress += shown + length
+        return PaddingPlan(self.contigs, lengths, name_lengths, reset_padding, shown_title, tail_padding)
+
+
+    def title_paddings(self, lengths):
+        """The first half of calc_padding() for an array of contig lengths.  Returns the index of the level
+        each contig is placed in (-1 when it doesn't fit any) and its title padding before limit_title_padding()."""
+        min_gap = (20 + 6) * self.base_width  # 20px font height, + 6px vertical padding  * 100 nt per line
+        level_index = np.full(len(lengths), -1, dtype=np.int64)
+        title_padding = np.zeros(len(lengths), dtype=np.int64)
+        for i, current_level in enumerate(self.levels):
+            title = np.full(len(lengths), max(min_gap, self.levels[i - 1].chunk_size), dtype=np.int64)
+            if self.skip_small_titles:
+                title[lengths < small_title_bp] = self.title_skip_padding
+            if not self.use_titles:
+                title[:] = 0
+            title[title > self.levels[3].chunk_size] = self.megarow_label_size
+            fits = (level_index < 0) & (lengths + min_gap < current_level.chunk_size) & \
+                   (lengths + title <= current_level.chunk_size)
+            level_index[fits] = i
+            title_padding[fits] = title[fits]
+        return level_index, title_padding
 
-            total_progress += reset + title + tail + length  # pointer in image
-            seq_start += title_length + length  # pointer in text
-        return total_progress  # + reset + title + tail + length
+
+    def limit_title_padding(self, title_padding):
+        """Child classes can shrink titles after the reset and tail have been calculated.
+        Works on a single int or an array of title paddings."""
+        return title_padding
 
 
     def read_contigs_and_calc_padding(self, input_file_path, extract_contigs=None):
-        """Reads and filters contigs before calculating their padding."""
-        try:
-            self.contigs = read_contigs(input_file_path)
-        except UnicodeDecodeError as e:
-            print(e)
-            print("Important: Non-standard characters detected.  Switching to 256 colormap for bytes")
-            self.using_spectrum = True
-            self.palette = viridis_palette()
-            self.contigs = [Contig(input_file_path, open(input_file_path, 'rb').read())]
-        self.contigs = filter_by_contigs(self.contigs, extract_contigs)
-        self.protein_palette = is_protein_sequence(self.contigs[0])
-        return self.calc_all_padding()
+        """Reads and filters contigs before calculating their padding.
+        With stream_sequences only names and lengths are read here.  The sequence stays on disk until
+        draw_nucleotides() and output_fasta() read it back, so peak memory doesn't grow with the genome.
+        input_file_path can also be a list of Contigs that are already in memory."""
+        with self.phase('read'):
+            try:
+                if isinstance(input_file_path, str):
+                    self.contigs = read_and_filter_contigs(input_file_path, extract_contigs, self.stream_sequences)
+                else:
+                    self.contigs = filter_by_contigs(list(input_file_path), extract_contigs)
+            except UnicodeDecodeError as e:
+                print(e)
+                print("Important: Non-standard characters detected.  Switching to 256 colormap for bytes")
+                self.using_spectrum = True
+                self.palette = viridis_palette()
+                self.contigs = [Contig(input_file_path, open(input_file_path, 'rb').read())]
+                self.contigs = filter_by_contigs(self.contigs, extract_contigs)
+            self.protein_palette = is_protein_sequence(self.contigs[0])
+        with self.phase('padding'):
+            return self.calc_all_padding()
 
     def prepare_image(self, image_length):
         """Approximates the needed width and height of the canvas given the amount of nucleotides in the fasta.
         Reserves and allocates a (likely very large) amount of RAM for the image.
-        TODO: It's possible a future version of FluentDNA could allocate one chromosome, contig, or tile of RAM
-        at a time, output a full deepzoom stack to the HDD and then proceed to the next section. This would
-        require much less RAM and may even perform faster. However it would require tracking resources for allocated
-        and unallocated image tiles."""
+        With render_mode = 'tiled' only the tiles that are drawn on are allocated and they spill to disk
+        beyond self.memory_budget, see Canvas.TiledCanvas. render_mode = 'memmap' uses a raw file on disk."""
         width, height = self.max_dimensions(image_length)
         print("Image dimensions are", width, "x", height, "pixels")
-        self.image = Image.new(self.pil_mode, (width, height), hex_to_rgb('#FFFFFF'))#ui_grey)
-        self.draw = ImageDraw.Draw(self.image)
+        self.set_canvas(self.new_canvas(width, height))
+
+
+    def new_canvas(self, width, height, color=hex_to_rgb('#FFFFFF')):
+        """Creates a PIL Image, TiledCanvas or MemmapCanvas depending on self.render_mode.
+        Indexed color always uses an ArrayCanvas because PIL can't draw RGB text on a 'P' Image.
+        In memory, layouts that draw nucleotides with numpy get a NumpyCanvas: 3 bytes per RGB pixel instead of
+        PIL's 4, it's drawn on without a copy, and deep zoom reads it without decoding the PNG again.
+        Layouts that draws_by_pixel keep a PIL Image, its pixel access is much faster than an ArrayCanvas'.
+        With multiple workers, in memory canvases go in shared memory so the workers can draw on them."""
+        mode, palette = self.pil_mode, None
+        if self.indexed_color:
+            palette = self.indexed_palette()
+            if palette is not None:
+                mode = 'P'
+        self.check_resources(width, height, mode)
+        if self.render_mode == 'tiled':
+            return TiledCanvas(mode, (width, height), color, palette,
+                               memory_budget=self.memory_budget, spill_dir=self.canvas_dir)
+        if self.render_mode == 'memmap':
+            return MemmapCanvas(mode, (width, height), color, palette, directory=self.canvas_dir)
+        if self.workers > 1:
+            if shared_memory is not None:
+                return SharedMemoryCanvas(mode, (width, height), color, palette)
+            return MemmapCanvas(mode, (width, height), color, palette, directory=self.canvas_dir)
+        if self.memory_canvas_is_array(mode):
+            return NumpyCanvas(mode, (width, height), color, palette)
+        return Image.new(mode, (width, height), color)  # ui_grey
+
+
+    def memory_canvas_is_array(self, mode):
+        """Whether new_canvas() makes an ArrayCanvas rather than a PIL Image for render_mode 'memory'"""
+        return mode == 'P' or self.workers > 1 or \
+            (not self.draws_by_pixel and self.supports_vectorized_drawing(mode))
+
+
+    def check_resources(self, width, height, mode):
+        """Prints the Preflight estimate for a width x height canvas before anything is allocated and resolves
+        render_mode 'auto'.  A tiled canvas chosen this way keeps at most half the available RAM in tiles.
+        With dry_run it stops here by raising DryRun."""
+        preflight = Preflight(width, height, len(ImageMode.getmode(mode).bands), self.canvas_dir,
+                              webpage=not self.no_webpage, pil_image=not self.memory_canvas_is_array(mode))
+        if self.render_mode == 'auto':
+            self.render_mode = preflight.choose_render_mode()
+            if self.render_mode == 'tiled':
+                self.memory_budget = min(self.memory_budget, preflight.available_ram // 2)
+        print(preflight.describe(self.render_mode))
+        if self.dry_run:
+            raise DryRun()
+
+
+    def indexed_palette(self):
+        """Fixed 256 color palette for indexed_color: white, every color in self.palette, then as fine a grey
+        ramp as fits.  Borders, corners and title text are all greys, so they come out within 1 shade.
+        Returns None when the layout can't be drawn with a palette."""
+        if self.pil_mode != 'RGB' or self.using_spectrum:
+            print("Indexed color is only available for RGB nucleotide layouts. Using", self.pil_mode)
+            return None
+        default = self.palette.default_factory() if getattr(self.palette, 'default_factory', None) \
+            else (255, 0, 0)
+        colors = [(255, 255, 255)]
+        for color in list(self.palette.values()) + [default]:
+            if tuple(color[:3]) not in colors:
+                colors.append(tuple(color[:3]))
+        ramp_length = 256 - len(colors)
+        for i in range(ramp_length):
+            grey = int(round(i * 255 / max(1, ramp_length - 1)))
+            if (grey, grey, grey) not in colors:
+                colors.append((grey, grey, grey))
+        return colors
+
+
+    def set_canvas(self, image):
+        """self.draw and self.pixels always need to point at the current self.image"""
+        self.image = image
+        self.draw = canvas_draw(self.image)
         self.pixels = self.image.load()
 
 
@@ -379,7 +748,7 @@ class TileLayout(object):
                 total_padding = total_progress + title_padding + reset_padding + next_segment_length
                 tail = self.levels[i - 1].chunk_size - total_padding % self.levels[i - 1].chunk_size - 1
 
-                return reset_padding, title_padding, tail
+                return reset_padding, int(self.limit_title_padding(title_padding)), tail
 
         return 0, 0, 0
 
@@ -390,19 +759,26 @@ class TileLayout(object):
     def position_on_screen(self, progress):  #Alias for layout: Optimize?
         return self.levels.position_on_screen(progress)
 
+    def positions_on_screen(self, progress):
+        """Alias for layout: batch version of position_on_screen() for numpy arrays"""
+        return self.levels.positions_on_screen(progress)
+
 
     def draw_pixel(self, character, x, y):
         self.pixels[x, y] = self.palette[character]
 
 
     def draw_titles(self):
-        """Calls draw_title() repeatedly"""
+        """Calls draw_title() repeatedly.  With --workers the titles are rasterized in parallel and pasted
+        in order afterwards, see TitleCache.batched()."""
         total_progress = 0
-        for contig in self.contigs:
-            total_progress += contig.reset_padding  # is to move the cursor to the right line for a large title
-            if contig.title_padding > self.title_skip_padding:  # there needs to be room to draw
-                self.draw_title(total_progress, contig)
-            total_progress += contig.title_padding + len(contig.seq) + contig.tail_padding
+        with title_cache.batched(self.workers):
+            for contig in self.contigs:
+                total_progress += contig.reset_padding  # is to move the cursor to the right line for a large title
+                if contig.title_padding > self.title_skip_padding:  # there needs to be room to draw
+                    self.draw_title(total_progress, contig)
+                total_progress += contig.title_padding + len(contig.seq) + contig.tail_padding
+                self.progress.update(total_progress / max(1, self.image_length), contig.name)
 
 
     def draw_title(self, total_progress, contig):
@@ -410,7 +786,8 @@ class TileLayout(object):
         Fonts are precalculated and match the LayoutLevel size. Text becomes rasterized into the image itself and
         is no longer retrievable after this point (would be nice if stored for mouse). Draw_title() is very
         time intensive function because it involves creating a new image canvas, placing it onto the existing large
-        canvas and transferring the pixels. For fragmented assemblies, half or more of the render time is just text."""
+        canvas and transferring the pixels. For fragmented assemblies, half or more of the render time is just text.
+        TitleCache keeps that image down to the pixels the text covers and reuses it for repeated titles."""
 
         upper_left = self.position_on_screen(total_progress)
         bottom_right = self.position_on_screen(total_progress + contig.title_padding - 2)
@@ -448,14 +825,16 @@ class TileLayout(object):
         upper_left = list(upper_left)  # to make it mutable
         font = self.get_font(font_size)
         multi_line_title = pretty_contig_name(text, title_width, title_lines)
-        txt = Image.new('RGBA', (width, height))#, color=(0,0,0,255))
-        bottom_justified = height - multi_line_height(font, multi_line_title, txt)
-        ImageDraw.Draw(txt).multiline_text((0, max(0, bottom_justified)), multi_line_title, font=font,
-                                           fill=color)
         if vertical_label:
-            txt = txt.rotate(90, expand=True)
             upper_left[0] += 8  # adjusts baseline for more polish
-        canvas.paste(txt, (upper_left[0], upper_left[1]), txt)
+
+        def render():
+            text_width, text_height = text_size(font, multi_line_title)
+            bottom_justified = height - text_height
+            return text_bitmap(multi_line_title, font, text_width, width, height, max(0, bottom_justified), color,
+                               rotation=90 if vertical_label else 0)
+        title_cache.paste(canvas, ('title', multi_line_title, font, width, height, vertical_label, color),
+                          render, upper_left)
 
     def get_font(self, font_size):
         """Finding the correct TTF file is an important cross-platform compatibility issue. You're probably looking
@@ -496,6 +875,15 @@ class TileLayout(object):
         # del self.image  # This step saved for finsih_webpage
 
 
+    def deepzoom_source(self):
+        """A canvas that isn't a PIL Image can be tiled directly instead of decoding the PNG again.
+        In memory images are released so their RAM is free for the deepzoom step."""
+        if isinstance(self.image, ArrayCanvas):
+            return self.image
+        self.image, self.draw, self.pixels = None, None, None
+        return self.final_output_location
+
+
     def max_dimensions(self, image_length):
         """ Uses Tile Layout to find the largest chunk size in each dimension (XY) that the
         image_length will reach
@@ -606,6 +994,9 @@ class TileLayout(object):
 
     def contig_struct(self):
         """Each contig has an entry which is used to keep track of its cumulative position on the screen layout."""
+        plan = self.padding_plan
+        if plan is not None and plan.contigs is self.contigs and len(plan) == len(self.contigs):
+            return self.contig_struct_from_plan(plan)
         json = []
         xy_seq_start = 0
         for index, contig in enumerate(self.contigs):
@@ -620,6 +1011,18 @@ class TileLayout(object):
             xy_seq_start += len(contig.seq) + contig.tail_padding
         return json
 
+    def contig_struct_from_plan(self, plan, limit=1001):
+        """contig_struct() with positions taken straight from the PaddingPlan made by calc_all_padding()"""
+        columns = [plan.xy_seq_start, plan.xy_seq_start + plan.lengths, plan.title_padding, plan.tail_padding,
+                   plan.xy_seq_start - plan.title_padding, plan.nuc_title_start, plan.nuc_seq_start]
+        json = []
+        for contig, (start, end, title, tail, title_start, nuc_title, nuc_seq) in zip(
+                self.contigs[:limit], zip(*[column[:limit].tolist() for column in columns])):
+            json.append({"name": contig.name.replace("'", ""), "xy_seq_start": start, "xy_seq_end": end,
+                         "title_padding": title, "tail_padding": tail, "xy_title_start": title_start,
+                         "nuc_title_start": nuc_title, "nuc_seq_start": nuc_seq})
+        return json
+
     def contig_json(self):
         """This method 100% relies on remember_contig_spacing() being called beforehand,
         typically because output_fasta() was called for a webpage"""
@@ -633,36 +1036,27 @@ class TileLayout(object):
 
 
     def get_packed_coordinates(self):
-        """An attempted speed up for draw_nucleotides() that was the same speed.  In draw_nucleotides() the
-        extra code was:
-            coordinates = self.get_packed_coordinates()  # precomputed sets of 100,000
-            seq_consumed = 0
-            columns_batched = 0
-            for column in range(0, seq_length, 100000):
-                if seq_length - column > 100000:
-                    columns_batched += 1
-                    x, y = self.position_on_screen(total_progress)  # only one call per column
-                    for cx, cy, offset in coordinates:
-                        self.draw_pixel(contig.seq[column + offset], x + cx, y + cy)
-                    total_progress += 100000
-                    seq_consumed += 100000
-                else:
-                    pass  # loop will exit and remaining seq will be handled individually
-
-        This method is an optimization that computes all offsets for a column once so they can be reused.
+        """Computes all offsets for a column once so they can be reused.  The original version of this was
+        applied in a Python loop and turned out to be no faster than calling position_on_screen().
+        It now lives on as Layouts.ColumnStencil, which draw_sequence_array() applies with numpy.
         The output looks like this:  (x, y, sequence offset)
         [(0, 0, 0), (1, 0, 1), (2, 0, 2), (3, 0, 3), ... (0, 1, 10), (1, 1, 11), (2, 1, 12), (3, 1, 13),"""
-        line = range(self.levels[0].modulo)
-        column_height = self.levels[1].modulo
-        coords = []
-        for y in range(column_height):
-            coords.extend([(x, y, y * self.levels[0].modulo + x) for x in line])
-        return coords
+        stencil = self.levels.column_stencil()
+        return list(zip(stencil.dx.tolist(), stencil.dy.tolist(), range(stencil.size)))
 
 
     def additional_html_content(self, html_content):
         return {}  # override in children
 
+    def layout_json(self):
+        """Everything needed to map pixels back to sequence, as a dict that json.dumps() accepts: image size,
+        the layout levels of each genome and where each contig starts (first 1001 contigs, like the webpage)."""
+        width, height = self.image.size if self.image is not None else self.max_dimensions(self.image_length)
+        return {"width": width, "height": height,
+                "layout_algorithm": self.layout_algorithm,
+                "each_layout": [layout.to_json() for layout in self.each_layout],
+                "contigs": self.contig_struct()}
+
     def all_layouts_json(self):
         records = []
         for i, layout in enumerate(self.each_layout):
@@ -672,13 +1066,14 @@ class TileLayout(object):
     def remember_contig_spacing(self):
         self.contig_memory.append(self.contig_struct())
 
-    def find_layout_height_by_chromosomes(self):
+    def find_layout_height_by_chromosomes(self, lengths=None):
         """Set the number of mega-rows and the height of the layout.
         Returns a new layout based on the current fasta file."""
         if self.using_custom_layout:
             return self.levels
-        lengths = [len(c.seq) for c in self.contigs]
-        sum_length, biggest_chromosome = sum(lengths), max(lengths)
+        if lengths is None:
+            lengths = [len(c.seq) for c in self.contigs]
+        sum_length, biggest_chromosome = int(np.sum(lengths)), int(np.max(lengths))
         nMegaRows = math.ceil(biggest_chromosome / self.megarow_label_size)
 
         mRow_pixel_height = self.levels[1].modulo # approx. how tall is one mega row?
@@ -696,6 +1091,30 @@ class TileLayout(object):
                                     [l.padding for l in self.levels],
                                     self.levels.origin)
 
+forked_layout = None  # (layout, canvas, lookup) inherited by draw_nucleotides_in_workers() processes
+
+
+def draw_job_in_worker(job):
+    """Runs in a forked worker. Draws one piece of a contig from nucleotide_jobs() into the shared canvas."""
+    layout, canvas, lookup = forked_layout
+    contig_index, start, stop, progress = job
+    seq = layout.contigs[contig_index].seq
+    codes = encode_sequence(seq.read_bytes(start, stop) if isinstance(seq, StreamedSequence) else seq[start:stop])
+    layout.draw_sequence_array(canvas.array, lookup, codes, progress)
+    return contig_index
+
+
+def encode_sequence(seq):
+    """Converts a contig sequence into a uint8 array of character codes, one byte per nucleotide.
+    Characters outside of latin-1 can't be looked up in a 256 entry palette so they become '?',
+    which is drawn in the default palette color just like any other unknown character."""
+    if isinstance(seq, StreamedSequence):
+        seq = seq.read_bytes()
+    if isinstance(seq, (bytes, bytearray)):  # binary files read by using_spectrum and streamed blocks
+        return np.frombuffer(seq, dtype=np.uint8)
+    return np.frombuffer(str(seq).encode('latin-1', 'replace'), dtype=np.uint8)
+
+
 def write_contigs_to_chunks_dir(project_dir, fasta_name, contigs):
     """In order to display the exact sequence under the mouse we need to send the sequence file to the client
     machine over the web. Rather than sending them chr1 (240MB). We chunk the file into 1MB chunks and store
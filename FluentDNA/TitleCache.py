@@ -0,0 +1,168 @@
+"""Rasterized titles and labels for write_title() and LayoutFrame.write_label().
+Both used to draw into a new RGBA image the size of the whole title box and paste all of it, even though
+the text only covers the left part of the box.  The transparent remainder never changes the canvas, so
+text is drawn into an image only as wide as the text (after rotation: only as tall).  That is the same
+pixels for a fraction of the allocation and paste, which matters most for the huge chromosome titles and
+for canvases, where every paste reads and writes back the region it covers.
+Finished bitmaps are kept by everything that changes their pixels, so names that repeat (parallel
+genomes, gene labels, alignment headers) are only rasterized once.
+Inside batched() the bitmaps are rasterized by a pool of forked processes (--workers), the main process
+only pastes them onto the canvas, in the same order as they would have been drawn one at a time."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from PIL import Image, ImageDraw
+
+from FluentDNA.FluentDNAUtils import font_descender
+from FluentDNA.RunReport import fork_pool
+
+
+class TitleCache(object):
+    """Bitmaps by key, least recently used are dropped once they take more than memory_budget bytes.
+    Each entry is (RGBA image or None, dx, dy) where (dx, dy) is the offset from the title's upper left."""
+    def __init__(self, memory_budget=64 * 1024 ** 2):
+        self.memory_budget = memory_budget
+        self.bitmaps = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.batch = None  # (canvas, key, render, upper_left) queued by paste() inside batched()
+
+    def get(self, key, render):
+        entry = self.bitmaps.get(key)
+        if entry is not None:
+            self.bitmaps.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return self.store(key, render())
+
+    def store(self, key, entry):
+        size = entry_bytes(entry)
+        if size <= self.memory_budget // 4:  # one giant title shouldn't flush everything else
+            self.bitmaps[key] = entry
+            self.cached_bytes += size
+            while self.cached_bytes > self.memory_budget:
+                _, dropped = self.bitmaps.popitem(last=False)
+                self.cached_bytes -= entry_bytes(dropped)
+        return entry
+
+    def paste(self, canvas, key, render, upper_left):
+        """Pastes the bitmap for key onto canvas (PIL Image or ArrayCanvas), calling render() if it isn't cached.
+        Inside batched() it is only queued."""
+        if self.batch is not None:
+            self.batch.append((canvas, key, render, tuple(upper_left)))
+            return
+        paste_entry(canvas, self.get(key, render), upper_left)
+
+    @contextmanager
+    def batched(self, workers):
+        """Queues every paste() in the with block, then rasterizes them in workers processes and pastes
+        them in order.  Only use it around code that does nothing to the canvas except write text, since the
+        text lands after everything else.  Without fork or extra workers it pastes immediately as usual."""
+        if self.batch is not None or workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            yield
+            return
+        self.batch = []
+        try:
+            yield
+            batch = self.batch
+        finally:
+            self.batch = None
+        self.paste_in_workers(batch, workers)
+
+    def paste_in_workers(self, batch, workers, window=256):
+        """Goes through the batch a window at a time so only one window of bitmaps is waiting to be pasted.
+        Workers inherit the batch from the fork, so render() closures never need to be pickled.
+        A key that's already cached or repeated in the window is only rendered once."""
+        global forked_batch
+        forked_batch = batch
+        try:
+            pool = fork_pool(workers)
+            try:
+                for start in range(0, len(batch), window):
+                    first = OrderedDict()  # key: batch index that renders it
+                    for i in range(start, min(len(batch), start + window)):
+                        key = batch[i][1]
+                        if key not in self.bitmaps and key not in first:
+                            first[key] = i
+                    rendered = dict(zip(first.values(), pool.map(render_in_worker, list(first.values()), 1)))
+                    for i in range(start, min(len(batch), start + window)):
+                        canvas, key, render, upper_left = batch[i]
+                        if i in rendered:
+                            self.misses += 1
+                            entry = self.store(key, rendered.pop(i))
+                        else:
+                            entry = self.get(key, render)  # also covers a repeat too big to be cached
+                        paste_entry(canvas, entry, upper_left)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            forked_batch = None
+
+    def clear(self):
+        self.bitmaps.clear()
+        self.cached_bytes = 0
+
+
+def paste_entry(canvas, entry, upper_left):
+    image, dx, dy = entry
+    if image is not None:
+        canvas.paste(image, (upper_left[0] + dx, upper_left[1] + dy), image)
+
+
+forked_batch = None  # queued pastes inherited by paste_in_workers() processes
+
+
+def render_in_worker(index):
+    """Runs in a forked worker.  Rasterizes one queued title, the image is pickled back to the main process."""
+    return forked_batch[index][2]()
+
+
+def entry_bytes(entry):
+    image = entry[0]
+    return 0 if image is None else image.width * image.height * 4
+
+
+title_cache = TitleCache()  # shared by every layout, keys include the font object so they can't collide
+measuring_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+
+def text_size(font, text):
+    """(width, height) of multiline text, height includes the descender like multi_line_height()"""
+    width, sum_line_spacing = measuring_draw.multiline_textsize(text, font)
+    return width, sum_line_spacing + font_descender(font)
+
+
+def text_bitmap(text, font, text_width, width, height, top, color, rotation=0):
+    """Text drawn at (0, top) in a width x height box, then rotated by 90 or -90 with expand like Image.rotate().
+    Returns (image, dx, dy) where image is cropped to the pixels the text actually covers and (dx, dy) is where
+    it goes relative to the box.  Left aligned text never reaches past its width from text_size().
+    Big opaque black titles are drawn as an 'L' mask and merged into RGBA: the same pixels as drawing into
+    RGBA, but PIL's single band drawing is many times faster.  Small ones are quicker drawn directly."""
+    text_width = min(width, text_width)
+    if text_width <= 0 or height <= 0:
+        return None, 0, 0
+    if text_width * height > 128 * 128 and tuple(color) in [(0, 0, 0), (0, 0, 0, 255)]:
+        mask = Image.new('L', (text_width, height))
+        ImageDraw.Draw(mask).multiline_text((0, top), text, font=font, fill=255)
+        black = Image.new('L', mask.size)
+        txt = Image.merge('RGBA', (black, black, black, mask))
+    else:
+        txt = Image.new('RGBA', (text_width, height))
+        ImageDraw.Draw(txt).multiline_text((0, top), text, font=font, fill=color)
+    dx, dy = 0, 0
+    if rotation:
+        txt = txt.rotate(rotation, expand=True)
+        if rotation == 90:  # counter clockwise, the left of the box becomes the bottom
+            dy = width - text_width
+    bbox = txt.getbbox()
+    if bbox is None:
+        return None, 0, 0
+    return txt.crop(bbox), dx + bbox[0], dy + bbox[1]
@@ -16,7 +16,6 @@ import traceback
 
 from DNASkittleUtils.DDVUtils import editable_str
 from collections import defaultdict
-from datetime import datetime
 
 from DNASkittleUtils.Contigs import Contig, read_contigs
 from DNASkittleUtils.DDVUtils import rev_comp
@@ -35,6 +34,7 @@ class TransposonLayout(TileLayout):
         self.repeat_entries = None
         self.current_column_height = 20
         self.next_origin = [self.border_width, 30] # margin for titles, incremented each MSA
+        self.draws_by_pixel = True
 
 
 
@@ -48,21 +48,19 @@ class TransposonLayout(TileLayout):
 
     def process_all_repeats(self, ref_fasta, output_folder, output_file_name, repeat_annotation_filename, chromosomes=None):
         self.levels.origin = (self.levels.origin[0], self.levels.origin[1] + self.levels[5].padding)  # One full Row of padding for Title
-        start_time = datetime.now()
-        self.read_all_files(ref_fasta, repeat_annotation_filename, chromosomes)
+        with self.phase('read'):
+            self.read_all_files(ref_fasta, repeat_annotation_filename, chromosomes)
 
-        print("Read contigs :", datetime.now() - start_time)
-
-        self.initialize_image_by_sequence_dimensions()
-        print("Initialized Image:", datetime.now() - start_time, "\n")
+        with self.phase('image allocation'):
+            self.initialize_image_by_sequence_dimensions()
         try:  # These try catch statements ensure we get at least some output.  These jobs can take hours
-            self.draw_nucleotides()
-            print("\nDrew Nucleotides:", datetime.now() - start_time)
+            with self.phase('nucleotides'):
+                self.draw_nucleotides()
         except Exception as e:
             print('Encountered exception while drawing nucleotides:', '\n')
             traceback.print_exc()
-        self.output_image(output_folder, output_file_name, False)
-        print("Output Image in:", datetime.now() - start_time)
+        with self.phase('png'):
+            self.output_image(output_folder, output_file_name, False)
         copy_to_sources(output_folder, ref_fasta)
         copy_to_sources(output_folder, repeat_annotation_filename)
 
@@ -0,0 +1,148 @@
+"""Deterministic synthetic genomes for benchmarking.  The same (total_bp, n_scaffolds, seed) always writes
+byte identical files, so timings from different commits are measured on the same input.
+Scaffold lengths are log-normal like a real assembly and sorted longest first.  Sequence is uniform random ACGT,
+genes have an mRNA, exons and CDS, and the chain file aligns each reference scaffold to the query scaffold
+of the same length with randomly sized blocks and gaps."""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import os
+import random
+
+import numpy as np
+
+
+def scaffold_lengths(total_bp, n_scaffolds, seed=0):
+    """n_scaffolds log-normal lengths that add up to exactly total_bp, longest first"""
+    n_scaffolds = max(1, min(n_scaffolds, total_bp))
+    weights = np.random.RandomState(seed).lognormal(0, 1.5, n_scaffolds)
+    lengths = np.maximum(1, (weights / weights.sum() * total_bp).astype(np.int64))
+    lengths.sort()
+    lengths = lengths[::-1]
+    lengths[0] += total_bp - lengths.sum()  # rounding, can't go below 1 since the longest is > average
+    return [int(x) for x in lengths]
+
+
+def write_sequence(handle, rng, length, line_width=60, chunk_lines=65536):
+    """Writes length random bases as FASTA lines, a chunk at a time so memory stays flat for any genome size"""
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    remaining = length
+    while remaining > 0:
+        n = min(remaining, line_width * chunk_lines)
+        chunk = bases[rng.randint(0, 4, n, dtype=np.uint8)]
+        full_lines = n // line_width
+        lines = np.empty((full_lines, line_width + 1), dtype=np.uint8)
+        lines[:, :line_width] = chunk[:full_lines * line_width].reshape(full_lines, line_width)
+        lines[:, line_width] = ord('\n')
+        handle.write(lines.tobytes())
+        if n % line_width:  # only the last chunk has a partial line
+            handle.write(chunk[full_lines * line_width:].tobytes() + b'\n')
+        remaining -= n
+
+
+def write_fasta(path, names, lengths, seed=0):
+    rng = np.random.RandomState(seed)
+    with open(path, 'wb') as fasta:
+        for name, length in zip(names, lengths):
+            fasta.write(b'>' + name.encode() + b'\n')
+            write_sequence(fasta, rng, length)
+    return path
+
+
+def write_gff(path, names, lengths, genes_per_mbp=20, seed=0):
+    """GFF3 with gene, mRNA, exon and CDS features.  Genes are 1-20kbp and never overlap on a scaffold.
+    Returns the number of genes."""
+    rng = random.Random(seed)
+    gene_count = 0
+    with open(path, 'w') as gff:
+        gff.write('##gff-version 3\n')
+        for name, length in zip(names, lengths):
+            n_genes = int(length * genes_per_mbp / 1e6 + rng.random())  # short scaffolds get one sometimes
+            if n_genes == 0 or length < 2000:
+                continue
+            slot = length // n_genes
+            for i in range(n_genes):
+                gene_length = min(slot - 1, rng.randint(1000, 20000))
+                if gene_length < 100:
+                    break
+                start = i * slot + 1 + rng.randint(0, slot - gene_length - 1)
+                end = start + gene_length - 1
+                strand = rng.choice('+-')
+                gene_count += 1
+                gene_id = 'gene%i' % gene_count
+                mrna_id = 'mRNA%i' % gene_count
+                gff.write('%s\tsynthetic\tgene\t%i\t%i\t.\t%s\t.\tID=%s;Name=SYN%i\n' %
+                          (name, start, end, strand, gene_id, gene_count))
+                gff.write('%s\tsynthetic\tmRNA\t%i\t%i\t.\t%s\t.\tID=%s;Parent=%s\n' %
+                          (name, start, end, strand, mrna_id, gene_id))
+                n_exons = rng.randint(2, 8)
+                exon_length = gene_length // (2 * n_exons)
+                for e in range(n_exons):
+                    exon_start = start + e * 2 * exon_length
+                    exon_end = exon_start + exon_length - 1
+                    for feature in ['exon', 'CDS']:
+                        gff.write('%s\tsynthetic\t%s\t%i\t%i\t.\t%s\t%s\tID=%s.%s%i;Parent=%s\n' %
+                                  (name, feature, exon_start, exon_end, strand, '0' if feature == 'CDS' else '.',
+                                   mrna_id, feature, e + 1, mrna_id))
+    return gene_count
+
+
+def write_chain(path, ref_names, query_names, lengths, seed=0):
+    """One '+' strand chain per scaffold pair in UCSC format: blocks of "size dt dq" then the last size.
+    Gaps alternate between reference and query so both ends stay inside the scaffolds."""
+    rng = random.Random(seed)
+    with open(path, 'w') as chain:
+        for chain_id, (ref, query, length) in enumerate(zip(ref_names, query_names, lengths)):
+            if length < 1000:
+                continue
+            blocks, t, q = [], 0, 0
+            while True:
+                size = rng.randint(50, 5000)
+                dt, dq = (rng.randint(0, 200), 0) if len(blocks) % 2 else (0, rng.randint(0, 200))
+                if max(t, q) + size + max(dt, dq) + 5050 > length:
+                    size = length - max(t, q)  # the final block reaches the end of the shorter remainder
+                    blocks.append((size,))
+                    t, q = t + size, q + size
+                    break
+                blocks.append((size, dt, dq))
+                t, q = t + size + dt, q + size + dq
+            score = sum(block[0] for block in blocks) * 90
+            chain.write('chain %i %s %i + 0 %i %s %i + 0 %i %i\n' %
+                        (score, ref, length, t, query, length, q, chain_id + 1))
+            for block in blocks:
+                chain.write('\t'.join(str(x) for x in block) + '\n')
+            chain.write('\n')
+    return path
+
+
+class SyntheticGenome(object):
+    """File paths of one generated reference genome, its annotation, a query genome and the chain between them.
+    generate() only writes files that aren't already in the directory, so a benchmark directory can be reused."""
+    def __init__(self, directory, total_bp, n_scaffolds, seed=0, genes_per_mbp=20):
+        self.total_bp = total_bp
+        self.lengths = scaffold_lengths(total_bp, n_scaffolds, seed)
+        self.names = ['scaffold_%i' % (i + 1) for i in range(len(self.lengths))]
+        self.query_names = ['query_%i' % (i + 1) for i in range(len(self.lengths))]
+        self.seed = seed
+        self.genes_per_mbp = genes_per_mbp
+        prefix = os.path.join(directory, 'synthetic_%i_%i_%i' % (total_bp, len(self.lengths), seed))
+        self.fasta = prefix + '.fa'
+        self.query_fasta = prefix + '_query.fa'
+        self.gff = prefix + '_genes%i.gff' % genes_per_mbp
+        self.chain = prefix + '.chain'
+
+    def generate(self):
+        if not os.path.exists(os.path.dirname(self.fasta)):
+            os.makedirs(os.path.dirname(self.fasta))
+        for path, write in [(self.fasta, lambda p: write_fasta(p, self.names, self.lengths, self.seed)),
+                            (self.query_fasta, lambda p: write_fasta(p, self.query_names, self.lengths,
+                                                                     self.seed + 1)),
+                            (self.gff, lambda p: write_gff(p, self.names, self.lengths, self.genes_per_mbp,
+                                                           self.seed)),
+                            (self.chain, lambda p: write_chain(p, self.names, self.query_names, self.lengths,
+                                                               self.seed))]:
+            if not os.path.exists(path):
+                print("Generating", path)
+                write(path + '.partial')
+                os.rename(path + '.partial', path)  # an interrupted run doesn't leave a truncated file
+        return self
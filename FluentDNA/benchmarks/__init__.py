@@ -0,0 +1,3 @@
+"""Performance benchmarks for FluentDNA.  SyntheticGenome writes deterministic FASTA, GFF and chain files of any
+size, run_benchmarks times the hot paths on them and saves the results as JSON so commits can be compared:
+python -m FluentDNA.benchmarks.run_benchmarks --scales 1Mbp 10Mbp-1k --output before.json"""
@@ -0,0 +1,242 @@
+"""Times the FluentDNA hot paths on synthetic genomes at several scales and saves the results as JSON.
+Each hot path is one RunReport phase, so every result has wall and CPU seconds, bytes read and written and
+peak RSS.  Setup that isn't being measured (reading the FASTA, finding annotated regions) is timed too,
+under a name in parentheses.  A hot path that fails is recorded with "error": true and the rest still run.
+
+python -m FluentDNA.benchmarks.run_benchmarks --scales 1Mbp 10Mbp-1k --output before.json
+python -m FluentDNA.benchmarks.run_benchmarks --scales 1Mbp 10Mbp-1k --compare before.json
+Start up time of the command line is measured too, in fresh interpreters: importing fluentdna and running
+fluentdna --version shouldn't load numpy, PIL or any Layout.
+"""
+from __future__ import print_function, division, absolute_import, \
+    with_statement, generators, nested_scopes
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+
+from DNASkittleUtils.Contigs import read_contigs
+
+from FluentDNA import VERSION
+from FluentDNA.Annotations import create_fasta_from_annotation
+from FluentDNA.benchmarks.SyntheticGenome import SyntheticGenome
+from FluentDNA.ChainParser import ChainParser
+from FluentDNA.FluentDNAUtils import create_deepzoom_stack
+from FluentDNA.HighlightedAnnotation import HighlightedAnnotation, outlines
+from FluentDNA.Ideogram import IdeogramCoordinateFrame
+from FluentDNA.RunReport import RunReport
+from FluentDNA.TileLayout import TileLayout
+
+# name: (total bp, scaffolds).  The first two are the default, the rest need minutes to hours and lots of RAM.
+SCALES = OrderedDict([('1Mbp', (10 ** 6, 1)),
+                      ('10Mbp-1k', (10 ** 7, 1000)),
+                      ('100Mbp-10', (10 ** 8, 10)),
+                      ('100Mbp-1M', (10 ** 8, 10 ** 6)),
+                      ('1Gbp-100', (10 ** 9, 100))])
+HOT_PATHS = ['calc_all_padding', 'draw_nucleotides', 'draw_titles', 'create_deepzoom_stack',
+             'ChainParser.parse_chain', 'create_fasta_from_annotation', 'outlines',
+             'IdeogramCoordinateFrame.build_coordinate_mapping']
+ideogram_radix = ([3, 3, 3, 3, 3, 27], [5, 3, 3, 3, 3, 3, 53])  # the ideogram example from the README
+heavy_modules = ['numpy', 'PIL', 'DNASkittleUtils', 'natsort', 'psutil', 'FluentDNA.TileLayout']
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(report, name, function, *args):
+    """Runs function(*args) as one phase.  Errors are printed and recorded, the next hot path still runs."""
+    try:
+        with report.phase(name):
+            return function(*args)
+    except Exception:
+        print("Benchmark", name, "failed:")
+        traceback.print_exc()
+        return None
+
+
+def render(report, genome, output_dir, options):
+    """The TileLayout steps of a normal run: padding, nucleotides, titles, then deep zoom from the result"""
+    layout = TileLayout()
+    layout.render_mode = options.render_mode
+    layout.workers = options.workers
+    layout.canvas_dir = output_dir
+    layout.report = report
+    layout.contigs = measure(report, '(read fasta)', read_contigs, genome.fasta)
+    layout.image_length = measure(report, 'calc_all_padding', layout.calc_all_padding)
+    measure(report, '(prepare_image)', layout.prepare_image, layout.image_length)
+    measure(report, 'draw_nucleotides', layout.draw_nucleotides)
+    measure(report, 'draw_titles', layout.draw_titles)
+    measure(report, '(png)', layout.output_image, output_dir, 'benchmark', True)
+    source = layout.deepzoom_source()
+    layout.contigs = []
+    layout.image = None
+    measure(report, 'create_deepzoom_stack', create_deepzoom_stack, source,
+            os.path.join(output_dir, 'GeneratedImages', 'dzc_output.xml'), options.workers, options.tile_archive)
+    if hasattr(source, 'close'):
+        source.close()
+
+
+def parse_chain(genome, output_dir):
+    parser = ChainParser(chain_name=genome.chain, first_source=genome.fasta, second_source=genome.query_fasta,
+                         output_prefix=os.path.join(output_dir, 'chain_'), extract_contigs=genome.names[:1])
+    return parser.parse_chain(genome.names[:1])
+
+
+def annotation_outline_points(layout, genome):
+    """Points of every gene on the longest scaffold and the size of the markup image they're drawn on,
+    the same way HighlightedAnnotation.draw_annotation_layer() gets them"""
+    layout.contigs = read_contigs(genome.fasta)[:1]
+    layout.calc_all_padding()
+    coordinate_frame = layout.contig_struct()[0]
+    regions = layout.find_annotated_regions(layout.annotation, genome.names[0], coordinate_frame["title_padding"])
+    union = set()
+    for region in regions:
+        union.update(region.points)
+    width = max(p[0] for p in union) + 2 * layout.border_width if union else 0
+    height = max(p[1] for p in union) + 2 * layout.border_width if union else 0
+    return union, width, height
+
+
+def annotation(report, genome):
+    layout = measure(report, '(parse gff)', HighlightedAnnotation, genome.gff)
+    if layout is None:
+        return
+    measure(report, 'create_fasta_from_annotation', create_fasta_from_annotation, layout.annotation,
+            genome.names, genome.lengths)
+    points = measure(report, '(annotation points)', annotation_outline_points, layout, genome)
+    if points is not None:
+        union, width, height = points
+        measure(report, 'outlines', outlines, union, layout.border_width, width + 1, height + 1)
+
+
+def ideogram(report, genome):
+    """Ideogram only draws the first contig, so the mapping is built for the longest scaffold"""
+    frame = IdeogramCoordinateFrame(ideogram_radix[0], ideogram_radix[1], 1, 1, 12)
+    measure(report, 'IdeogramCoordinateFrame.build_coordinate_mapping', frame.build_coordinate_mapping,
+            genome.lengths[0])
+
+
+def startup(repeat=5):
+    """Best of repeat wall seconds for fresh interpreters to start, import fluentdna and run fluentdna --version,
+    plus any heavy_modules the import loaded"""
+    package_parent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([package_parent, os.environ.get('PYTHONPATH', '')]))
+    fluentdna = os.path.join(package_parent, 'FluentDNA', 'fluentdna.py')
+    commands = OrderedDict([('python', [sys.executable, '-c', 'pass']),
+                            ('import fluentdna', [sys.executable, '-c', 'import FluentDNA.fluentdna']),
+                            ('fluentdna --version', [sys.executable, fluentdna, '--version'])])
+    result = OrderedDict()
+    for name, command in commands.items():
+        best = None
+        for i in range(repeat):
+            start = time.time()
+            subprocess.check_call(command, env=env, stdout=subprocess.DEVNULL)
+            best = min(best or float('inf'), time.time() - start)
+        result[name] = round(best, 4)
+        print("Startup %s: %.3fs" % (name, best))
+    loaded = subprocess.check_output([sys.executable, '-c', 'import sys, FluentDNA.fluentdna; print(" ".join('
+                                      'm for m in sys.modules if m in %r))' % heavy_modules], env=env)
+    result['heavy modules'] = loaded.decode().splitlines()[-1].split()  # fluentdna prints where it's running first
+    if result['heavy modules']:
+        print("WARNING: importing fluentdna loads", result['heavy modules'])
+    return result
+
+
+def run_scale(name, options):
+    total_bp, n_scaffolds = SCALES[name]
+    print("=== Benchmark %s: %i bp in %i scaffolds ===" % (name, total_bp, n_scaffolds))
+    genome = SyntheticGenome(options.data_dir, total_bp, n_scaffolds, seed=options.seed).generate()
+    report = RunReport(options.trace_memory)
+    output_dir = tempfile.mkdtemp(prefix='benchmark_', dir=options.data_dir)
+    try:
+        if set(HOT_PATHS[:4]).intersection(options.paths):
+            render(report, genome, output_dir, options)
+        if 'ChainParser.parse_chain' in options.paths:
+            measure(report, 'ChainParser.parse_chain', parse_chain, genome, output_dir)
+        if 'create_fasta_from_annotation' in options.paths or 'outlines' in options.paths:
+            annotation(report, genome)
+        if 'IdeogramCoordinateFrame.build_coordinate_mapping' in options.paths:
+            ideogram(report, genome)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    result = report.as_dict('benchmark')
+    result.update({'scale': name, 'total_bp': total_bp, 'scaffolds': len(genome.lengths), 'seed': options.seed})
+    del result['command']  # it's saved once for the whole run
+    return result
+
+
+def compare(results, baseline_path):
+    """Prints the ratio of each hot path's wall time to the same scale and path in a previous results file"""
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    before = {(scale['scale'], phase): total['wall_seconds']
+              for scale in baseline['scales'] for phase, total in scale['totals'].items()}
+    print("%-12s %-50s %10s %10s %8s" % ('scale', 'hot path', 'before', 'after', 'ratio'))
+    for name, seconds in results['startup'].items():
+        old = baseline.get('startup', {}).get(name)
+        if isinstance(seconds, float) and old:
+            print("%-12s %-50s %9.3fs %9.3fs %7.2fx" % ('startup', name, old, seconds, seconds / old))
+    for scale in results['scales']:
+        for phase, total in scale['totals'].items():
+            old = before.get((scale['scale'], phase))
+            if old is None or phase.startswith('('):
+                continue
+            print("%-12s %-50s %9.3fs %9.3fs %7.2fx" % (scale['scale'], phase, old, total['wall_seconds'],
+                                                       total['wall_seconds'] / old if old else float('inf')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times FluentDNA hot paths on synthetic genomes.")
+    parser.add_argument('--scales', nargs='+', default=list(SCALES)[:2], choices=list(SCALES),
+                        help="Genome sizes to run, default %(default)s")
+    parser.add_argument('--paths', nargs='+', default=HOT_PATHS, choices=HOT_PATHS,
+                        help="Hot paths to time, default all of them")
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help="JSON file for the results")
+    parser.add_argument('--compare', default=None,
+                        help="Results JSON from an earlier commit to print the ratios against")
+    parser.add_argument('--data_dir', default=os.path.join(tempfile.gettempdir(), 'fluentdna_benchmarks'),
+                        help="Where synthetic genomes are generated and kept between runs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--render_mode', default='memory', choices=['memory', 'tiled', 'memmap'],
+                        help="Canvas storage for draw_nucleotides, same as fluentdna --render_mode")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Processes for draw_nucleotides, titles and deep zoom, same as fluentdna --workers")
+    parser.add_argument('--tile_archive', action='store_true',
+                        help="Deep zoom into one archive file, same as fluentdna --tile_archive")
+    parser.add_argument('--trace_memory', action='store_true',
+                        help="Also record tracemalloc peaks, slows everything down")
+    options = parser.parse_args()
+
+    results = {'started': datetime.now().isoformat(),
+               'version': VERSION,
+               'commit': git_commit(),
+               'python': sys.version.split()[0],
+               'platform': platform.platform(),
+               'cpus': os.cpu_count(),
+               'command': sys.argv,
+               'startup': startup(),
+               'scales': [run_scale(name, options) for name in options.scales]}
+    with open(options.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    print("Benchmark results saved to", options.output)
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -36,30 +36,25 @@
 #===============================================================================
 
 
+import io
 import math
+import mmap
+import multiprocessing
 import optparse
 import os
+import shutil
+from collections import deque
+import numpy as np
 from PIL import Image as PILImage
 import sys
 import xml.dom.minidom
 
-# Monkey Patch: Sets a much larger size to avoid the DecompressionBombWarning that
-# scares users.  FluentDNA will suck up a lot of RAM, but especially on clusters,
-# this warning shouldn't go off all the time.  I've been able to reliably generate
-# 3GB images on my laptop with 32GB of RAM.  Larger HPC should be able to handle
-# more.  Further handling for gauging system resources would be helpful.
-PILImage.MAX_IMAGE_PIXELS = 10 * 1024 * 1024 * 1024  # 10GB
+from FluentDNA.Canvas import PNGRows
+from FluentDNA.RunReport import fork_pool
+from FluentDNA.TileArchive import TileArchiveWriter, archive_path
 
 NS_DEEPZOOM = "http://schemas.microsoft.com/deepzoom/2008"
 
-resize_filter_map = {
-    "cubic": PILImage.CUBIC,
-    "bilinear": PILImage.BILINEAR,
-    "bicubic": PILImage.BICUBIC,
-    "nearest": PILImage.NEAREST,
-    "antialias": PILImage.ANTIALIAS,
-    }
-
 image_format_map = {
     "jpg": "jpg",
     "png": "png",
@@ -154,6 +149,13 @@ class DZIDescriptor(object):
 
         return (x, y, x + w, y + h)
 
+    def get_edge_coverage(self, level):
+        """FluentDNA: Fraction of the last column and row of a level that is image.  Level sizes are rounded up,
+        so the edge pixels of a smaller level stand for less of the image than the others."""
+        scale = self.get_scale(level)
+        width, height = self.get_dimensions(level)
+        return self.width * scale - (width - 1), self.height * scale - (height - 1)
+
 
 class Image(object):
     """Represents a Deep Zoom image."""
@@ -169,36 +171,50 @@ class Image(object):
 class ImageCreator(object):
     """Creates Deep Zoom images."""
     def __init__(self, tile_size=256, tile_overlap=1, tile_format="jpg",
-                 image_quality=0.95, resize_filter=None):
+                 image_quality=0.95, workers=1, archive=False):
         self.tile_size = int(tile_size)
+        self.workers = workers  # FluentDNA: processes encoding tiles, see start_workers()
         self.tile_format = tile_format
         self.tile_overlap = _clamp(int(tile_overlap), 0, 10)
         self.image_quality = _clamp(image_quality, 0, 1.0)
         if not tile_format in image_format_map:
             self.tile_format = "jpg"
-        self.resize_filter = resize_filter
+        self.pool = None
+        self.archive = archive  # FluentDNA: one TileArchive file instead of a file per tile
+        self.archive_writer = None
+        self.rows = None  # FluentDNA: the Canvas.PNGRows create() reads a PNG source with
+        self.palette = None  # FluentDNA: of a 'P' source, for full size tiles
 
     def get_image(self, level):
-        """Returns the bitmap image at the given level."""
+        """Returns the bitmap image at the given level.
+        FluentDNA: Smaller levels are halved from the level above them, the same pixels create() writes.
+        A 2x2 box average is the only filter, so the resize_filter option is gone.
+        create() doesn't use this, it streams the image through all the levels at once."""
         assert 0 <= level and level < self.descriptor.num_levels, "Invalid pyramid level"
         width, height = self.descriptor.get_dimensions(level)
         # don't transform to what we already have
         if self.descriptor.width == width and self.descriptor.height == height:
             return self.image
-        if (self.resize_filter is None) or (self.resize_filter not in resize_filter_map):
-            return self.image.resize((width, height), PILImage.ANTIALIAS)
-        return self.image.resize((width, height), resize_filter_map[self.resize_filter])
+        image = self.image.halved() if hasattr(self.image, 'halved') else halve(self.image)
+        for larger in reversed(range(level + 1, self.descriptor.num_levels - 1)):
+            image = halve(image, *self.descriptor.get_edge_coverage(larger))
+        return image
 
     def tiles(self, level):
         """Iterator for all tiles in the given level. Returns (column, row) of a tile."""
         columns, rows = self.descriptor.get_num_tiles(level)
-        for column in range(columns):
-            for row in range(rows):
+        for row in range(rows):
+            for column in range(columns):
                 yield (column, row)
 
     def create(self, source, destination):
-        """Creates Deep Zoom image from source file and saves it to destination."""
-        self.image = PILImage.open(source)
+        """Creates Deep Zoom image from source file and saves it to destination.
+        source can also be an open image or a canvas (Canvas.ArrayCanvas).
+        FluentDNA: The image is read in bands of tile_size rows and streamed through a PyramidLevel for
+        every level at once, so memory is a few rows of tiles per level.  A canvas is read straight from
+        its storage and a PNG file a band at a time by Canvas.PNGRows.  Other files are decoded whole."""
+        self.image = open_image(source) if isinstance(source, str) else source
+        self._uniform_tiles, self._tile_paths = {}, {}
         width, height = self.image.size
         self.descriptor = DZIDescriptor(width=width,
                                         height=height,
@@ -208,27 +224,303 @@ class ImageCreator(object):
         destination = _expand(destination)
         image_name = os.path.splitext(os.path.basename(destination))[0]
         dir_name = os.path.dirname(destination)
-        image_files = _ensure(os.path.join(_ensure(dir_name), "%s_files"%image_name))
-
-        # Create tiles
+        image_files = os.path.join(_ensure(dir_name), "%s_files"%image_name)
+        if self.archive:  # the server prefers tile files, so tiles from an earlier run have to go
+            if os.path.isdir(image_files):
+                shutil.rmtree(image_files)
+            self.archive_writer = TileArchiveWriter(archive_path(destination))
+        else:
+            if os.path.exists(archive_path(destination)):
+                os.remove(archive_path(destination))
+            _ensure(image_files)
+            self.level_dirs = [_ensure(os.path.join(image_files, str(level)))
+                               for level in range(self.descriptor.num_levels)]
+        self.source_mode, self.pixel_mode = band_modes(self.image)
+        self.rows = PNGRows.open(source) if isinstance(source, str) else None
+        self.palette = None
+        if self.rows is not None:
+            self.palette = self.rows.palette
+        elif isinstance(self.image, PILImage.Image):
+            self.image.load()  # once, before workers fork with the same file handle
+            self.palette = self.image.getpalette() if self.image.mode == 'P' else None
+
+        # Create tiles, all levels at once from the top of the image down
+        pyramid = None
         for level in range(self.descriptor.num_levels):
-            level_dir = _ensure(os.path.join(image_files, str(level)))
-            level_image = self.get_image(level)
-            for (column, row) in self.tiles(level):
-                bounds = self.descriptor.get_tile_bounds(level, column, row)
-                tile = level_image.crop(bounds)
-                format = self.descriptor.tile_format
-                tile_path = os.path.join(level_dir,
-                                         "%s_%s.%s"%(column, row, format))
-                tile_file = open(tile_path, "wb")
-                if self.descriptor.tile_format == "jpg":
-                    tile.save(tile_file, "JPEG",
-                              quality=int(self.image_quality * 100))
-                else:
-                    tile.save(tile_file, self.descriptor.tile_format)
+            pyramid = PyramidLevel(self, level, pyramid)
+        try:
+            self.start_workers()
+            for y in range(0, height, self.tile_size):
+                pyramid.push(*self.read_band(y, min(height, y + self.tile_size)))
+            self.stop_workers()
+            if self.archive_writer is not None:
+                self.archive_writer.close()
+        finally:
+            self.stop_workers(terminate=True)
+            if self.archive_writer is not None:
+                self.archive_writer.abort()  # does nothing after close()
+                self.archive_writer = None
+            if self.rows is not None:
+                self.rows.close()
+                self.rows = None
 
         # Create descriptor
         self.descriptor.save(destination)
+        self._uniform_tiles, self._tile_paths = {}, {}
+
+    def read_band(self, y0, y1):
+        """FluentDNA: Rows y0 to y1 of the source as (height, width, bands) arrays: the pixels for full size
+        tiles in source_mode and the pixels to halve in pixel_mode.  They're only different for 'P' mode."""
+        if isinstance(self.image, PILImage.Image):
+            if self.rows is not None:
+                band = self.rows.read(y1 - y0)  # y0 is where the last band ended
+                band.info = self.image.info.copy()
+            else:
+                band = self.image.crop((0, y0, self.image.width, y1))
+            if band.mode != self.source_mode:
+                band = band.convert(self.source_mode)
+            pixels = band_array(band)
+            return pixels, (band_array(band.convert(self.pixel_mode)) if band.mode == 'P' else pixels)
+        pixels = self.image.read_region(0, y0, self.image.width, y1)
+        return pixels, (self.image.palette[pixels[..., 0]] if self.image.mode == 'P' else pixels)
+
+    def tile_image(self, level, pixels):
+        """FluentDNA: PIL Image of a tile cut from the rows of a level.  Full size tiles are in the mode
+        of the source and keep its palette and info, like the crop() they used to be."""
+        if level < self.descriptor.num_levels - 1:
+            return PILImage.fromarray(pixels[..., 0] if pixels.shape[2] == 1 else pixels, self.pixel_mode)
+        if not isinstance(self.image, PILImage.Image):
+            return self.image.array_to_image(pixels)
+        image = PILImage.fromarray(np.ascontiguousarray(pixels[..., 0] if pixels.shape[2] == 1 else pixels),
+                                   self.source_mode)
+        if image.mode == 'P':
+            image.putpalette(self.palette)
+        image.info = self.image.info.copy()
+        return image
+
+    def encode_tiles(self, level, row, columns, band, left):
+        """FluentDNA: Encodes the tiles of one row in the range columns.  band holds all the rows they span,
+        starting at the left edge of the first tile.  Returns [(column, encoded bytes, uniform key)].
+        Most tiles of a FluentDNA image are one color: white padding, title gutters, gaps in alignments.
+        Each distinct uniform tile is only encoded once per process and stored once, see store_tiles()."""
+        tiles = []
+        for column in columns:
+            x0, y0, x1, y1 = self.descriptor.get_tile_bounds(level, column, row)
+            pixels = band[:, x0 - left:x1 - left]
+            key = uniform_key(pixels, level)
+            data = self._uniform_tiles.get(key)
+            if data is None:
+                data = self.encode(self.tile_image(level, pixels))
+                if key is not None:
+                    self._uniform_tiles[key] = data
+            tiles.append((column, data, key))
+        return tiles
+
+    def encode(self, tile):
+        output = io.BytesIO()
+        if self.descriptor.tile_format == "jpg":
+            tile.save(output, "JPEG", quality=int(self.image_quality * 100))
+        else:
+            tile.save(output, self.descriptor.tile_format)
+        return output.getvalue()
+
+    def store_tiles(self, level, row, tiles):
+        """FluentDNA: Adds encoded tiles to the archive, or writes their files.  Repeats of a uniform tile are
+        hard links to the first file, so the viewer sees the same files.  Worker processes each remember
+        their own, so a few copies can be written.  Returns the number of tiles."""
+        for column, data, key in tiles:
+            if self.archive_writer is not None:
+                self.archive_writer.add(level, column, row, data, key)
+                continue
+            format = self.descriptor.tile_format
+            tile_path = os.path.join(self.level_dirs[level], "%s_%s.%s" % (column, row, format))
+            if os.path.lexists(tile_path):
+                os.remove(tile_path)  # a link from an earlier run would be written through to its other names
+            if key is not None and key in self._tile_paths:
+                try:
+                    os.link(self._tile_paths[key], tile_path)
+                    continue
+                except (OSError, AttributeError):  # file system without hard links
+                    del self._tile_paths[key]
+            with open(tile_path, "wb") as tile_file:
+                tile_file.write(data)
+            if key is not None:
+                self._tile_paths[key] = tile_path
+        return len(tiles)
+
+    def save_tile_row(self, level, row, band):
+        """FluentDNA: Called by PyramidLevel with the rows of a level that one row of tiles spans.
+        With workers the row is split into jobs of columns_per_job tiles, each copied to a free slot."""
+        columns = self.descriptor.get_num_tiles(level)[0]
+        if self.pool is None:
+            return self.store_tiles(level, row, self.encode_tiles(level, row, range(columns), band, 0))
+        for first in range(0, columns, columns_per_job):
+            last = min(columns, first + columns_per_job)
+            left = self.descriptor.get_tile_bounds(level, first, row)[0]
+            right = self.descriptor.get_tile_bounds(level, last - 1, row)[2]
+            if not self.free_slots:
+                self.finish_job()
+            slot = self.free_slots.pop()
+            shape = (band.shape[0], right - left, band.shape[2])
+            slot_array(self.slots[slot], shape)[:] = band[:, left:right]
+            self.jobs.append((slot, level, row, self.pool.apply_async(save_slot_in_worker,
+                                                                      (slot, shape, level, row, first, last, left))))
+        return columns
+
+    def finish_job(self):
+        """FluentDNA: Waits for the oldest job and frees its slot.  Tiles for an archive come back here and
+        are added in the order the jobs were sent, so the archive is the same with any number of workers."""
+        slot, level, row, result = self.jobs.popleft()
+        tiles = result.get()  # raises the worker's exception, if any
+        if self.archive_writer is not None:
+            self.store_tiles(level, row, tiles)
+        self.free_slots.append(slot)
+
+    def start_workers(self):
+        """FluentDNA: PNG compression is most of the deep zoom time, so with workers > 1 tiles are encoded by
+        a pool of forked processes.  Pixels don't go through the pool: the main process copies a job's rows
+        into one of a few slots of shared memory mapped before the fork, and only the slot number is sent.
+        Every tile has its own file, so the result is identical to one process."""
+        global forked_creator
+        if self.workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            return
+        slot_bytes = (self.tile_size + 2 * self.tile_overlap) * \
+            (columns_per_job * self.tile_size + 2 * self.tile_overlap) * 4
+        self.slots = [mmap.mmap(-1, slot_bytes) for i in range(self.workers * 2)]
+        self.free_slots = list(range(len(self.slots)))
+        self.jobs = deque()
+        forked_creator = self
+        self.pool = fork_pool(self.workers)
+
+    def stop_workers(self, terminate=False):
+        """Waits for every job and closes the pool.  terminate=True stops it without waiting, after an error."""
+        global forked_creator
+        if self.pool is None:
+            return
+        try:
+            if not terminate:
+                while self.jobs:
+                    self.finish_job()
+                self.pool.close()
+        finally:
+            if terminate:
+                self.pool.terminate()
+            self.pool.join()
+            self.pool, self.slots, self.jobs = None, None, None
+            forked_creator = None
+
+
+class PyramidLevel(object):
+    """FluentDNA: One level of the pyramid while ImageCreator.create() streams the image through it.
+    push() receives the rows of this level from top to bottom.  As soon as every row a row of tiles spans
+    has arrived, the tiles are written and only the overlap is kept for the next one.  The rows are also
+    halved and pushed to the next level down, with an odd last row held until its partner arrives.
+    The last row and column are weighted by get_edge_coverage(), so colors stay true down to 1 pixel."""
+    def __init__(self, creator, level, below=None):
+        self.creator = creator
+        self.level = level
+        self.below = below
+        self.descriptor = creator.descriptor
+        self.width, self.height = self.descriptor.get_dimensions(level)
+        self.cover_x, self.cover_y = self.descriptor.get_edge_coverage(level)
+        self.rows = self.descriptor.get_num_tiles(level)[1]
+        self.buffer, self.buffer_top = None, 0  # rows not yet written and the y of the first one
+        self.received = 0
+        self.next_row = 0
+        self.halved_rows = 0
+        self.unpaired = None
+
+    def push(self, pixels, colors=None):
+        """pixels are the next rows of the level as a (rows, width, bands) array.  colors is the same
+        rows in pixel_mode, when they're different (indexed color)."""
+        self.received += len(pixels)
+        self.buffer = pixels if self.buffer is None else np.concatenate([self.buffer, pixels])
+        while self.next_row < self.rows:
+            top, bottom = self.descriptor.get_tile_bounds(self.level, 0, self.next_row)[1::2]
+            if bottom > self.received:
+                break
+            self.creator.save_tile_row(self.level, self.next_row, self.buffer[top - self.buffer_top:
+                                                                              bottom - self.buffer_top])
+            self.next_row += 1
+            keep = self.descriptor.get_tile_bounds(self.level, 0, self.next_row)[1] \
+                if self.next_row < self.rows else self.received
+            self.buffer, self.buffer_top = self.buffer[keep - self.buffer_top:], keep
+        if self.below is not None:
+            colors = pixels if colors is None else colors
+            for y in range(0, len(colors), halving_rows):  # float32 is 4x the size
+                halved = self.halve(colors[y:y + halving_rows])
+                if len(halved):
+                    self.below.push(halved)
+
+    def halve(self, colors):
+        rows = colors.astype(np.float32)
+        self.halved_rows += len(rows)
+        last = self.halved_rows == self.height
+        if self.unpaired is not None:
+            rows = np.concatenate([self.unpaired, rows])
+        self.unpaired = None
+        if len(rows) % 2 and not last:
+            rows, self.unpaired = rows[:-1], rows[-1:]
+        rows = _average_pairs(rows, 0, self.cover_y if last else 1.0)
+        rows = _average_pairs(rows, 1, self.cover_x)
+        return np.floor(rows + 0.5).astype(np.uint8)
+
+
+columns_per_job = 16  # tiles per worker job, keeps shared memory slots small for wide images
+halving_rows = 64
+forked_creator = None  # the ImageCreator inherited by start_workers() processes
+
+
+def save_slot_in_worker(slot, shape, level, row, first, last, left):
+    """Runs in a forked worker.  Encodes tiles first to last - 1 of a row from a shared memory slot and
+    writes them, or returns them for the main process to add to the archive."""
+    creator = forked_creator
+    tiles = creator.encode_tiles(level, row, range(first, last), slot_array(creator.slots[slot], shape), left)
+    if creator.archive_writer is not None:
+        return tiles
+    return creator.store_tiles(level, row, tiles)
+
+
+def slot_array(slot, shape):
+    return np.frombuffer(slot, dtype=np.uint8, count=int(np.prod(shape))).reshape(shape)
+
+
+def open_image(path):
+    """FluentDNA images are far bigger than PIL's decompression bomb limit.  It's lifted for opening the
+    image being tiled, not for every image the program opens."""
+    limit = PILImage.MAX_IMAGE_PIXELS
+    PILImage.MAX_IMAGE_PIXELS = None
+    try:
+        return PILImage.open(path)
+    finally:
+        PILImage.MAX_IMAGE_PIXELS = limit
+
+
+def band_modes(image):
+    """(source_mode, pixel_mode) for an image or canvas: full size tiles are in source_mode, smaller levels
+    are averaged in pixel_mode.  'P' is averaged in RGB, modes PIL can't average are converted first."""
+    mode = image.mode
+    alpha = 'RGBA' if isinstance(image, PILImage.Image) and 'transparency' in image.info else 'RGB'
+    if mode in ('L', 'LA', 'RGB', 'RGBA'):
+        return mode, mode
+    if mode == 'P':
+        return mode, alpha
+    return alpha, alpha
+
+
+def band_array(image):
+    pixels = np.asarray(image)
+    return pixels.reshape(pixels.shape[:2] + (-1,))
+
+
+def uniform_key(pixels, level):
+    """FluentDNA: (level, size, color) if every pixel of a tile is the same, otherwise None.
+    Levels are in different modes, so a color only means the same thing within a level.
+    Checking the first row alone rejects most tiles of sequence without reading the rest."""
+    first = pixels[0, 0]
+    if not (pixels[0] == first).all() or not (pixels == first).all():
+        return None
+    return level, pixels.shape[:2], tuple(first.tolist())
 
 
 class CollectionCreator(object):
@@ -357,6 +649,33 @@ class CollectionCreator(object):
 
 ################################################################################
 
+def halve(image, cover_x=1.0, cover_y=1.0, band_height=64):
+    """FluentDNA: Half size image where each pixel is the average of the 2x2 block below it, one band of rows
+    at a time.  cover_x and cover_y are get_edge_coverage() of the image: the partial last column and row
+    are weighted by how much image they hold, so colors stay true all the way down to 1 pixel.
+    Modes other than L, LA, RGB and RGBA, like 'P' from an indexed color PNG, are converted first."""
+    if image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    width, height = image.size
+    result = PILImage.new(image.mode, ((width + 1) // 2, (height + 1) // 2))
+    for y in range(0, height, band_height):
+        band = np.asarray(image.crop((0, y, width, min(height, y + band_height))), dtype=np.float32)
+        band = _average_pairs(band, 0, cover_y if y + band_height >= height else 1.0)
+        band = _average_pairs(band, 1, cover_x)
+        result.paste(PILImage.fromarray(np.floor(band + 0.5).astype(np.uint8), image.mode), (0, y // 2))
+    return result
+
+def _average_pairs(pixels, axis, cover):
+    """Averages rows (axis 0) or columns (axis 1) two at a time.  An odd one out is kept as it is."""
+    pixels = np.moveaxis(pixels, axis, 0)
+    first, second = pixels[0::2], pixels[1::2]
+    if len(pixels) % 2:
+        second = np.concatenate([second, first[-1:]])
+    averaged = (first + second) / 2
+    if not len(pixels) % 2 and cover < 1:
+        averaged[-1] = (first[-1] + cover * second[-1]) / (1 + cover)
+    return np.moveaxis(averaged, 0, axis)
+
 def _expand(d):
     return os.path.abspath(os.path.expanduser(os.path.expandvars(d)))
 
@@ -389,9 +708,6 @@ def main():
                       default=1, help="Overlap of the tiles in pixels (0-10). Default: 1")
     parser.add_option("-q", "--image_quality", dest="image_quality", type="float",
                       default=0.95, help="Quality of the image output (0-1). Default: 0.95")
-    parser.add_option("-r", "--resize_filter", dest="resize_filter", default="antialias",
-                      help="Type of filter for resizing (bicubic, nearest, \
-                            bilinear, antialias (best). Default: antialias")
 
     (options, args) = parser.parse_args()
 
@@ -406,13 +722,10 @@ def main():
 
     if not options.destination:
         options.destination = os.path.splitext(source)[0] + ".dzi"
-    if options.resize_filter and options.resize_filter in resize_filter_map:
-        options.resize_filter = resize_filter_map[options.resize_filter]
 
     creator = ImageCreator(tile_size=options.tile_size,
                            tile_format=options.tile_format,
-                           image_quality=options.image_quality,
-                           resize_filter=options.resize_filter)
+                           image_quality=options.image_quality)
     creator.create(source, options.destination)
 
 if __name__ == "__main__":
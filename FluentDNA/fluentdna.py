@@ -35,31 +35,22 @@ sys.path.append(BASE_DIR)
 sys.path.append(os.path.join(BASE_DIR, 'bin'))
 sys.path.append(os.path.join(BASE_DIR, 'bin', 'env'))
 
-os.chdir(BASE_DIR)
-
-import multiprocessing
-multiprocessing.freeze_support()
+if getattr(sys, 'frozen', False):
+    import multiprocessing
+    multiprocessing.freeze_support()
 
 # ----------BEGIN MAIN PROGRAM----------
-"""All imports from inside the FluentDNA module must start here. Frozen modules aren't available before this line."""
+"""All imports from inside the FluentDNA module must start here. Frozen modules aren't available before this line.
+Only the standard library and FluentDNAUtils are imported at load time so --version, --update_name and
+--runserver start quickly.  Layouts, numpy and PIL are imported by dispatch_job() for the layout it runs,
+benchmarks/run_benchmarks.py keeps track of it."""
 from FluentDNA import VERSION
 
 import argparse
 import gc
 from datetime import datetime
-from DNASkittleUtils.CommandLineUtils import just_the_name
 from FluentDNA.FluentDNAUtils import create_deepzoom_stack, make_output_directory, base_directories, \
     hold_console_for_windows, beep, copy_to_sources, archive_execution_command
-from FluentDNA.ParallelGenomeLayout import ParallelLayout
-from FluentDNA.AnnotatedTrackLayout import  AnnotatedTrackLayout
-from FluentDNA.Ideogram import Ideogram
-from FluentDNA.HighlightedAnnotation import HighlightedAnnotation
-from FluentDNA.ChainParser import ChainParser
-from FluentDNA.UniqueOnlyChainParser import UniqueOnlyChainParser
-from FluentDNA.AnnotatedAlignment import AnnotatedAlignment
-from FluentDNA.TileLayout import TileLayout
-from FluentDNA.MultipleAlignmentLayout import MultipleAlignmentLayout
-from DNASkittleUtils.Contigs import write_contigs_to_file, read_contigs
 
 if sys.platform == 'win32':
     OS_DIR = 'windows'
@@ -121,7 +112,8 @@ def run_server(output_dir=None):
     success = launch_browser(url, output_dir)
     try: # Try to determine if this is running in a terminal
         import FluentDNA
-        handler = server.SimpleHTTPRequestHandler
+        from FluentDNA.TileArchive import archive_request_handler
+        handler = archive_request_handler(server.SimpleHTTPRequestHandler)  # also serves --tile_archive results
         httpd = TCPServer((ADDRESS, PORT), handler)
         print("Open a browser at " + url)
         print("If you are using this computer remotely, use CTRL+C to close the browser and "
@@ -151,6 +143,7 @@ def launch_browser(url, output_dir):
 def done(args, output_dir=None):
     """Ensure that server always starts when requested.
     Otherwise system exit."""
+    finish_profile(args)  # before the server, which never returns
     if not args.no_server and args.run_server:
         run_server(output_dir)
     else:
@@ -160,6 +153,14 @@ def done(args, output_dir=None):
         sys.exit(0)
 
 
+def finish_profile(args):
+    """Saves the --profile results in sources/ next to command.sh, or next to the image without a webpage"""
+    profiler = getattr(args, 'profiler', None)
+    if profiler is not None:
+        sources = os.path.join(args.output_dir, 'sources')
+        profiler.finish(sources if os.path.isdir(sources) else args.output_dir)
+
+
 def dispatch_job(args):
     """The main switch statement that matches a series of command line arguments with the proper
     FluentDNA modules to handle those arguments. This can be chosen explicitly with the --layout= argument
@@ -168,6 +169,7 @@ def dispatch_job(args):
     class to route the dispatched job to.
 
     All Layouts will return an output directory which will be used by the run_server() method for results.
+    Each branch imports its own Layout, so a job only loads the modules it uses.
     """
     SERVER_HOME, base_path = base_directories(args.output_name)
 
@@ -177,13 +179,15 @@ def dispatch_job(args):
 
 
     if args.layout == "NONE":  # Complete webpage generation from existing image
+        from FluentDNA.TileLayout import TileLayout
         layout = TileLayout(use_titles=args.use_titles, sort_contigs=args.sort_contigs,
                             low_contrast=args.low_contrast, base_width=args.base_width,
                             custom_layout=args.custom_layout)
         #Don't overwrite old webpage when regenerating zoom stack from an image
         layout.generate_html(args.output_dir, args.output_name, overwrite_files=False)
         print("Creating Deep Zoom Structure for Existing Image...")
-        create_deepzoom_stack(args.image, os.path.join(args.output_dir, 'GeneratedImages', "dzc_output.xml"))
+        create_deepzoom_stack(args.image, os.path.join(args.output_dir, 'GeneratedImages', "dzc_output.xml"),
+                              args.workers, args.tile_archive)
         print("Done creating Deep Zoom Structure.")
         done(args, args.output_dir)
 
@@ -194,7 +198,9 @@ def dispatch_job(args):
 
     # ==========TODO: separate views that support batches of contigs============= #
     elif args.layout == 'alignment':
+        from FluentDNA.MultipleAlignmentLayout import MultipleAlignmentLayout
         layout = MultipleAlignmentLayout(sort_contigs=args.sort_contigs)
+        apply_render_options(args, layout)
         start_time = layout.process_all_alignments(args.fasta,
                                       args.output_dir,
                                       args.output_name)
@@ -209,6 +215,7 @@ def dispatch_job(args):
                                             args.output_name, [args.fasta] + args.extra_fastas)
             done(args, args.output_dir)
         else:  # parse chain files, possibly in batch
+            from FluentDNA.ChainParser import ChainParser
             chain_parser = ChainParser(chain_name=args.chain_file,
                                        first_source=args.fasta,
                                        second_source=args.extra_fastas[0],
@@ -220,6 +227,7 @@ def dispatch_job(args):
                                        show_translocations_only=args.show_translocations_only,
                                        aligned_only=args.aligned_only,
                                        extract_contigs=args.contigs)
+            chain_parser.trace_memory = args.trace_memory
             print("Creating Gapped and Unique Fastas from Chain File...")
             batches = chain_parser.parse_chain(args.contigs)
             del chain_parser
@@ -230,19 +238,23 @@ def dispatch_job(args):
                     create_parallel_viz_from_fastas(args, len(batch.fastas),
                                                     batch.output_folder,
                                                     os.path.basename(batch.output_folder),
-                                                    batch.fastas, border_boxes=True)
+                                                    batch.fastas, border_boxes=True, report=batch.report)
                     copy_to_sources(batch.output_folder, args.chain_file)
             done(args)
     elif args.layout == "annotation_track":
+        from FluentDNA.AnnotatedTrackLayout import AnnotatedTrackLayout
         layout = AnnotatedTrackLayout(args.fasta, args.ref_annotation, args.annotation_width)
+        apply_render_options(args, layout)
         start_time = layout.render_genome(args.output_dir, args.output_name, args.contigs)
         finish_webpage(args, layout, args.output_name, start_time)
         done(args, args.output_dir)
     elif args.layout == "annotated":
+        from FluentDNA.HighlightedAnnotation import HighlightedAnnotation
         layout = HighlightedAnnotation(args.ref_annotation, args.query_annotation, args.repeat_annotation,
                                        use_titles=args.use_titles, sort_contigs=args.sort_contigs,
                                        low_contrast=args.low_contrast, base_width=args.base_width,
                                        custom_layout=args.custom_layout, use_labels=args.use_labels)
+        apply_render_options(args, layout)
         start_time = layout.process_file(args.fasta, args.output_dir, args.output_name,
                             args.no_webpage, args.contigs)
         finish_webpage(args, layout, args.output_name, start_time)
@@ -253,6 +265,7 @@ def dispatch_job(args):
                                first_source='data\\hg38.fa',
                                second_source='',
                                output_folder_prefix='Hg38_unique_vs_panTro4_')"""
+        from FluentDNA.UniqueOnlyChainParser import UniqueOnlyChainParser
         unique_chain_parser = UniqueOnlyChainParser(chain_name=args.chain_file, first_source=args.fasta,
                                                     second_source=args.fasta, output_prefix=base_path,
                                                     trial_run=args.trial_run,
@@ -276,6 +289,7 @@ def dispatch_job(args):
         if hasattr(radix_settings, '__len__') and len(radix_settings) == 4 and \
             type(radix_settings[0]) == type(radix_settings[1]) == type([]) and \
             type(radix_settings[2]) == type(radix_settings[3]) == type(1):
+            from FluentDNA.Ideogram import Ideogram
             layout = Ideogram(radix_settings,
                               ref_annotation=args.ref_annotation, query_annotation=args.query_annotation,
                               repeat_annotation=args.repeat_annotation,
@@ -290,6 +304,7 @@ def dispatch_job(args):
 
 
     elif args.ref_annotation and args.layout != 'transposon':  # parse chain files, possibly in batch
+        from FluentDNA.AnnotatedAlignment import AnnotatedAlignment
         anno_align = AnnotatedAlignment(chain_name=args.chain_file,
                                         first_source=args.fasta,
                                         first_annotation=args.ref_annotation,
@@ -301,6 +316,7 @@ def dispatch_job(args):
                                         squish_gaps=args.squish_gaps,
                                         show_translocations_only=args.show_translocations_only,
                                         aligned_only=args.aligned_only)
+        anno_align.trace_memory = args.trace_memory
         print("Creating Aligned Annotations using Chain File...")
         batches = anno_align.parse_chain(args.contigs)
         del anno_align
@@ -308,18 +324,20 @@ def dispatch_job(args):
         if not args.stats_only:
             for batch in batches:  # multiple contigs, multiple views
                 create_parallel_viz_from_fastas(args, len(batch.fastas), args.output_dir, args.output_name,
-                                                batch.fastas)
+                                                batch.fastas, report=batch.report)
         done(args)
     else:
         raise NotImplementedError("What you are trying to do is not currently implemented!")
 
 
-def create_parallel_viz_from_fastas(args, n_genomes, output_dir, output_name, fastas, border_boxes=True):
+def create_parallel_viz_from_fastas(args, n_genomes, output_dir, output_name, fastas, border_boxes=True, report=None):
     """Helper function since multiple layout were all using a derivation of parallel layouts:
     Parallel: Simply showing two ungapped fastas side by side. Presumably they have similar coordinates?
     ChainFiles: Using a chain file to align one assembly to another and show both aligned side by side
     AnnotatedAlignment: Same as above but also with an annotation or two similarly gapped and rearranged
+    report: the RunReport of a chain Batch, so the chain phases are saved with the layout phases
     """
+    from FluentDNA.ParallelGenomeLayout import ParallelLayout
     print("Creating Large Comparison Image from Input Fastas...")
     column_widths = None
     if args.column_widths:
@@ -330,6 +348,9 @@ def create_parallel_viz_from_fastas(args, n_genomes, output_dir, output_name, fa
             print("Column widths should be a python expression of a list of integers ex: [30,80]", file=sys.stderr)
     layout = ParallelLayout(n_genomes=n_genomes, low_contrast=args.low_contrast, base_width=args.base_width,
                             column_widths=column_widths, border_boxes=border_boxes)
+    apply_render_options(args, layout, output_dir)
+    if report is not None:
+        layout.report = report
     start_time = layout.process_file(output_dir, output_name, fastas, args.no_webpage, args.contigs)
     args.output_dir = output_dir
     finish_webpage(args, layout, output_name, start_time)
@@ -342,16 +363,34 @@ def create_tile_layout_viz_from_fasta(args, fasta, output_name, layout=None):
 
     print("Creating Large Image from Input Fasta...")
     if layout is None:
+        from FluentDNA.TileLayout import TileLayout
         layout = TileLayout(use_titles=args.use_titles, sort_contigs=args.sort_contigs,
                             low_contrast=args.low_contrast, base_width=args.base_width,
                             custom_layout=args.custom_layout)
+    apply_render_options(args, layout)
     start_time = layout.process_file(fasta, args.output_dir, output_name, args.no_webpage, args.contigs)
 
     finish_webpage(args, layout, output_name, start_time)
 
 
+def apply_render_options(args, layout, output_dir=None):
+    """Canvas storage options are the same for every Layout.  Spilled tiles and memmap files go
+    inside the output directory and are deleted when the layout is done."""
+    layout.render_mode = args.render_mode
+    layout.memory_budget = int(args.memory_budget * 1024 ** 3)
+    layout.canvas_dir = output_dir or args.output_dir
+    layout.indexed_color = args.indexed_color
+    layout.workers = max(1, args.workers)
+    layout.stream_sequences = args.stream_sequences or args.dry_run  # a dry run only needs the lengths
+    layout.dry_run = args.dry_run
+    layout.no_webpage = args.no_webpage
+    layout.report.trace_allocations = args.trace_memory
+    return layout
+
+
 def combine_files(batches, args, output_name):
     from itertools import chain
+    from DNASkittleUtils.Contigs import write_contigs_to_file, read_contigs
     contigs = list(chain(*[read_contigs(batch.fastas[0]) for batch in batches]))
     fasta_output = os.path.join(args.output_dir, 'sources', output_name + '.fa')
     write_contigs_to_file(fasta_output, contigs)
@@ -359,28 +398,58 @@ def combine_files(batches, args, output_name):
     copy_to_sources(args.output_dir, args.chain_file)
 
 
-def finish_webpage(args, layout, output_name, start_time=datetime.now()):
+def finish_webpage(args, layout, output_name, start_time=None):
     """Creates HTML (containing all the mouse over coordinate information) and deepzoom stack for the
     results webpage to be presented to the end user. For input, accepts a single giant image plus coordinates
     as a Layout object. layout.final_output_location is crucial for assigning the output directory.
     arg output_name is cosmetic and user visible. Steps have been taken to use as little memory as possible
-    as this step tends to be a bottleneck on resources."""
+    as this step tends to be a bottleneck on resources.
+    Every phase timed in layout.report, plus these two, is saved to run_report.json beside the image."""
     final_location = layout.final_output_location
+    report, layout_name = layout.report, type(layout).__name__
     print("Done creating Large Image at ", final_location)
     if not args.no_webpage:
         with open(os.path.join(os.path.dirname(final_location), 'command.sh'), 'w') as f:
             f.write(archive_execution_command() + '\n')  # original command that got us here
-        layout.generate_html(args.output_dir, output_name)
+        with report.phase('html'):
+            layout.generate_html(args.output_dir, output_name)
+        source = layout.deepzoom_source()
         del layout
         gc.collect()  # it's important to free the large amount of RAM this uses
         print("Creating Deep Zoom Structure from Generated Image...")
-        create_deepzoom_stack(os.path.join(args.output_dir, final_location),
-                              os.path.join(args.output_dir, 'GeneratedImages', "dzc_output.xml"))
+        if isinstance(source, str):
+            source = os.path.join(args.output_dir, source)
+        with report.phase('deep zoom'):
+            create_deepzoom_stack(source, os.path.join(args.output_dir, 'GeneratedImages', "dzc_output.xml"),
+                                  args.workers, args.tile_archive)
+        if hasattr(source, 'close'):
+            source.close()
         print("Done creating Deep Zoom Structure")
     else:
         del layout
         gc.collect()  # it's important to free the large amount of RAM this uses
-    print("Total processing time: ", datetime.now() - start_time )
+    try:
+        print("Timing report saved to", report.save(os.path.dirname(final_location), layout_name))
+    except (IOError, OSError) as e:
+        print("Could not save the timing report:", e)
+    started = report.started or start_time
+    if started is not None:
+        print("Total processing time: ", datetime.now() - started)
+
+
+def resolve_input_paths(args):
+    """FluentDNA used to chdir into its install directory, so relative paths like example_data/... in the
+    README were read from there.  Relative paths are now read from the current directory first and only
+    fall back to the install directory when they don't exist here."""
+    def resolve(path):
+        if path and not os.path.isabs(path) and not os.path.exists(path) \
+                and os.path.exists(os.path.join(BASE_DIR, path)):
+            return os.path.join(BASE_DIR, path)
+        return path
+    for name in ['fasta', 'image', 'chain_file', 'ref_annotation', 'query_annotation', 'repeat_annotation']:
+        setattr(args, name, resolve(getattr(args, name)))
+    if args.extra_fastas:
+        args.extra_fastas = [resolve(path) for path in args.extra_fastas]
 
 
 def main():
@@ -567,6 +636,69 @@ def main():
                              'Custom layout must be formatted as two integer lists of euqal length.\n'
                              'For example: --custom_layout="([10,100,100,10,3,999], [0,0,0,3,18,108])"',
                         dest="custom_layout")
+    parser.add_argument("--render_mode",
+                        type=str,
+                        default='auto',
+                        choices=['auto', 'memory', 'tiled', 'memmap'],
+                        help="'memory' draws on one image in RAM. 'tiled' only allocates image tiles that are "
+                             "drawn on and spills them to disk beyond --memory_budget, for images larger than RAM. "
+                             "'memmap' draws on a raw file in the output directory and lets the OS page it. "
+                             "'auto' (default) estimates the image size first and picks the one that fits in "
+                             "the available RAM.",
+                        dest="render_mode")
+    parser.add_argument("--dry_run",
+                        action='store_true',
+                        help="Only print the estimated image size, deep zoom tiles, disk space, run time and "
+                             "render mode, then stop before anything is drawn.",
+                        dest="dry_run")
+    parser.add_argument("--memory_budget",
+                        type=float,
+                        default=2.0,
+                        help="Gigabytes of image tiles to keep in RAM with --render_mode=tiled",
+                        dest="memory_budget")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes drawing nucleotides into a shared memory canvas. "
+                             "Titles and labels are rasterized and deep zoom tiles are encoded by the same "
+                             "number of processes.",
+                        dest="workers")
+    parser.add_argument("--tile_archive",
+                        action='store_true',
+                        help="Pack the deep zoom tiles into one GeneratedImages/dzc_output.tiles file instead of "
+                             "a file per tile, for file systems that struggle with millions of small files. "
+                             "Results can then only be viewed through the built-in server (--runserver).",
+                        dest="tile_archive")
+    parser.add_argument("--trace_memory",
+                        action='store_true',
+                        help="Also trace Python allocations with tracemalloc and save the peak and the biggest "
+                             "allocations of each phase in run_report.json. Makes the run noticeably slower.",
+                        dest="trace_memory")
+    parser.add_argument("--indexed_color",
+                        action='store_true',
+                        help="Store one byte per pixel with a fixed palette instead of RGB. Uses a third of "
+                             "the RAM and writes smaller paletted PNGs.",
+                        dest="indexed_color")
+    parser.add_argument("--stream",
+                        action='store_true',
+                        help="Read only contig names and lengths up front and stream the sequence from disk while "
+                             "drawing. Keeps memory flat for very large FASTA files.",
+                        dest="stream_sequences")
+    parser.add_argument("--no_fasta_index",
+                        action='store_true',
+                        help="Don't save a samtools style FASTA.fai next to the FASTA.  By default one is written "
+                             "whenever that folder is writable so later --contigs runs can jump straight to the "
+                             "contigs they need. Existing .fai files are always used.",
+                        dest="no_fasta_index")
+    parser.add_argument("--profile",
+                        nargs='?',
+                        const='cprofile',
+                        default=None,
+                        choices=['cprofile', 'sample'],
+                        help="Profile the whole job and save fluentdna.prof and a list of the slowest functions "
+                             "in sources/. 'cprofile' (the default) is exact but slows pure Python steps down, "
+                             "--profile=sample checks the stack every 5ms and is cheap enough for multi-hour jobs.",
+                        dest="profile")
     parser.add_argument('-n', '--update_name', dest='update_name', help='Query for the name of this program as known to the update server', action='store_true')
     parser.add_argument('-v', '--version', dest='version', help='Get current version of program.', action='store_true')
 
@@ -578,6 +710,11 @@ def main():
     elif args.version:
         print(VERSION)
         sys.exit(0)
+    from DNASkittleUtils.CommandLineUtils import just_the_name
+    from FluentDNA import FastaIndex
+    from FluentDNA.Preflight import DryRun
+    FastaIndex.save_indexes = not args.no_fasta_index
+    resolve_input_paths(args)
 
     # Errors
 
@@ -668,7 +805,17 @@ def main():
         make_output_directory(args.output_dir)
         args.run_server = True
 
-    dispatch_job(args)
+    if args.profile:
+        from FluentDNA.Profiler import JobProfiler
+        args.profiler = JobProfiler(args.profile).start()
+    else:
+        args.profiler = None
+    try:
+        dispatch_job(args)
+    except DryRun:
+        print("Dry run: nothing was drawn.")
+    finally:
+        finish_profile(args)  # when the job failed or returned without done()
 
 
 if __name__ == "__main__":
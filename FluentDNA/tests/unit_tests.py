@@ -1,7 +1,49 @@
+import filecmp
+import json
 import os
+import pstats
+import random
+import shutil
+import struct
+import tempfile
+import time
+import tracemalloc
 import unittest
+import zlib
+
+import numpy as np
+from DNASkittleUtils.Contigs import Contig, read_contigs, write_contigs_to_file
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 
 from FluentDNA.AnnotatedTrackLayout import AnnotatedTrackLayout
+from FluentDNA.Annotations import parseGFF
+from FluentDNA.benchmarks.SyntheticGenome import SyntheticGenome
+from FluentDNA.benchmarks.run_benchmarks import startup
+from FluentDNA.Canvas import ArrayCanvas, TiledCanvas, MemmapCanvas, PNGRows, canvas_draw, write_png_chunk
+from FluentDNA import FastaIndex
+from FluentDNA.ChainFiles import chain_file_to_list
+from FluentDNA.FastaIndex import StreamedSequence, streamed_contigs, fai_path, read_fai, pluck_contig
+from FluentDNA.deepzoom import DZIDescriptor, ImageCreator
+from FluentDNA.FluentDNAUtils import filter_by_contigs, read_and_filter_contigs, multi_line_height, pretty_contig_name
+from FluentDNA.Preflight import Preflight, DryRun
+from FluentDNA.Profiler import JobProfiler
+from FluentDNA.Progress import Progress, CancelToken, Cancelled
+from FluentDNA.Render import render
+from FluentDNA.RunReport import RunReport, fork_pool, running_samplers
+from FluentDNA.TileArchive import TileArchive, archive_request_handler
+from FluentDNA.TileLayout import TileLayout
+from FluentDNA.TitleCache import title_cache
+
+
+def random_contigs(lengths, alphabet='ACGTN-', seed=7):
+    rng = random.Random(seed)
+    return [Contig('contig_%i' % i, ''.join(rng.choice(alphabet) for _ in range(n)))
+            for i, n in enumerate(lengths)]
+
+
+def as_image(canvas):
+    """Layouts draw into an ArrayCanvas where they can, ImageChops wants a PIL Image"""
+    return canvas.to_image() if isinstance(canvas, ArrayCanvas) else canvas
 
 class AnnotationTrackTest(unittest.TestCase):
     """The majority of testing is done in end_to_end_tests.py because visualization have
@@ -16,5 +58,690 @@ class AnnotationTrackTest(unittest.TestCase):
         self.assertEqual(True, True)
 
 
+class DrawNucleotidesTest(unittest.TestCase):
+    def render(self, layout, contigs, by_pixel):
+        layout.contigs = contigs
+        layout.image_length = layout.calc_all_padding()
+        layout.prepare_image(layout.image_length)
+        if by_pixel:
+            layout.draw_nucleotides_by_pixel(verbose=False)
+        else:
+            layout.draw_nucleotides(verbose=False)
+        return layout.image
+
+    def test_vectorized_matches_per_pixel(self):
+        lengths = [250000, 123457, 999, 40]  # full columns, partial columns and tiny contigs
+        fast = self.render(TileLayout(), random_contigs(lengths, 'ACGTNXacgt.'), by_pixel=False)
+        slow = self.render(TileLayout(), random_contigs(lengths, 'ACGTNXacgt.'), by_pixel=True)
+        self.assertEqual(fast.size, slow.size)
+        self.assertIsNone(ImageChops.difference(as_image(fast), as_image(slow)).getbbox())
+
+    def test_draws_without_copying_the_canvas(self):
+        layout = TileLayout()
+        layout.contigs = random_contigs([250000, 123457, 999, 40] * 4, 'ACGTN')
+        layout.image_length = layout.calc_all_padding()
+        layout.prepare_image(layout.image_length)
+        canvas = layout.image
+        canvas_bytes = canvas.array.nbytes
+        tracemalloc.start()  # numpy reports its buffers to tracemalloc
+        try:
+            layout.draw_nucleotides(verbose=False)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertIs(canvas, layout.image)
+        self.assertEqual(canvas.array.nbytes, 3 * canvas.width * canvas.height)  # not PIL's 4 bytes per pixel
+        self.assertLess(peak, canvas_bytes, "draw_nucleotides made a copy of the canvas")  # the old copy was 1.75x
+
+    def test_custom_layout_matches_per_pixel(self):
+        custom = "([7,11,13,5,3,999], [0,0,1,4,9,20])"
+        fast = self.render(TileLayout(custom_layout=custom), random_contigs([30000, 2001]), by_pixel=False)
+        slow = self.render(TileLayout(custom_layout=custom), random_contigs([30000, 2001]), by_pixel=True)
+        self.assertIsNone(ImageChops.difference(as_image(fast), as_image(slow)).getbbox())
+
+    def test_indexed_color_matches_rgb(self):
+        layout = TileLayout()
+        layout.indexed_color = True
+        indexed = self.render(layout, random_contigs([250000, 999], 'ACGTNXacgt.'), by_pixel=False)
+        rgb = self.render(TileLayout(), random_contigs([250000, 999], 'ACGTNXacgt.'), by_pixel=False)
+        self.assertEqual(indexed.mode, 'P')
+        self.assertIsNone(ImageChops.difference(as_image(rgb), indexed.to_image().convert('RGB')).getbbox())
+
+    def test_workers_match_one_process(self):
+        layout = TileLayout()
+        layout.workers = 3
+        layout.nucleotide_jobs = lambda: TileLayout.nucleotide_jobs(layout, job_size=100000)  # one column each
+        contigs = random_contigs([250000, 123457, 999, 40] * 3)
+        shared = self.render(layout, contigs, by_pixel=False)
+        single = self.render(TileLayout(), contigs, by_pixel=False)
+        self.assertTrue(shared.shared)
+        self.assertIsNone(ImageChops.difference(as_image(single), shared.to_image()).getbbox())
+        shared.close()
+
+
+class BatchCoordinateTest(unittest.TestCase):
+    def check_layout(self, frame, progress):
+        xs, ys = frame.positions_on_screen(progress)
+        expected = [frame.position_on_screen(int(p)) for p in progress]
+        self.assertEqual(list(zip(xs.tolist(), ys.tolist())), [tuple(xy) for xy in expected])
+        self.assertEqual(frame.positions_to_progress(xs, ys).tolist(), progress.tolist())
+
+    def test_default_layout(self):
+        frame = TileLayout().levels
+        progress = np.random.RandomState(3).randint(0, 500 * 1000 * 1000, 5000)
+        self.check_layout(frame, np.concatenate([np.arange(250000), progress]))
+
+    def test_custom_layout(self):
+        frame = TileLayout(custom_layout="([7,11,13,5,3,999], [0,2,1,4,9,20])").levels
+        self.check_layout(frame, np.arange(0, 3 * 1000 * 1000, 7))
+
+    def test_column_stencil(self):
+        layout = TileLayout(custom_layout="([7,11,13,5,3,999], [0,2,1,4,9,20])")
+        stencil = layout.levels.column_stencil()
+        self.assertEqual(stencil.size, 77)
+        expected = [tuple(layout.levels.relative_position(i)) + (i,) for i in range(stencil.size)]
+        self.assertEqual(layout.get_packed_coordinates(), expected)
+        self.assertEqual((stencil.width, stencil.height), (7, 11))
+        self.assertIs(layout.levels.column_stencil(), stencil)  # cached
+
+    def test_padding_has_no_progress(self):
+        frame = TileLayout().levels
+        x, y = frame.position_on_screen(99)  # last nucleotide of the first line
+        self.assertEqual(frame.positions_to_progress([x + 1, x + 3, frame.origin[0] - 1], [y, y, y]).tolist(),
+                         [-1, -1, -1])
+
+
+class PaddingPlanTest(unittest.TestCase):
+    def check_plan(self, layout, lengths):
+        layout.contigs = [Contig('contig %i' % i, 'A' * n) for i, n in enumerate(lengths)]
+        image_length = layout.calc_all_padding()
+        planned = [(c.reset_padding, c.title_padding, c.tail_padding, c.nuc_title_start, c.nuc_seq_start)
+                   for c in layout.contigs]
+        total_progress, seq_start, expected = 0, 0, []
+        for c in layout.contigs:  # the original one contig at a time loop
+            reset, title, tail = layout.calc_padding(total_progress, len(c.seq))
+            expected.append((reset, title, tail, seq_start, seq_start + len(c.name) + 1))
+            total_progress += reset + title + tail + len(c.seq)
+            seq_start += len(c.name) + 1 + len(c.seq)
+        self.assertEqual(expected, planned)
+        self.assertEqual(total_progress, image_length)
+        from_plan = layout.contig_struct()
+        layout.padding_plan = None
+        self.assertEqual(layout.contig_struct(), from_plan)
+
+    def test_matches_calc_padding(self):
+        rng = random.Random(11)
+        lengths = [int(rng.lognormvariate(6, 2.5)) + 1 for _ in range(12000)]  # > 10,000 scaffolds get sorted
+        self.check_plan(TileLayout(), lengths[:300])
+        self.check_plan(TileLayout(), lengths)
+        self.check_plan(TileLayout(use_titles=False), lengths[:300])
+        self.check_plan(TileLayout(custom_layout="([7,11,13,5,3,999], [0,0,1,4,9,20])"), lengths[:300])
+
+
+class TiledCanvasTest(unittest.TestCase):
+    def draw_everything(self, image):
+        """Same operations the Layouts use, on either a PIL Image or an ArrayCanvas"""
+        rng = np.random.RandomState(5)
+        if isinstance(image, ArrayCanvas):
+            image[10:200:3, 20:150] = rng.randint(0, 256, (64, 130, 3))
+            image[rng.randint(0, 300, 5000), rng.randint(0, 250, 5000)] = rng.randint(0, 256, (5000, 3))
+        else:
+            pixels = np.array(image)
+            pixels[10:200:3, 20:150] = rng.randint(0, 256, (64, 130, 3))
+            pixels[rng.randint(0, 300, 5000), rng.randint(0, 250, 5000)] = rng.randint(0, 256, (5000, 3))
+            image.paste(Image.fromarray(pixels), (0, 0))
+        image.load()[249, 299] = (1, 2, 3)
+        canvas_draw(image).rectangle([60, 100, 190, 170], fill=(201, 201, 201))
+        txt = Image.new('RGBA', (120, 40))
+        ImageDraw.Draw(txt).multiline_text((0, 0), "chr19\nsample", font=ImageFont.load_default(), fill=(0, 0, 0, 255))
+        image.paste(txt, (-10, 240), txt)  # partly off the canvas
+        canvas_draw(image).text((100, 30), "Title", font=ImageFont.load_default(), fill=(30, 30, 30, 255))
+        return image
+
+    def test_matches_pil_image(self):
+        expected = self.draw_everything(Image.new('RGB', (250, 300), (255, 255, 255)))
+        tiled = self.draw_everything(TiledCanvas('RGB', (250, 300), (255, 255, 255), tile_size=64,
+                                                 memory_budget=3 * 64 * 64 * 3))
+        self.assertTrue(tiled.spilled)  # only 3 of 20 tiles fit in the budget
+        self.assertIsNone(ImageChops.difference(expected, tiled.to_image()).getbbox())
+        path = 'tiled_canvas_test.png'
+        try:
+            tiled.save(path, 'PNG')
+            self.assertIsNone(ImageChops.difference(expected, Image.open(path).convert('RGB')).getbbox())
+        finally:
+            os.remove(path)
+        tiled.close()
+        self.assertFalse(tiled.tiles or tiled.spilled)
+
+    def test_memmap_matches_pil_image(self):
+        expected = self.draw_everything(Image.new('RGB', (250, 300), (255, 255, 255)))
+        canvas = self.draw_everything(MemmapCanvas('RGB', (250, 300), (255, 255, 255), directory='.'))
+        self.assertIsNone(ImageChops.difference(expected, canvas.to_image()).getbbox())
+        self.assertEqual(canvas.crop((240, 290, 256, 306)).getpixel((9, 9)), (1, 2, 3))
+        canvas.close()
+        self.assertFalse(os.path.exists(canvas.path))
+
+    def test_halved_in_bands(self):
+        canvas = self.draw_everything(TiledCanvas('RGB', (251, 301), (255, 255, 255), tile_size=64))
+        canvas.band_height = lambda: 16  # many bands
+        pixels = np.pad(np.asarray(canvas.to_image()).astype(int), ((0, 1), (0, 1), (0, 0)), mode='edge')
+        expected = (pixels[0::2, 0::2] + pixels[1::2, 0::2] + pixels[0::2, 1::2] + pixels[1::2, 1::2] + 2) // 4
+        self.assertEqual(np.asarray(canvas.halved()).tolist(), expected.tolist())
+
+    def test_reading_does_not_evict(self):
+        tiled = self.draw_everything(TiledCanvas('RGB', (250, 300), (255, 255, 255), tile_size=64,
+                                                 memory_budget=3 * 64 * 64 * 3))
+        in_memory, spilled = list(tiled.tiles), set(tiled.spilled)
+        boxes = [(x - 1, y - 1, x + 41, y + 41) for y in range(0, 300, 40) for x in range(0, 250, 40)]
+        for box, tile in zip(boxes, tiled.crop_tiles(boxes)):
+            self.assertIsNone(ImageChops.difference(tiled.crop(box), tile).getbbox())
+        self.assertEqual((in_memory, spilled), (list(tiled.tiles), tiled.spilled))
+        tiled.close()
+
+    def test_tiled_layout_matches_memory(self):
+        contigs = [250000, 123457, 999, 40]
+        layout = TileLayout()
+        layout.render_mode, layout.memory_budget = 'tiled', 1
+        tiled = DrawNucleotidesTest().render(layout, random_contigs(contigs), by_pixel=False)
+        memory = DrawNucleotidesTest().render(TileLayout(), random_contigs(contigs), by_pixel=False)
+        self.assertIsNone(ImageChops.difference(as_image(memory), tiled.to_image()).getbbox())
+
+
+class StreamedFastaTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.fa')
+        with os.fdopen(handle, 'w', newline='') as fasta:
+            fasta.write('>empty header is dropped\n>chr1 first\r\n')
+            sequence = random_contigs([250000], 'ACGTNacgt')[0].seq
+            fasta.write(''.join(sequence[i:i + 61] + '\r\n' for i in range(0, len(sequence), 61)))
+            fasta.write('\n>irregular\nACGT\nAC\n\nGGGTTT\n>no trailing newline\nacgtn')
+
+    def tearDown(self):
+        for path in [self.path, fai_path(self.path)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_matches_read_contigs(self):
+        streamed = streamed_contigs(self.path)
+        self.assertEqual([(c.name, c.seq) for c in read_contigs(self.path)],
+                         [(c.name, str(c.seq)) for c in streamed])
+        self.assertTrue(streamed[0].seq.entry.regular)
+        self.assertFalse(streamed[1].seq.entry.regular)
+        self.assertEqual(streamed[0].seq[123450:123460], str(streamed[0].seq)[123450:123460])
+
+    def test_indexed_extraction(self):
+        with open(self.path, 'w') as fasta:  # a .fai needs regular line lengths in every contig
+            fasta.write('>chr1\nACGTACGT\nAC\n>chr2 second one\nGATTACA\nga\n\n>no name\nnnn')
+        wanted = ['chr2', 'missing', 'no']
+        FastaIndex.save_indexes = False
+        try:
+            indexed = read_and_filter_contigs(self.path, wanted)
+        finally:
+            FastaIndex.save_indexes = True
+        self.assertFalse(os.path.exists(fai_path(self.path)))  # --no_fasta_index
+        self.assertEqual([c.seq for c in indexed], [c.seq for c in read_and_filter_contigs(self.path, wanted)])
+        self.assertTrue(os.path.exists(fai_path(self.path)))
+        self.assertEqual(['chr1', 'chr2', 'no'], [entry.name for entry in read_fai(fai_path(self.path))])
+        parsed = filter_by_contigs(read_contigs(self.path), wanted)
+        self.assertEqual([(c.name, c.seq) for c in parsed], [(c.name, c.seq) for c in indexed])
+        self.assertEqual('GATTACAGA', pluck_contig('CHR2 second one', self.path, verbose=False))
+
+    def test_streamed_layout_matches_memory(self):
+        memory = DrawNucleotidesTest().render(TileLayout(), read_contigs(self.path), by_pixel=False)
+        StreamedSequence.block_size = 1000  # many blocks, with column pieces crossing them
+        try:
+            streamed = DrawNucleotidesTest().render(TileLayout(), streamed_contigs(self.path), by_pixel=False)
+        finally:
+            StreamedSequence.block_size = 1024 * 1024
+        self.assertIsNone(ImageChops.difference(as_image(memory), as_image(streamed)).getbbox())
+
+
+class TitleCacheTest(unittest.TestCase):
+    def full_box_title(self, layout, text, width, height, font_size, vertical_label, canvas, upper_left):
+        """write_title() as it was, drawing into an image the size of the whole box"""
+        font = layout.get_font(font_size)
+        title = pretty_contig_name(text, 18, 2)
+        txt = Image.new('RGBA', (width, height))
+        bottom_justified = height - multi_line_height(font, title, txt)
+        ImageDraw.Draw(txt).multiline_text((0, max(0, bottom_justified)), title, font=font, fill=(0, 0, 0, 255))
+        if vertical_label:
+            txt = txt.rotate(90, expand=True)
+            upper_left = (upper_left[0] + 8, upper_left[1])
+        canvas.paste(txt, upper_left, txt)
+
+    def test_matches_full_box(self):
+        layout = TileLayout()
+        for text in ['chr19', 'scaffold_12345|quiver:extra_long_name', 'x']:
+            for width, height, font_size in [(300, 40, 9), (60, 30, 38), (900, 500, 380)]:
+                for vertical_label in [False, True]:
+                    expected = Image.new('RGB', (1200, 1200), (255, 255, 255))
+                    actual = expected.copy()
+                    self.full_box_title(layout, text, width, height, font_size, vertical_label, expected, (5, 7))
+                    for _ in range(2):  # second time comes from the cache
+                        layout.write_title(text, width, height, font_size, 2, 18, (5, 7), vertical_label, actual)
+                    self.full_box_title(layout, text, width, height, font_size, vertical_label, expected, (5, 7))
+                    self.assertIsNone(ImageChops.difference(expected, actual).getbbox(),
+                                      (text, width, height, font_size, vertical_label))
+        self.assertGreater(title_cache.hits, 0)
+
+    def test_workers_match_one_process(self):
+        lengths = [150000, 120000, 60000, 9000, 2000] * 4 + [2500000]
+        contigs = [Contig('scaffold_%i|%s' % (i % 7, 'x' * i), 'A' * n) for i, n in enumerate(lengths)]
+        images = []
+        for workers in [1, 3]:
+            title_cache.clear()
+            layout = TileLayout()
+            layout.workers = workers
+            DrawNucleotidesTest().render(layout, list(contigs), by_pixel=False)
+            layout.draw_titles()
+            images.append(layout.image)
+        self.assertIsNone(ImageChops.difference(as_image(images[0]), images[1].to_image()).getbbox())
+        images[1].close()
+        self.assertIsNone(title_cache.batch)
+
+    def test_labels_match_full_box(self):
+        levels, font = TileLayout().levels, ImageFont.load_default()
+        for strand in ['+', '-']:
+            for vertical_label, center, chop in [(False, False, True), (True, False, True), (False, True, False)]:
+                expected = Image.new('RGB', (300, 300), (255, 255, 255))
+                actual = expected.copy()
+                txt = Image.new('RGBA', (40, 30))  # write_label() as it was, for a name wider than the box
+                text_width = ImageDraw.Draw(txt).textsize('GENE_NAME', font)[0]
+                if not chop:
+                    txt = Image.new('RGBA', (text_width, 30))
+                top = 15 - multi_line_height(font, 'GENE_NAME', txt) // 2 if center or vertical_label else \
+                    (0 if strand == '+' else 30 - multi_line_height(font, 'GENE_NAME', txt))
+                ImageDraw.Draw(txt).multiline_text((0, max(0, top)), 'GENE_NAME', font=font, fill=(50, 50, 50, 255))
+                x, y = 100 + (40 - text_width) // 2, 100
+                if vertical_label:
+                    txt = txt.rotate(90 if strand == '-' else -90, expand=True)
+                    y += -4 if strand == '-' else 4
+                expected.paste(txt, (x, y), txt)
+                levels.write_label('GENE_NAME', 40, 30, font, 18, (100, 100), vertical_label, strand, actual,
+                                   horizontal_centering=True, center_vertical=center, chop_text=chop)
+                self.assertIsNone(ImageChops.difference(expected, actual).getbbox(), (strand, vertical_label, chop))
+
+
+class RunReportTest(unittest.TestCase):
+    def test_phases_and_json(self):
+        layout = TileLayout()
+        with layout.phase('padding'):
+            layout.contigs = random_contigs([250000, 999])
+            layout.calc_all_padding()
+        with self.assertRaises(ValueError):
+            with layout.phase('titles'):
+                raise ValueError()
+        with layout.phase('padding'):
+            pass
+        self.assertEqual([(p['phase'], p['error']) for p in layout.report.phases],
+                         [('padding', False), ('titles', True), ('padding', False)])
+        self.assertEqual(layout.report.totals()['padding']['runs'], 2)
+        directory = tempfile.mkdtemp()
+        try:
+            with open(layout.report.save(directory, 'TileLayout')) as saved:
+                report = json.load(saved)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(report['layout'], 'TileLayout')
+        self.assertGreaterEqual(report['wall_seconds'], report['phases'][0]['wall_seconds'])
+
+    def test_memory_high_water(self):
+        report = RunReport(trace_allocations=True)
+        with report.phase('allocate'):
+            block = np.ones(32 * 1024 ** 2, dtype=np.uint8)
+            time.sleep(0.3)  # long enough for the sampler to see it
+            del block
+        entry = report.phases[0]
+        self.assertGreaterEqual(entry['traced_peak'], 32 * 1024 ** 2)
+        self.assertTrue(entry['top_allocations'])
+        self.assertGreaterEqual(entry['rss_peak'], entry['rss_start'] + 16 * 1024 ** 2)
+        self.assertEqual(report.totals()['allocate']['rss_peak'], entry['rss_peak'])
+
+    def test_sampler_paused_while_forking(self):
+        sampling = []
+        os.register_at_fork(before=lambda: sampling.append([s.thread.is_alive() for s in running_samplers]))
+        with RunReport().phase('fork', verbose=False):
+            pool = fork_pool(2)
+            pool.map(abs, [-1, -2])
+            pool.close()
+            pool.join()
+            self.assertTrue(running_samplers[0].thread.is_alive())  # sampling the workers from here again
+        self.assertEqual(sampling[:2], [[False], [False]])
+        self.assertEqual(running_samplers, [])
+
+
+class PreflightTest(unittest.TestCase):
+    def test_render_mode_follows_available_ram(self):
+        small = Preflight(2584, 1009, 3)
+        self.assertEqual(small.tile_count, 70)  # what deepzoom wrote for hg38_chr19_sample
+        self.assertEqual(small.choose_render_mode(), 'memory')
+        huge = Preflight(small.available_ram // 1000, 1000, 3)  # three times the available RAM
+        self.assertEqual(huge.choose_render_mode(), 'tiled')
+        self.assertTrue(huge.warnings('memory'))
+
+    def test_memory_needed_per_render_mode(self):
+        """Peaks measured on 369 megapixels: 1262MB with a NumpyCanvas, 1410MB with a PIL Image"""
+        stream = 10000 * 5 * 256 * 4  # deep zoom rows
+        array = Preflight(10000, 5000, 3)
+        self.assertEqual(array.memory_needed('memory'), 3 * 50000000 + stream)
+        self.assertEqual(array.memory_needed('memmap'), stream)
+        self.assertEqual(array.memory_needed('tiled'), stream)
+        pil = Preflight(10000, 5000, 3, pil_image=True)
+        self.assertEqual(pil.canvas_bytes, 4 * 50000000)
+        self.assertEqual(pil.memory_needed('memory'), 4 * 50000000)  # released before deep zoom reads the PNG
+        self.assertEqual(pil.disk_needed('memmap') - pil.disk_needed('memory'), 3 * 50000000)
+        no_webpage = Preflight(10000, 5000, 3, webpage=False, pil_image=True)
+        self.assertEqual(no_webpage.memory_needed('memory'), 4 * 50000000)
+        self.assertEqual(Preflight(10000, 5000, 1).memory_needed('memory'), 50000000 + stream)  # indexed
+
+    def test_pil_canvas_estimate(self):
+        layout = TileLayout()
+        layout.contigs = random_contigs([250000])
+        layout.calc_all_padding()
+        self.assertTrue(layout.memory_canvas_is_array('RGB'))
+        layout.draws_by_pixel = True
+        self.assertFalse(layout.memory_canvas_is_array('RGB'))
+        self.assertTrue(layout.memory_canvas_is_array('P'))
+
+    def test_dry_run_allocates_nothing(self):
+        layout = TileLayout()
+        layout.render_mode, layout.dry_run = 'auto', True
+        layout.contigs = random_contigs([250000])
+        with self.assertRaises(DryRun):
+            layout.prepare_image(layout.calc_all_padding())
+        self.assertIsNone(layout.image)
+        self.assertEqual(layout.render_mode, 'memory')
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_sampling_profile_loads_in_pstats(self):
+        directory = tempfile.mkdtemp()
+        try:
+            profiler = JobProfiler('sample').start()
+            end = time.time() + 0.3
+            while time.time() < end:
+                sum(i * i for i in range(1000))
+            path = profiler.finish(directory)
+            self.assertIsNone(profiler.finish(directory))  # only saved once
+            stats = pstats.Stats(path).stats
+            self.assertTrue(any(name == 'test_sampling_profile_loads_in_pstats' for _, _, name in stats))
+            self.assertTrue(os.path.exists(os.path.join(directory, 'fluentdna_hotspots.txt')))
+        finally:
+            shutil.rmtree(directory)
+
+
+class SyntheticGenomeTest(unittest.TestCase):
+    def test_deterministic_and_parseable(self):
+        directory = tempfile.mkdtemp()
+        try:
+            genome = SyntheticGenome(directory, 200000, 7, seed=3).generate()
+            again = SyntheticGenome(os.path.join(directory, 'again'), 200000, 7, seed=3).generate()
+            for path, other in [(genome.fasta, again.fasta), (genome.gff, again.gff), (genome.chain, again.chain)]:
+                with open(path, 'rb') as a, open(other, 'rb') as b:
+                    self.assertEqual(a.read(), b.read())
+            contigs = read_contigs(genome.fasta)
+            self.assertEqual([c.name for c in contigs], genome.names)
+            self.assertEqual([len(c.seq) for c in contigs], genome.lengths)
+            self.assertEqual(sum(genome.lengths), 200000)
+            self.assertTrue(set(contigs[0].seq) <= set('ACGT'))
+            genes = [e for entries in parseGFF(genome.gff).values() for e in entries if e.type == 'gene']
+            self.assertTrue(genes)
+            lengths = dict(zip(genome.names, genome.lengths))
+            self.assertTrue(all(1 <= g.start <= g.end <= lengths[g.seqid] for g in genes))
+            for chain in chain_file_to_list(genome.chain):
+                self.assertEqual(chain.tEnd, sum(e.size + e.gap_query for e in chain.entries))
+                self.assertEqual(chain.qEnd, sum(e.size + e.gap_ref for e in chain.entries))
+                self.assertLessEqual(max(chain.tEnd, chain.qEnd), chain.tSize)
+        finally:
+            shutil.rmtree(directory)
+
+
+class RenderTest(unittest.TestCase):
+    def test_render_matches_process_file_without_writing(self):
+        directory = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            contigs = random_contigs([250000, 123457, 999])
+            fasta = os.path.join(directory, 'render.fa')
+            write_contigs_to_file(fasta, contigs)
+            TileLayout().process_file(fasta, os.path.join(directory, 'out'), 'render', no_webpage=True)
+            written = np.asarray(Image.open(os.path.join(directory, 'out', 'render.png')))
+            os.chdir(directory)
+            before = sorted(os.listdir(directory))
+            pixels, layout_json = render(contigs)
+            self.assertEqual(sorted(os.listdir(directory)), before)
+            self.assertTrue(np.array_equal(pixels, written))
+            self.assertEqual((layout_json['height'], layout_json['width']), pixels.shape[:2])
+            self.assertEqual([c['name'] for c in layout_json['contigs']], [c.name for c in contigs])
+            json.dumps(layout_json)
+
+            tiled = TileLayout()
+            tiled.render_mode = 'tiled'
+            window, _ = render(fasta, tiled, region=(100, 200, 612, 456))
+            self.assertTrue(np.array_equal(window, written[200:456, 100:612]))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory)
+
+
+class ProgressTest(unittest.TestCase):
+    def test_cancel_saves_partial_image(self):
+        directory = tempfile.mkdtemp()
+        try:
+            contigs = random_contigs([250000, 123457, 999, 40])
+            events = []
+            token = CancelToken()
+
+            def callback(event):
+                events.append(event)
+                if event.contig == 'contig_1':
+                    token.cancel()  # takes effect at the next update, after contig_2 is drawn
+            layout = TileLayout()
+            layout.progress = Progress(callback, token, interval=0)
+            with self.assertRaises(Cancelled):
+                layout.process_file(contigs, directory, 'cancelled', no_webpage=True)
+            self.assertEqual([(e.phase, e.fraction) for e in events[:3]],
+                             [('read', 0.0), ('read', 1.0), ('padding', 0.0)])
+            self.assertEqual([e.contig for e in events if e.contig], ['contig_0', 'contig_1'])
+            self.assertEqual(layout.report.phases[-1]['phase'], 'png')
+            partial = np.asarray(Image.open(os.path.join(directory, 'cancelled.png')))
+            drawn = np.count_nonzero((partial != 255).any(axis=2))
+            self.assertEqual(drawn, 250000 + 123457 + 999)  # up to contig_2, no titles
+        finally:
+            shutil.rmtree(directory)
+
+    def test_updates_are_throttled(self):
+        events = []
+        progress = Progress(events.append, interval=60)
+        with progress.phase('nucleotides'):
+            for i in range(1000):
+                progress.update(i / 1000., 'chr1')
+        self.assertEqual(len(events), 3)  # start, the first update and done
+
+
+class DeepZoomTest(unittest.TestCase):
+    def create(self, image, directory, workers=1):
+        creator = ImageCreator(tile_size=256, tile_overlap=1, tile_format='png', workers=workers)
+        creator.create(image, os.path.join(directory, 'dzc_output.xml'))
+        return creator.descriptor, os.path.join(directory, 'dzc_output_files')
+
+    def tile(self, files, level, column, row):
+        return np.asarray(Image.open(os.path.join(files, str(level), '%i_%i.png' % (column, row))))
+
+    def test_levels_are_halved_from_each_other(self):
+        """Odd sizes on every level and a white border, the smallest level is still the mean color"""
+        directory = tempfile.mkdtemp()
+        try:
+            pixels = np.random.RandomState(0).randint(0, 256, (1027, 2601, 3)).astype(np.uint8)
+            pixels[-20:] = 255
+            descriptor, files = self.create(Image.fromarray(pixels), directory)
+            top = descriptor.num_levels - 1
+            self.assertTrue(np.array_equal(self.tile(files, top, 1, 2), pixels[511:769, 255:513]))
+            for level in range(descriptor.num_levels):
+                columns, rows = descriptor.get_num_tiles(level)
+                self.assertEqual(len(os.listdir(os.path.join(files, str(level)))), columns * rows)
+            half = pixels[:1026, :2600].reshape(513, 2, 1300, 2, 3).astype(int).sum(axis=(1, 3))
+            self.assertTrue(np.array_equal(self.tile(files, top - 1, 0, 0), (half[:257, :257] + 2) // 4))
+            smallest = self.tile(files, 0, 0, 0).reshape(3)
+            self.assertTrue(np.all(np.abs(smallest - pixels.reshape(-1, 3).mean(axis=0)) <= 1.5))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_png_read_in_bands(self):
+        """Every PNG filter type, with bands and reads that don't line up with the IDAT chunks"""
+        directory = tempfile.mkdtemp()
+        try:
+            pixels = np.random.RandomState(4).randint(0, 256, (301, 97, 3))
+            pixels[:, 50:] = pixels[:, 50:] // 64 * 64  # runs for the filters to predict
+            raw = pixels.reshape(301, -1)
+            up = np.vstack([np.zeros_like(raw[:1]), raw[:-1]])
+            left, upleft = np.pad(raw, ((0, 0), (3, 0)))[:, :-3], np.pad(up, ((0, 0), (3, 0)))[:, :-3]
+            guess = left + up - upleft
+            near_left, near_up = np.abs(guess - left), np.abs(guess - up)
+            paeth = np.where((near_left <= near_up) & (near_left <= np.abs(guess - upleft)), left,
+                             np.where(near_up <= np.abs(guess - upleft), up, upleft))
+            predictions = [np.zeros_like(raw), left, up, (left + up) // 2, paeth]
+            lines = b''.join(bytes([y % 5]) + ((raw[y] - predictions[y % 5][y]) % 256).astype(np.uint8).tobytes()
+                             for y in range(301))
+            data = zlib.compress(lines)
+            path = os.path.join(directory, 'filters.png')
+            with open(path, 'wb') as f:
+                f.write(b'\x89PNG\r\n\x1a\n')
+                write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', 97, 301, 8, 2, 0, 0, 0))
+                for start in range(0, len(data), 5000):
+                    write_png_chunk(f, b'IDAT', data[start:start + 5000])
+                write_png_chunk(f, b'IEND', b'')
+            self.assertTrue(np.array_equal(np.asarray(Image.open(path)), pixels))
+            rows = PNGRows.open(path)
+            rows.read_size = 777
+            bands = [np.asarray(rows.read(height)) for height in [1, 100, 7, 193]]
+            rows.close()
+            self.assertTrue(np.array_equal(np.concatenate(bands), pixels))
+            self.assertIsNone(PNGRows.open(__file__))
+            self.create(path, os.path.join(directory, 'streamed'))
+            self.create(Image.open(path), os.path.join(directory, 'decoded'))
+            for name in os.listdir(os.path.join(directory, 'decoded', 'dzc_output_files', '1')):
+                tiles = [os.path.join(directory, d, 'dzc_output_files', '1', name) for d in ['streamed', 'decoded']]
+                self.assertTrue(filecmp.cmp(tiles[0], tiles[1], shallow=False), name)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_uniform_tiles_are_linked(self):
+        """Blank tiles share one file, and writing over an old result doesn't write through its links"""
+        directory = tempfile.mkdtemp()
+        try:
+            pixels = np.full((1000, 1000, 3), 255, dtype=np.uint8)
+            pixels[:300, :300] = np.random.RandomState(2).randint(0, 256, (300, 300, 3))
+            descriptor, files = self.create(Image.fromarray(pixels), directory)
+            top = str(descriptor.num_levels - 1)
+            self.assertEqual(os.stat(os.path.join(files, top, '2_1.png')).st_ino,
+                             os.stat(os.path.join(files, top, '2_2.png')).st_ino)
+            self.assertTrue(np.all(self.tile(files, int(top), 2, 2) == 255))
+            pixels[700:] = 0
+            self.create(Image.fromarray(pixels), directory)
+            self.assertTrue(np.all(self.tile(files, int(top), 2, 1) == 255))
+            self.assertTrue(np.all(self.tile(files, int(top), 1, 3)[-100:] == 0))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_canvas_is_streamed_in_tile_rows(self):
+        """An indexed canvas is read one band of tile rows at a time and tiled like the same PIL Image"""
+        class CountedCanvas(MemmapCanvas):
+            def read_region(self, x0, y0, x1, y1):
+                self.tallest = max(getattr(self, 'tallest', 0), y1 - y0)
+                return super(CountedCanvas, self).read_region(x0, y0, x1, y1)
+        directory = tempfile.mkdtemp()
+        canvas = CountedCanvas('P', (1100, 1300), (255, 255, 255),
+                               palette=[(255, 255, 255), (10, 200, 30), (0, 0, 0), (200, 0, 0)], directory=directory)
+        try:
+            canvas.write_region(0, 0, np.random.RandomState(3).randint(0, 4, (900, 1100, 1)).astype(np.uint8))
+            self.create(canvas, os.path.join(directory, 'canvas'))
+            self.assertEqual(canvas.tallest, 256)
+            descriptor, files = self.create(canvas.to_image(), os.path.join(directory, 'image'))
+            for level in range(descriptor.num_levels):
+                for name in os.listdir(os.path.join(files, str(level))):
+                    with open(os.path.join(directory, 'canvas', 'dzc_output_files', str(level), name), 'rb') as a, \
+                            open(os.path.join(files, str(level), name), 'rb') as b:
+                        self.assertEqual(a.read(), b.read())
+        finally:
+            canvas.close()
+            shutil.rmtree(directory)
+
+    def test_workers_write_the_same_tiles(self):
+        directory = tempfile.mkdtemp()
+        try:
+            pixels = np.random.RandomState(1).randint(0, 256, (900, 700, 3)).astype(np.uint8)
+            serial_descriptor, serial = self.create(Image.fromarray(pixels), os.path.join(directory, 'serial'))
+            descriptor, files = self.create(Image.fromarray(pixels), os.path.join(directory, 'workers'), workers=3)
+            for level in range(descriptor.num_levels):
+                names = sorted(os.listdir(os.path.join(serial, str(level))))
+                self.assertEqual(names, sorted(os.listdir(os.path.join(files, str(level)))))
+                for name in names:
+                    with open(os.path.join(serial, str(level), name), 'rb') as a, \
+                            open(os.path.join(files, str(level), name), 'rb') as b:
+                        self.assertEqual(a.read(), b.read())
+        finally:
+            shutil.rmtree(directory)
+
+
+class TileArchiveTest(unittest.TestCase):
+    def test_archive_serves_the_same_tiles(self):
+        """Every tile in the archive is the same bytes as its file, with or without workers, and the server
+        answers the usual dzc_output_files/ URLs from it"""
+        from functools import partial
+        from http.server import SimpleHTTPRequestHandler
+        from socketserver import TCPServer
+        from threading import Thread
+        from urllib.error import HTTPError
+        from urllib.request import urlopen
+        directory = tempfile.mkdtemp()
+        try:
+            pixels = np.full((700, 1200, 3), 255, dtype=np.uint8)
+            pixels[:400, :500] = np.random.RandomState(4).randint(0, 256, (400, 500, 3))
+            image = Image.fromarray(pixels)
+            for name, workers, archive in [('files', 1, False), ('archive', 1, True), ('workers', 2, True)]:
+                creator = ImageCreator(tile_size=256, tile_overlap=1, tile_format='png', workers=workers,
+                                       archive=archive)
+                creator.create(image, os.path.join(directory, name, 'dzc_output.xml'))
+            files = os.path.join(directory, 'files', 'dzc_output_files')
+            self.assertFalse(os.path.exists(os.path.join(directory, 'archive', 'dzc_output_files')))
+            with open(os.path.join(directory, 'archive', 'dzc_output.tiles'), 'rb') as a, \
+                    open(os.path.join(directory, 'workers', 'dzc_output.tiles'), 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+            archive = TileArchive(os.path.join(directory, 'archive', 'dzc_output.tiles'))
+            count = 0
+            for level in os.listdir(files):
+                for name in os.listdir(os.path.join(files, level)):
+                    column, row = [int(x) for x in name[:-4].split('_')]
+                    with open(os.path.join(files, level, name), 'rb') as tile:
+                        self.assertEqual(archive.read(int(level), column, row), tile.read())
+                    count += 1
+            self.assertEqual(len(archive), count)
+            self.assertIsNone(archive.read(0, 5, 5))
+
+            handler = archive_request_handler(SimpleHTTPRequestHandler)
+            handler.log_message = lambda *args: None
+            httpd = TCPServer(('localhost', 0), partial(handler, directory=directory))
+            Thread(target=httpd.serve_forever).start()
+            try:
+                url = 'http://localhost:%i/archive/dzc_output_files/' % httpd.server_address[1]
+                with open(os.path.join(files, '11', '1_0.png'), 'rb') as tile:
+                    self.assertEqual(urlopen(url + '11/1_0.png').read(), tile.read())
+                with self.assertRaises(HTTPError):
+                    urlopen(url + '11/9_9.png')
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class StartupTest(unittest.TestCase):
+    def test_import_stays_light(self):
+        """fluentdna --version and --help shouldn't wait for numpy, PIL and every Layout to load"""
+        result = startup(repeat=1)
+        self.assertEqual(result['heavy modules'], [])
+
+
 if __name__ == '__main__':
     unittest.main()